@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+from __future__ import print_function, division
+import six
+
+# import modules
+import sys
+import os
+import time
+import inspect
+import argparse
+import glob
+import shutil
+import tempfile
+import numpy as np
+import h5py
+from skimage.external import tifffile as tiff
+
+# user modules
+# realpath() will make your script run, even if you symlink it
+cmd_folder = os.path.realpath(os.path.abspath(
+                          os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+mm3_helper_folder = os.path.join(cmd_folder, '..')
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+if mm3_helper_folder not in sys.path:
+    sys.path.insert(0, mm3_helper_folder)
+
+import mm3_helpers as mm3
+
+### functions
+# load the oriented phase plane of a raw image
+def load_phase_plane(image_filename):
+    with tiff.TiffFile(os.path.join(mm3.params['TIFF_dir'], image_filename)) as tif:
+        image_data = tif.asarray()
+
+    if len(image_data.shape) > 2:
+        ph_index = int(mm3.params['phase_plane'][1:]) - 1
+        image_data = image_data[ph_index]
+
+    return mm3.fix_orientation(image_data)
+
+# compare the wavelet and FFT channel detectors
+def benchmark_channel_detection(image_filenames):
+    '''Runs find_channel_peaks_cwt and find_channel_peaks_fft on the x projection of
+    the phase plane of each image. Reports the time per image for each and how well
+    the FFT channels agree with the CWT channels.
+
+    A CWT channel is matched if there is an FFT channel within half a channel width.
+    '''
+
+    chan_w = mm3.params['compile']['channel_width']
+
+    cwt_times = []
+    fft_times = []
+    cwt_counts = []
+    fft_counts = []
+    matched_counts = []
+    offsets = []
+
+    for image_filename in image_filenames:
+        image_data = load_phase_plane(image_filename)
+        projection_x = image_data.sum(axis=0).astype(np.int32)
+
+        t0 = time.time()
+        cwt_peaks = mm3.find_channel_peaks_cwt(projection_x)
+        cwt_times.append(time.time() - t0)
+
+        t0 = time.time()
+        fft_peaks = mm3.find_channel_peaks_fft(projection_x)
+        fft_times.append(time.time() - t0)
+
+        cwt_counts.append(len(cwt_peaks))
+        fft_counts.append(len(fft_peaks))
+
+        matched = 0
+        for peak in cwt_peaks:
+            if len(fft_peaks) == 0:
+                break
+            distance = np.min(np.abs(fft_peaks - peak))
+            if distance <= chan_w / 2:
+                matched += 1
+                offsets.append(distance)
+        matched_counts.append(matched)
+
+        mm3.information('%s: %d CWT channels, %d FFT channels, %d matched.'
+                        % (image_filename, len(cwt_peaks), len(fft_peaks), matched))
+
+    mm3.information('Channel detection on %d images:' % len(image_filenames))
+    mm3.information('  cwt: %.2f ms per image, %.1f channels per image.'
+                    % (1000 * np.mean(cwt_times), np.mean(cwt_counts)))
+    mm3.information('  fft: %.2f ms per image, %.1f channels per image.'
+                    % (1000 * np.mean(fft_times), np.mean(fft_counts)))
+    mm3.information('  speedup: %.1fx' % (np.sum(cwt_times) / max(np.sum(fft_times), 1e-9)))
+    if np.sum(cwt_counts) > 0:
+        mm3.information('  %.1f%% of CWT channels matched, mean offset %.2f px.'
+                        % (100. * np.sum(matched_counts) / np.sum(cwt_counts),
+                           np.mean(offsets) if offsets else np.nan))
+
+    return
+
+# load the phase stacks of the first channels of the experiment
+def load_channel_stacks(stack_count):
+    channel_masks = mm3.load_channel_masks()
+
+    image_stacks = []
+    for fov_id in sorted(channel_masks.keys()):
+        for peak_id in sorted(channel_masks[fov_id].keys()):
+            if len(image_stacks) >= stack_count:
+                return image_stacks
+            image_stacks.append(mm3.load_stack(fov_id, peak_id, color=mm3.params['phase_plane']))
+
+    return image_stacks
+
+# load phase stacks of channels with cells and the empty stacks of their FOVs
+def load_subtract_pairs(stack_count):
+    specs = mm3.load_specs()
+    color = mm3.params['phase_plane']
+
+    subtract_pairs = []
+    for fov_id in sorted(specs.keys()):
+        for peak_id in sorted(specs[fov_id].keys()):
+            if len(subtract_pairs) >= stack_count:
+                return subtract_pairs
+            if specs[fov_id][peak_id] != 1:
+                continue
+            subtract_pairs.append((mm3.load_stack(fov_id, peak_id, color=color),
+                                   mm3.load_stack(fov_id, 0, color='empty_%s' % color)))
+
+    return subtract_pairs
+
+# compare frame by frame and batched phase subtraction
+def benchmark_subtract(subtract_pairs):
+    '''Subtracts each channel stack with subtract_phase one frame at a time, as
+    before, and with subtract_phase_stack. Reports frames per second for each and
+    the number of frames where the two outputs differ.
+    '''
+
+    frame_times = []
+    stack_times = []
+    frame_count = 0
+    differing_frames = 0
+
+    for image_data, avg_empty_stack in subtract_pairs:
+        t0 = time.time()
+        frame_subtracted = np.stack([mm3.subtract_phase(image_pair) for image_pair
+                                     in zip(image_data, avg_empty_stack)], axis=0)
+        frame_times.append(time.time() - t0)
+
+        t0 = time.time()
+        stack_subtracted = mm3.subtract_phase_stack(image_data, avg_empty_stack)
+        stack_times.append(time.time() - t0)
+
+        frame_count += frame_subtracted.shape[0]
+        differing_frames += np.sum(np.any(frame_subtracted != stack_subtracted, axis=(1, 2)))
+
+    mm3.information('Phase subtraction of %d stacks, %d frames:' % (len(subtract_pairs), frame_count))
+    mm3.information('  by frame: %.1f frames/s' % (frame_count / max(np.sum(frame_times), 1e-9)))
+    mm3.information('  by stack: %.1f frames/s' % (frame_count / max(np.sum(stack_times), 1e-9)))
+    mm3.information('  speedup: %.1fx' % (np.sum(frame_times) / max(np.sum(stack_times), 1e-9)))
+    mm3.information('  %d frames differ.' % differing_frames)
+
+    return
+
+# compare compression codecs for HDF5 and TIFF output
+def benchmark_codecs(image_stacks):
+    '''Writes the stacks to a scratch HDF5 file with each codec and reports the
+    write and read speed in MB/s of raw data and the compression ratio. TIFF stacks
+    are done the same way for each zlib level.
+
+    Reads come straight after writes, so they are mostly served from the page cache
+    and measure decoding more than the disk.
+    '''
+
+    codecs = [('none', 0), ('gzip', 1), ('gzip', 4), ('gzip', 9), ('lzf', 0)]
+    if mm3.hdf5plugin is not None:
+        codecs += [('lz4', 0), ('blosc', 5), ('blosc_zstd', 5), ('zstd', 3)]
+    else:
+        mm3.information('hdf5plugin is not installed, skipping lz4, blosc and zstd.')
+
+    raw_mb = sum([image_stack.nbytes for image_stack in image_stacks]) / 1e6
+    mm3.information('Benchmarking codecs on %d stacks, %.1f MB.' % (len(image_stacks), raw_mb))
+
+    scratch_dir = tempfile.mkdtemp(prefix='mm3_codecs_')
+    try:
+        for codec, level in codecs:
+            storage_options = dict(mm3.default_storage_options, codec=codec, level=level)
+            h5_path = os.path.join(scratch_dir, '%s_%d.hdf5' % (codec, level))
+
+            t0 = time.time()
+            with h5py.File(h5_path, 'w') as h5f:
+                for n, image_stack in enumerate(image_stacks):
+                    h5f.create_dataset('stack_%04d' % n, data=image_stack,
+                        **mm3.get_h5_dataset_options(None, image_stack.shape[1:],
+                                                     storage_options=storage_options))
+            write_time = time.time() - t0
+
+            t0 = time.time()
+            with h5py.File(h5_path, 'r') as h5f:
+                for n in range(len(image_stacks)):
+                    h5f['stack_%04d' % n][:]
+            read_time = time.time() - t0
+
+            ratio = raw_mb * 1e6 / os.path.getsize(h5_path)
+            mm3.information('  HDF5 %-10s level %d: write %7.1f MB/s, read %7.1f MB/s, ratio %.2f'
+                            % (codec, level, raw_mb / max(write_time, 1e-9),
+                               raw_mb / max(read_time, 1e-9), ratio))
+
+        for level in (0, 1, 4, 9):
+            tif_paths = [os.path.join(scratch_dir, 'stack_%04d_%d.tif' % (n, level))
+                         for n in range(len(image_stacks))]
+
+            t0 = time.time()
+            for tif_path, image_stack in zip(tif_paths, image_stacks):
+                tiff.imsave(tif_path, image_stack, compress=level)
+            write_time = time.time() - t0
+
+            t0 = time.time()
+            for tif_path in tif_paths:
+                tiff.imread(tif_path)
+            read_time = time.time() - t0
+
+            ratio = raw_mb * 1e6 / sum([os.path.getsize(tif_path) for tif_path in tif_paths])
+            mm3.information('  TIFF zlib       level %d: write %7.1f MB/s, read %7.1f MB/s, ratio %.2f'
+                            % (level, raw_mb / max(write_time, 1e-9),
+                               raw_mb / max(read_time, 1e-9), ratio))
+    finally:
+        shutil.rmtree(scratch_dir)
+
+    return
+
+# when using this script as a function and not as a library the following will execute
+if __name__ == "__main__":
+    '''mm3_Benchmark.py times alternative implementations of pipeline steps on the
+    images of an experiment and checks that they agree.
+    '''
+
+    # set switches and parameters
+    parser = argparse.ArgumentParser(prog='python mm3_Benchmark.py',
+                                     description='Benchmarks alternative implementations of mm3 steps.')
+    parser.add_argument('-f', '--paramfile', type=str,
+                        required=True, help='Yaml file containing parameters.')
+    parser.add_argument('-t', '--test', type=str, default='channels',
+                        choices=['channels', 'codecs', 'subtract'],
+                        required=False, help='Which step to benchmark.')
+    parser.add_argument('-n', '--number', type=int, default=50,
+                        required=False, help='Number of images (or channel stacks for codecs and subtract) to use.')
+    namespace = parser.parse_args()
+
+    # Load the project parameters file
+    mm3.information('Loading experiment parameters.')
+    p = mm3.init_mm3_helpers(namespace.paramfile) # initialized the helper library
+
+    if namespace.test == 'codecs':
+        image_stacks = load_channel_stacks(namespace.number)
+        if len(image_stacks) == 0:
+            mm3.warning('No channel stacks found, run mm3_Compile.py first.')
+            sys.exit(1)
+        benchmark_codecs(image_stacks)
+        sys.exit(0)
+
+    if namespace.test == 'subtract':
+        subtract_pairs = load_subtract_pairs(namespace.number)
+        if len(subtract_pairs) == 0:
+            mm3.warning('No channel stacks found, run mm3_Subtract.py with do_empties first.')
+            sys.exit(1)
+        benchmark_subtract(subtract_pairs)
+        sys.exit(0)
+
+    # spread the images over the whole experiment
+    found_files = sorted([os.path.basename(filepath) for filepath in
+                          glob.glob(os.path.join(p['TIFF_dir'], '*.tif'))])
+    if len(found_files) == 0:
+        mm3.warning('No TIFF files found in %s.' % p['TIFF_dir'])
+        sys.exit(1)
+    picks = np.unique(np.linspace(0, len(found_files) - 1, namespace.number).astype(int))
+    image_filenames = [found_files[i] for i in picks]
+
+    if namespace.test == 'channels':
+        benchmark_channel_detection(image_filenames)
@@ -16,6 +16,9 @@ try:
     import cPickle as pickle
 except:
     import pickle
+import threading
+from six.moves import queue
+from multiprocessing import Pool
 import numpy as np
 from skimage.external import tifffile as tiff
 import pims_nd2
@@ -38,10 +41,314 @@ if mm3_dir not in sys.path:
 # this is the mm3 module with all the useful functions and classes
 import mm3_helpers as mm3
 
+### functions
+# get the start time of an nd2 file as a julian date
+def get_nd2_start_time(nd2f):
+    try:
+        starttime = nd2f.metadata['time_start_jdn'] # starttime is jd
+        mm3.information('Starttime got from nd2 metadata.')
+    except ValueError:
+        # problem with the date
+        jdn = mm3.julian_day_number()
+        nd2f._lim_metadata_desc.dTimeStart = jdn
+        starttime = nd2f.metadata['time_start_jdn'] # starttime is jd
+        mm3.information('Starttime found from lim.')
+
+    return starttime
+
+# get the color names out. Kinda roundabout way.
+def get_nd2_planes(nd2f):
+    return [nd2f.metadata[md]['name'] for md in nd2f.metadata if md[0:6] == u'plane_' and not md == u'plane_count']
+
+# time points to take out of an nd2 file
+def get_extraction_range(nd2f):
+    '''Returns the range of time points to extract. Note the indexing,
+    it is zero indexed to grab from nd2, but TIFF naming starts at 1.
+    If there is more than one FOV (len(nd2f) != 1), make sure the user input
+    last time index is before the actual time index. Ignore it.'''
+
+    image_start = max(p['nd2ToTIFF']['image_start'], 1)
+    image_end = p['nd2ToTIFF']['image_end']
+    if image_end == 'None':
+        image_end = False
+    if image_end:
+        if len(nd2f) > 1 and len(nd2f) < image_end:
+            image_end = len(nd2f)
+    else:
+        image_end = len(nd2f)
+
+    return range(image_start, image_end+1)
+
+# get the time and stage position of a frame
+def get_nd2_frame_metadata(frame, starttime):
+    # get time picture was taken
+    seconds = copy.deepcopy(frame.metadata['t_ms']) / 1000.
+    minutes = seconds / 60.
+    hours = minutes / 60.
+    days = hours / 24.
+    acq_time = starttime + days
+
+    # get physical location FOV on stage
+    x_um = frame.metadata['x_um']
+    y_um = frame.metadata['y_um']
+
+    return acq_time, x_um, y_um
+
+# crop image data to a single row of channels
+def crop_nd2_image(image_data, vertical_crop):
+    '''Crops [plane, y, x] or [y, x] image data in y to the fractions given by
+    vertical_crop, [ymin, ymax]. Does nothing if vertical_crop is False.'''
+
+    if not vertical_crop:
+        return image_data
+
+    H = image_data.shape[-2]
+    ylo = int(vertical_crop[0]*H)
+    yhi = int(vertical_crop[1]*H)
+
+    return image_data[..., ylo:yhi, :]
+
+# read frames of one FOV from nd2 files in the form used for slicing
+def read_nd2_frames(image_names, frame_sources, vertical_crop):
+    '''Yields the [y, x, plane] pixel data for each image name, one frame at a time.
+    frame_sources gives the nd2 file, time index, and FOV index of each name.
+    '''
+
+    nd2f = None
+    current_file = None
+
+    try:
+        for image_name in image_names:
+            nd2_file, t_id, fov_id = frame_sources[image_name]
+
+            if nd2_file != current_file:
+                if nd2f is not None:
+                    nd2f.close()
+                nd2f = pims_nd2.ND2_Reader(nd2_file)
+                current_file = nd2_file
+
+                # this insures all colors will be read
+                if len(get_nd2_planes(nd2f)) > 1:
+                    nd2f.bundle_axes = [u'c', u'y', u'x']
+
+            nd2f.default_coords[u'm'] = fov_id
+            image_data = crop_nd2_image(np.asarray(nd2f[t_id]), vertical_crop)
+
+            yield mm3.prepare_frame_for_slicing(image_data)
+
+    finally:
+        if nd2f is not None:
+            nd2f.close()
+
+# put the nd2 files straight into HDF5 files
+def nd2_to_hdf5(nd2files, user_spec_fovs, vertical_crop):
+    '''Streams frames from the nd2 files into the per FOV HDF5 files made by
+    mm3_Compile.py, without writing TIFFs in between.
+
+    The first pass reads the phase plane of every frame to get the metadata and
+    find channels, from which the channel masks are made. The image metadata index
+    and time table are saved as well. The second pass reads all planes of each FOV
+    in time order and writes the channel slices with hdf5_slice_and_write_frames.
+    Images are named as the TIFFs would have been.
+    '''
+
+    ph_index = int(p['phase_plane'][1:]) - 1
+
+    analyzed_imgs = {} # image metadata, as get_tif_params makes it
+    frame_sources = {} # nd2 file, time index, and FOV index for each image
+
+    # first pass, find channels on the phase plane
+    for nd2_file in nd2files:
+        file_prefix = os.path.split(os.path.splitext(nd2_file)[0])[1]
+        mm3.information('Finding channels in %s ...' % file_prefix)
+
+        with pims_nd2.ND2_Reader(nd2_file) as nd2f:
+            starttime = get_nd2_start_time(nd2f)
+            planes = get_nd2_planes(nd2f)
+
+            # only the phase plane is read
+            nd2f.bundle_axes = [u'y', u'x']
+            if len(planes) > 1:
+                nd2f.default_coords[u'c'] = ph_index
+
+            for fov_id in range(0, nd2f.sizes[u'm']): # for every FOV
+                # fov_id is the fov index according to elements, fov is the output fov ID
+                fov = fov_id + 1
+
+                # skip FOVs as specified above
+                if len(user_spec_fovs) > 0 and not (fov in user_spec_fovs):
+                    continue
+
+                # set the FOV we are working on in the nd2 file object
+                nd2f.default_coords[u'm'] = fov_id
+
+                for t in get_extraction_range(nd2f):
+                    t_id = t - 1
+                    frame = nd2f[t_id]
+                    acq_time, x_um, y_um = get_nd2_frame_metadata(frame, starttime)
+
+                    image_data = crop_nd2_image(np.asarray(frame), vertical_crop)
+                    image_data = mm3.fix_orientation(image_data)
+
+                    image_name = file_prefix + "_t%04dxy%02d.tif" % (t, fov)
+                    analyzed_imgs[image_name] = {'filepath': nd2_file,
+                                                 'fov': fov,
+                                                 't': t,
+                                                 'jd': acq_time,
+                                                 'x': x_um,
+                                                 'y': y_um,
+                                                 'planes': planes,
+                                                 'shape': [image_data.shape[0], image_data.shape[1]],
+                                                 'channels': mm3.find_channel_locs(image_data)}
+                    frame_sources[image_name] = (nd2_file, t_id, fov_id)
+
+                mm3.information('Found channels for FOV %d.' % fov)
+
+    if len(analyzed_imgs) == 0:
+        mm3.warning('No images found in the nd2 files.')
+        return
+
+    # save the metadata and time table the way mm3_Compile.py would
+    channel_masks = mm3.make_masks(analyzed_imgs)
+    mm3.update_tif_metadata_index(analyzed_imgs)
+    p['use_jd'] = True # the nd2 metadata has the acquisition times
+    mm3.make_time_table(analyzed_imgs)
+
+    # second pass, slice all planes into the HDF5 files one FOV at a time
+    for fov in sorted(channel_masks.keys()):
+        image_names = sorted([image_name for image_name in analyzed_imgs
+                              if analyzed_imgs[image_name]['fov'] == fov],
+                             key=lambda image_name: analyzed_imgs[image_name]['jd'])
+
+        mm3.information('Writing %d images to HDF5 for FOV %d.' % (len(image_names), fov))
+        mm3.hdf5_slice_and_write_frames(image_names,
+                                        read_nd2_frames(image_names, frame_sources, vertical_crop),
+                                        channel_masks, analyzed_imgs)
+
+    return
+
+# save TIFFs handed over by extract_fov
+def write_tiffs(write_queue, tif_compress, write_errors):
+    '''Runs in a thread and saves (path, image data, description) items from the
+    queue until it gets None. Compression happens here, so the reading thread can
+    go on to the next frame. Errors are put in write_errors.'''
+
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        if write_errors:
+            continue # drain the queue after a failure
+
+        tif_path, image_data, metadata_json = item
+        try:
+            mm3.information('Saving %s.' % os.path.basename(tif_path))
+            tiff.imsave(tif_path, image_data, description=metadata_json, compress=tif_compress, photometric='minisblack')
+        except Exception as e:
+            write_errors.append(e)
+
+# export all time points of one FOV to TIFFs
+def extract_fov(nd2_file, fov_id, vertical_crop, number_of_rows, tif_compress):
+    '''Writes the TIFFs for one FOV of an nd2 file. This is run by a pool, one
+    FOV per worker, so each worker opens its own reader. Frames are read in this
+    thread and passed to a writer thread through a short queue.
+
+    Returns the number of TIFFs written.
+    '''
+
+    file_prefix = os.path.split(os.path.splitext(nd2_file)[0])[1]
+    # fov_id is the fov index according to elements, fov is the output fov ID
+    fov = fov_id + 1
+
+    write_queue = queue.Queue(maxsize=4)
+    write_errors = []
+    writer = threading.Thread(target=write_tiffs, args=(write_queue, tif_compress, write_errors))
+    writer.start()
+
+    tif_count = 0
+    try:
+        # load the nd2. the nd2f file object has lots of information thanks to pims
+        with pims_nd2.ND2_Reader(nd2_file) as nd2f:
+            starttime = get_nd2_start_time(nd2f)
+            planes = get_nd2_planes(nd2f)
+
+            # this insures all colors will be saved when saving tiff
+            if len(planes) > 1:
+                nd2f.bundle_axes = [u'c', u'y', u'x']
+
+            # set the FOV we are working on in the nd2 file object
+            nd2f.default_coords[u'm'] = fov_id
+
+            # loop through time points
+            for t in get_extraction_range(nd2f):
+                if write_errors:
+                    break
+
+                # timepoint output name (1 indexed rather than 0 indexed)
+                t_id = t - 1
+                frame = nd2f[t_id]
+
+                # get the time and stage position of the picture
+                acq_time, x_um, y_um = get_nd2_frame_metadata(frame, starttime)
+
+                # make dictionary which will be the metdata for this TIFF
+                metadata_t = { 'fov': fov,
+                               't' : t,
+                               'jd': acq_time,
+                               'x': x_um,
+                               'y': y_um,
+                               'planes': planes}
+                metadata_json = json.dumps(metadata_t)
+
+                # get the pixel information. copy it as it is saved by the other thread
+                image_data = np.array(frame)
+
+                # crop tiff if specified. Lots of flags for if there are double rows or  multiple colors
+                if vertical_crop:
+                    # add extra axis to make below slicing simpler.
+                    if len(image_data.shape) < 3:
+                        image_data = np.expand_dims(image_data, axis=0)
+
+                    # for just a simple crop
+                    if number_of_rows == 1:
+                        image_data = crop_nd2_image(image_data, vertical_crop)
+                        tif_filename = file_prefix + "_t%04dxy%02d.tif" % (t, fov)
+                        write_queue.put((os.path.join(p['TIFF_dir'], tif_filename), image_data, metadata_json))
+                        tif_count += 1
+
+                    # for dealing with two rows of channel
+                    elif number_of_rows == 2:
+                        # cut top row
+                        image_data_one = image_data[:,vertical_crop[0][0]:vertical_crop[0][1],:]
+                        tif_filename = file_prefix + "_t%04dxy%02d_1.tif" % (t, fov)
+                        write_queue.put((os.path.join(p['TIFF_dir'], tif_filename), image_data_one, metadata_json))
+
+                        # cut bottom row
+                        image_data_two = image_data[:,vertical_crop[1][0]:vertical_crop[1][1],:]
+                        tif_filename = file_prefix + "_t%04dxy%02d_2.tif" % (t, fov)
+                        write_queue.put((os.path.join(p['TIFF_dir'], tif_filename), image_data_two, metadata_json))
+                        tif_count += 2
+
+                else: # just save the image if no cropping was done.
+                    tif_filename = file_prefix + "_t%04dxy%02d.tif" % (t, fov)
+                    write_queue.put((os.path.join(p['TIFF_dir'], tif_filename), image_data, metadata_json))
+                    tif_count += 1
+
+    finally:
+        # let the writer finish what is queued
+        write_queue.put(None)
+        writer.join()
+
+    if write_errors:
+        raise write_errors[0]
+
+    return tif_count
+
 ### Main script
 if __name__ == "__main__":
     '''
     This script converts a Nikon Elements .nd2 file to individual TIFF files per time point. Multiple color planes are stacked in each time point to make a multipage TIFF.
+    With --hdf5 the channels are sliced straight into the HDF5 files instead, so mm3_Compile.py does not need to be run.
     '''
 
     # set switches and parameters
@@ -51,6 +358,10 @@ if __name__ == "__main__":
                         required=True, help='Yaml file containing parameters.')
     parser.add_argument('-o', '--fov',  type=str,
                         required=False, help='List of fields of view to analyze. Input "1", "1,2,3", or "1-3", etc.')
+    parser.add_argument('-j', '--nproc', type=int,
+                        required=False, help='Number of processors to use.')
+    parser.add_argument('--hdf5', action='store_true',
+                        required=False, help='Slice channels from the nd2 files straight into HDF5 files instead of exporting TIFFs.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -71,6 +382,11 @@ if __name__ == "__main__":
     else:
         user_spec_fovs = []
 
+    # number of processes for extracting FOVs in parallel
+    if namespace.nproc:
+        p['num_analyzers'] = namespace.nproc
+    mm3.information('Using {} threads for multiprocessing.'.format(p['num_analyzers']))
+
     # number of rows of channels. Used for cropping.
     number_of_rows = p['nd2ToTIFF']['number_of_rows']
 
@@ -90,10 +406,6 @@ if __name__ == "__main__":
     # number between 0 and 9, 0 is no compression, 9 is most compression.
     tif_compress = p['nd2ToTIFF']['tiff_compress']
 
-    # set up image and analysis folders if they do not already exist
-    if not os.path.exists(p['TIFF_dir']):
-        os.makedirs(p['TIFF_dir'])
-
     # Load ND2 files into a list for processing
     if p['nd2ToTIFF']['external_directory']:
         nd2files = glob.glob(os.path.join(p['nd2ToTIFF']['external_directory'], "*.nd2"))
@@ -103,125 +415,57 @@ if __name__ == "__main__":
         nd2files = glob.glob(os.path.join(p['experiment_directory'], "*.nd2"))
         mm3.information("Found %d files to analyze in experiment directory." % len(nd2files))
 
+    # go straight to the HDF5 files mm3_Compile.py would make
+    if namespace.hdf5:
+        if number_of_rows != 1:
+            mm3.warning('HDF5 export only supports one row of channels.')
+            sys.exit(1)
+
+        for directory in [p['ana_dir'], p['hdf5_dir']]:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        nd2_to_hdf5(nd2files, user_spec_fovs, vertical_crop)
+        sys.exit(0)
+
+    # set up image and analysis folders if they do not already exist
+    if not os.path.exists(p['TIFF_dir']):
+        os.makedirs(p['TIFF_dir'])
+
+    # each FOV is extracted by its own process with its own reader
+    pool = Pool(p['num_analyzers'])
+    extract_results = []
+    start_time = time.time()
+
     for nd2_file in nd2files:
         file_prefix = os.path.split(os.path.splitext(nd2_file)[0])[1]
         mm3.information('Extracting %s ...' % file_prefix)
 
-        # load the nd2. the nd2f file object has lots of information thanks to pims
         with pims_nd2.ND2_Reader(nd2_file) as nd2f:
-            try:
-                starttime = nd2f.metadata['time_start_jdn'] # starttime is jd
-                mm3.information('Starttime got from nd2 metadata.')
-            except ValueError:
-                # problem with the date
-                jdn = mm3.julian_day_number()
-                nd2f._lim_metadata_desc.dTimeStart = jdn
-                starttime = nd2f.metadata['time_start_jdn'] # starttime is jd
-                mm3.information('Starttime found from lim.')
-
-            # get the color names out. Kinda roundabout way.
-            planes = [nd2f.metadata[md]['name'] for md in nd2f.metadata if md[0:6] == u'plane_' and not md == u'plane_count']
+            fov_count = nd2f.sizes[u'm']
 
-            # this insures all colors will be saved when saving tiff
-            if len(planes) > 1:
-                nd2f.bundle_axes = [u'c', u'y', u'x']
+        for fov_id in range(0, fov_count): # for every FOV
+            # skip FOVs as specified above
+            if len(user_spec_fovs) > 0 and not (fov_id + 1 in user_spec_fovs):
+                continue
 
-            # extraction range is the time points that will be taken out. Note the indexing,
-            # it is zero indexed to grab from nd2, but TIFF naming starts at 1.
-            # if there is more than one FOV (len(nd2f) != 1), make sure the user input
-            # last time index is before the actual time index. Ignore it.
-            if (p['nd2ToTIFF']['image_start'] < 1):
-                p['nd2ToTIFF']['image_start'] = 1
-            if p['nd2ToTIFF']['image_end'] == 'None':
-                p['nd2ToTIFF']['image_end'] = False
-            if p['nd2ToTIFF']['image_end']:
-                if len(nd2f) > 1 and len(nd2f) < p['nd2ToTIFF']['image_end']:
-                    p['nd2ToTIFF']['image_end'] = len(nd2f)
-            else:
-                p['nd2ToTIFF']['image_end'] = len(nd2f)
-            extraction_range = range(p['nd2ToTIFF']['image_start'],
-                                     p['nd2ToTIFF']['image_end']+1)
+            extract_results.append((file_prefix, fov_id + 1,
+                                    pool.apply_async(extract_fov,
+                                        args=(nd2_file, fov_id, vertical_crop,
+                                              number_of_rows, tif_compress))))
 
-            # loop through time points
-            for t in extraction_range:
-                # timepoint output name (1 indexed rather than 0 indexed)
-                t_id = t - 1
-                # set counter for FOV output name
-                #fov = fov_naming_start
-
-                for fov_id in range(0, nd2f.sizes[u'm']): # for every FOV
-                    # fov_id is the fov index according to elements, fov is the output fov ID
-                    fov = fov_id + 1
-
-                    # skip FOVs as specified above
-                    if len(user_spec_fovs) > 0 and not (fov in user_spec_fovs):
-                        continue
-
-                    # set the FOV we are working on in the nd2 file object
-                    nd2f.default_coords[u'm'] = fov_id
-
-                    # get time picture was taken
-                    seconds = copy.deepcopy(nd2f[t_id].metadata['t_ms']) / 1000.
-                    minutes = seconds / 60.
-                    hours = minutes / 60.
-                    days = hours / 24.
-                    acq_time = starttime + days
-
-                    # get physical location FOV on stage
-                    x_um = nd2f[t_id].metadata['x_um']
-                    y_um = nd2f[t_id].metadata['y_um']
-
-                    # make dictionary which will be the metdata for this TIFF
-                    metadata_t = { 'fov': fov,
-                                   't' : t,
-                                   'jd': acq_time,
-                                   'x': x_um,
-                                   'y': y_um,
-                                   'planes': planes}
-                    metadata_json = json.dumps(metadata_t)
-
-                    # get the pixel information
-                    image_data = nd2f[t_id]
-
-                    # crop tiff if specified. Lots of flags for if there are double rows or  multiple colors
-                    if vertical_crop:
-                        # add extra axis to make below slicing simpler.
-                        if len(image_data.shape) < 3:
-                            image_data = np.expand_dims(image_data, axis=0)
-
-                        # for just a simple crop
-                        if number_of_rows == 1:
-
-                            nc, H, W = image_data.shape
-                            ylo = int(vertical_crop[0]*H)
-                            yhi = int(vertical_crop[1]*H)
-                            image_data = image_data[:, ylo:yhi, :]
-
-                            # save the tiff
-                            tif_filename = file_prefix + "_t%04dxy%02d.tif" % (t, fov)
-                            mm3.information('Saving %s.' % tif_filename)
-                            tiff.imsave(os.path.join(p['TIFF_dir'], tif_filename), image_data, description=metadata_json, compress=tif_compress, photometric='minisblack')
-
-                        # for dealing with two rows of channel
-                        elif number_of_rows == 2:
-                            # cut and save top row
-                            image_data_one = image_data[:,vertical_crop[0][0]:vertical_crop[0][1],:]
-                            tif_filename = file_prefix + "_t%04dxy%02d_1.tif" % (t, fov)
-                            mm3.information('Saving %s.' % tif_filename)
-                            tiff.imsave(os.path.join(p['TIFF_dir'], tif_filename), image_data_one, description=metadata_json, compress=tif_compress, photometric='minisblack')
-
-                            # cut and save bottom row
-                            metadata_t['fov'] = fov # update metdata
-                            metadata_json = json.dumps(metadata_t)
-                            image_data_two = image_data[:,vertical_crop[1][0]:vertical_crop[1][1],:]
-                            tif_filename = file_prefix + "_t%04dxy%02d_2.tif" % (t, fov)
-                            mm3.information('Saving %s.' % tif_filename)
-                            tiff.imsave(os.path.join(p['TIFF_dir'], tif_filename), image_data_two, description=metadata_json, compress=tif_compress, photometric='minisblack')
-
-                    else: # just save the image if no cropping was done.
-                        tif_filename = file_prefix + "_t%04dxy%02d.tif" % (t, fov)
-                        mm3.information('Saving %s.' % tif_filename)
-                        tiff.imsave(os.path.join(p['TIFF_dir'], tif_filename), image_data, description=metadata_json, compress=tif_compress, photometric='minisblack')
+    pool.close() # tells the process nothing more will be added.
+    pool.join() # blocks script until everything has been processed and workers exit
 
-                    # increase FOV counter
-                    fov += 1
+    tif_count = 0
+    for file_prefix, fov, result in extract_results:
+        try:
+            tif_count += result.get()
+        except Exception as e:
+            # errors of the writer thread are raised by extract_fov too
+            mm3.warning('Failed to extract FOV %d of %s.' % (fov, file_prefix))
+            mm3.warning(e)
+
+    elapsed = time.time() - start_time
+    mm3.information('Wrote %d TIFFs in %.1f s (%.1f files/s).'
+                    % (tif_count, elapsed, tif_count / max(elapsed, 1e-9)))
@@ -88,7 +88,7 @@ def fov_plot_channels(fov_id, crosscorrs, specs, outputdir='.', phase_plane='c1'
             peak_xc = crosscorrs[fov_id][peak_id] # get cross corr data from dict
 
         # load data for figure
-        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane)
+        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane, frames=[0, -1])
 
         first_img = rescale_intensity(image_data[0,:,:]) # phase image at t=0
         last_img = rescale_intensity(image_data[-1,:,:]) # phase image at end
@@ -188,7 +188,7 @@ def fov_CNN_plot_channels(fov_id, predictionDict, specs, outputdir='.', phase_pl
             predictions = predictionDict[fov_id][peak_id] # get predictions array
 
         # load data for figure
-        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane)
+        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane, frames=[0, -1])
 
         first_img = rescale_intensity(image_data[0,:,:]) # phase image at t=0
         last_img = rescale_intensity(image_data[-1,:,:]) # phase image at end
@@ -287,7 +287,7 @@ def fov_cell_segger_plot_channels(fov_id, predictionDict, specs, outputdir='.',
             predictions = predictionDict[fov_id][peak_id] # get predictions array
 
         # load data for figure
-        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane)
+        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane, frames=[0, -1])
 
         first_img = rescale_intensity(image_data[0,:,:]) # phase image at t=0
         last_img = rescale_intensity(image_data[-1,:,:]) # phase image at end
@@ -800,14 +800,16 @@ def preload_images(specs, fov_id_list):
         mm3.information("Preloading images for FOV {}.".format(fov_id))
         UI_images[fov_id] = {}
         for peak_id in specs[fov_id].keys():
-            image_data = mm3.load_stack(fov_id, peak_id, color=p['phase_plane'])
-            UI_images[fov_id][peak_id] = {'first' : None, 'last' : None} # init dictionary
-             # phase image at t=0. Rescale intenstiy and also cut the size in half
+            # only read the two images which are shown
             first_image = p['channel_picker']['first_image']
-            UI_images[fov_id][peak_id]['first'] = imresize(image_data[first_image,:,:], 0.5)
             last_image = p['channel_picker']['last_image']
+            image_data = mm3.load_stack(fov_id, peak_id, color=p['phase_plane'],
+                                        frames=[first_image, last_image])
+            UI_images[fov_id][peak_id] = {'first' : None, 'last' : None} # init dictionary
+             # phase image at t=0. Rescale intenstiy and also cut the size in half
+            UI_images[fov_id][peak_id]['first'] = imresize(image_data[0,:,:], 0.5)
             # phase image at end
-            UI_images[fov_id][peak_id]['last'] = imresize(image_data[last_image,:,:], 0.5)
+            UI_images[fov_id][peak_id]['last'] = imresize(image_data[1,:,:], 0.5)
 
     return UI_images
 
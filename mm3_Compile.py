@@ -62,6 +62,8 @@ if __name__ == "__main__":
                         required=False, help='Number of processors to use.')
     parser.add_argument('-m', '--modelfile', type=str,
                         required=False, help='Path to trained U-net model.')
+    parser.add_argument('-a', '--append', action='store_true',
+                        required=False, help='Only process images added since the last run and append them to the existing HDF5 files.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -111,6 +113,19 @@ if __name__ == "__main__":
     elif p['output'] == 'HDF5':
         if not os.path.exists(p['hdf5_dir']):
             os.makedirs(p['hdf5_dir'])
+    elif p['output'] == 'zarr':
+        if not os.path.exists(p['zarr_dir']):
+            os.makedirs(p['zarr_dir'])
+
+    # append mode adds new time points to a previous run, e.g. during acquisition
+    append = namespace.append
+    if append:
+        if p['compile']['find_channels_method'] != 'peaks':
+            mm3.warning('Append mode is only supported with find_channels_method peaks.')
+            sys.exit(1)
+        if p['output'] != 'HDF5':
+            mm3.warning('%s stacks cannot be extended in place, they will be rewritten. Use HDF5 output for constant time appending.' % p['output'])
+        mm3.information('Appending new images to the previous run.')
 
     # declare information variables
     analyzed_imgs = {} # for storing get_params pool results.
@@ -118,9 +133,7 @@ if __name__ == "__main__":
     ### process TIFFs for metadata #################################################################
     if not p['compile']['do_metadata']:
         mm3.information("Loading image parameters dictionary.")
-
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.pkl'), 'rb') as tiff_metadata:
-            analyzed_imgs = pickle.load(tiff_metadata)
+        analyzed_imgs = mm3.load_tif_metadata()
 
     else:
         mm3.information("Finding image parameters.")
@@ -169,13 +182,20 @@ if __name__ == "__main__":
         else:
             mm3.warning('No TIFF files found')
 
+        # reuse the metadata of images which have not changed since they were indexed
+        file_stats = mm3.get_tif_file_stats(found_files)
+        analyzed_imgs = mm3.load_tif_metadata_index(file_stats=file_stats)
+        files_to_analyze = [ifile for ifile in found_files if ifile not in analyzed_imgs]
+        mm3.information("%d images are in the metadata index, analyzing %d."
+                        % (len(analyzed_imgs), len(files_to_analyze)))
+
         if p['compile']['find_channels_method'] == 'peaks':
 
             # initialize pool for analyzing image metadata
             pool = Pool(p['num_analyzers'])
 
             # loop over images and get information
-            for fn in found_files:
+            for fn in files_to_analyze:
                 # get_params gets the image metadata and puts it in analyzed_imgs dictionary
                 # for each file name. True means look for channels
 
@@ -193,7 +213,7 @@ if __name__ == "__main__":
             mm3.information('Image analysis pool finished, getting results.')
 
             # get results from the pool and put them in a dictionary
-            for fn in analyzed_imgs.keys():
+            for fn in files_to_analyze:
                 result = analyzed_imgs[fn]
                 if result.successful():
                     analyzed_imgs[fn] = result.get() # put the metadata in the dict if it's good
@@ -221,7 +241,7 @@ if __name__ == "__main__":
             pool = Pool(p['num_analyzers'])
 
             # loop over images and get information
-            for fn in found_files:
+            for fn in files_to_analyze:
                 # get_params gets the image metadata and puts it in analyzed_imgs dictionary
                 # for each file name. Won't look for channels, just gets the metadata for later use by Unet
 
@@ -238,7 +258,7 @@ if __name__ == "__main__":
             mm3.information('Image metadata pool finished, getting results.')
 
             # get results from the pool and put them in a dictionary
-            for fn in analyzed_imgs.keys():
+            for fn in files_to_analyze:
                result = analyzed_imgs[fn]
                if result.successful():
                    analyzed_imgs[fn] = result.get() # put the metadata in the dict if it's good
@@ -251,13 +271,38 @@ if __name__ == "__main__":
             file_names = [key for key in analyzed_imgs.keys()]
             file_names.sort() # sort the file names by time
             file_names = np.asarray(file_names)
-            fov_ids = [analyzed_imgs[key]['fov'] for key in analyzed_imgs.keys()]
+            fov_ids = np.asarray([analyzed_imgs[key]['fov'] for key in file_names])
 
             unique_fov_ids = np.unique(fov_ids)
 
             if p['compile']['do_channel_masks']:
                 channel_masks = {}
 
+            def get_trap_align_metadata(fov_file_names):
+                return {'first_frame_name': fov_file_names[0],
+                        'frame_count': len(fov_file_names),
+                        'plane_number': len(analyzed_imgs[fov_file_names[0]]['planes']),
+                        'trap_height': p['compile']['trap_crop_height'],
+                        'trap_width': p['compile']['trap_crop_width'],
+                        'phase_plane': p['phase_plane'],
+                        'phase_plane_index': p['moviemaker']['phase_plane_index'],
+                        'shift_distance': 256,
+                        'full_frame_size': 2048}
+
+            # alignment by phase correlation only needs the model for the first frame.
+            # Find the drift of all FOVs in a pool while the model runs on the first frames.
+            alignment_method = p['compile'].get('alignment_method', 'unet')
+            if alignment_method == 'phase_correlation':
+                mm3.information('Finding drift by phase correlation.')
+                drift_pool = Pool(p['num_analyzers'])
+                fov_drifts = {}
+                for fov_id in unique_fov_ids:
+                    fov_file_names = [file_names[idx] for idx in np.where(fov_ids == fov_id)[0]]
+                    fov_drifts[fov_id] = drift_pool.apply_async(mm3.get_fov_drift,
+                                            args=(fov_id, fov_file_names,
+                                                  get_trap_align_metadata(fov_file_names)))
+                drift_pool.close()
+
             for fov_id in unique_fov_ids:
 
                 mm3.information('Performing trap segmentation for fov_id: {}'.format(fov_id))
@@ -266,15 +311,7 @@ if __name__ == "__main__":
                 fov_indices = np.where(fov_ids == fov_id)[0]
                 # print(fov_indices)
                 fov_file_names = [file_names[idx] for idx in fov_indices]
-                trap_align_metadata = {'first_frame_name': fov_file_names[0],
-                                    'frame_count': len(fov_file_names),
-                                    'plane_number': len(analyzed_imgs[fn]['planes']),
-                                    'trap_height': p['compile']['trap_crop_height'],
-                                    'trap_width': p['compile']['trap_crop_width'],
-                                    'phase_plane': p['phase_plane'],
-                                    'phase_plane_index': p['moviemaker']['phase_plane_index'],
-                                    'shift_distance': 256,
-                                    'full_frame_size': 2048}
+                trap_align_metadata = get_trap_align_metadata(fov_file_names)
 
                 dilator = np.ones((1,300))
 
@@ -386,150 +423,154 @@ if __name__ == "__main__":
                 if p['debug']:
                     print(centroid)
 
-                # get the (frame_number,512,512,1)-sized stack for image aligment
-                align_region_stack = np.zeros((trap_align_metadata['frame_count'],512,512,1), dtype='uint16')
-
-                for frame,fn in enumerate(fov_file_names):
-                    imgPath = os.path.join(p['experiment_directory'],p['image_directory'],fn)
-                    frame_img = io.imread(imgPath)
-                    # detect if there are multiple imaging channels, and rearrange image if necessary, keeping only the phase image
-                    frame_img = mm3.permute_image(frame_img, trap_align_metadata)
-                    align_region_stack[frame,:,:,0] = frame_img[centroid[0]-256:centroid[0]+256,
-                                                             centroid[1]-256:centroid[1]+256]
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_region_stack[pltIdx*10,:,:,0])
-
-                #     plt.title('Alignment stack images');
-                #     plt.show();
-
-                # run model on all frames
-                batch_size=p['compile']['channel_prediction_batch_size']
-                mm3.information("Predicting trap regions for (512,512) slice through all frames.")
-
-                data_gen_args = {'batch_size':batch_size,
-                         'n_channels':1,
-                         'normalize_to_one':True,
-                         'shuffle':False}
-                predict_gen_args = {'verbose':1,
-                        'use_multiprocessing':True,
-                        'workers':p['num_analyzers']}
-
-                img_generator = mm3.TrapSegmentationDataGenerator(align_region_stack, **data_gen_args)
-
-                align_region_predictions = model.predict_generator(img_generator, **predict_gen_args)
-                #align_region_stack = mm3.apply_median_filter_and_normalize(align_region_stack)
-                #align_region_predictions = model.predict(align_region_stack, batch_size=batch_size)
-                # reduce dimensionality such that the class predictions are now (frame_number,512,512), and each voxel is labelled as the predicted region, i.e., 0=trap, 1=central trough, 2=background.
-                align_region_class_predictions = np.argmax(align_region_predictions, axis=3)
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_region_class_predictions[pltIdx*10,:,:])
-
-                #     plt.title('Alignment stack predictions');
-                #     plt.show();
-
-                # get boolean array where trap predictions are True
-                align_traps = align_region_class_predictions == 0
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_traps[pltIdx*10,:,:])
-
-                #     plt.title('Alignment trap masks');
-                #     plt.show();
-
-                # allocate array to store filtered traps over time
-                align_trap_mask_stack = np.zeros(align_traps.shape)
-                for frame in range(trap_align_metadata['frame_count']):
-
-                    frame_trap_labels = measure.label(align_traps[frame,:,:])
-                    frame_trap_props = measure.regionprops(frame_trap_labels)
-
-                    trap_bboxes = mm3.get_frame_trap_bounding_boxes(frame_trap_labels,
-                                                                    frame_trap_props,
-                                                                    trapAreaThreshold=trap_area_threshold,
-                                                                    trapWidth=trap_align_metadata['trap_width'],
-                                                                    trapHeight=trap_align_metadata['trap_height'])
+                if alignment_method == 'phase_correlation':
+                    integer_shifts = fov_drifts[fov_id].get()
 
-                    for i,bbox in enumerate(trap_bboxes):
-                        align_trap_mask_stack[frame,bbox[0]:bbox[2],bbox[1]:bbox[3]] = True
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_trap_mask_stack[pltIdx*10,:,:])
-
-                #     plt.title('Filtered alignment trap masks');
-                #     plt.show();
-
-                labelled_align_trap_mask_stack = measure.label(align_trap_mask_stack)
+                else:
+                    # get the (frame_number,512,512,1)-sized stack for image aligment
+                    align_region_stack = np.zeros((trap_align_metadata['frame_count'],512,512,1), dtype='uint16')
+
+                    for frame,fn in enumerate(fov_file_names):
+                        imgPath = os.path.join(p['experiment_directory'],p['image_directory'],fn)
+                        frame_img = io.imread(imgPath)
+                        # detect if there are multiple imaging channels, and rearrange image if necessary, keeping only the phase image
+                        frame_img = mm3.permute_image(frame_img, trap_align_metadata)
+                        align_region_stack[frame,:,:,0] = frame_img[centroid[0]-256:centroid[0]+256,
+                                                                 centroid[1]-256:centroid[1]+256]
 
-                trapTriggered = False
-                for frame in range(trap_align_metadata['frame_count']):
-                    anyTraps = np.any(labelled_align_trap_mask_stack[frame,:,:] > 0)
-                    # if anyTraps is False, that means no traps were detected for this frame. This usuall occurs due to a bug in our imaging system,
-                    #    which can cause it to miss the occasional frame. Should be fine to snag labels from prior frame.
-                    if not anyTraps:
-                        trapTriggered = True
-                        mm3.information("Frame at index {} has no detected traps. Borrowing labels from an adjacent frame.".format(frame))
-                        if frame > 0:
-                            labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame-1,:,:]
+                    # if p['debug']:
+                    #     colNum = 10
+                    #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
+
+                    #     for pltIdx in range(colNum):
+                    #         ax[pltIdx].imshow(align_region_stack[pltIdx*10,:,:,0])
+
+                    #     plt.title('Alignment stack images');
+                    #     plt.show();
+
+                    # run model on all frames
+                    batch_size=p['compile']['channel_prediction_batch_size']
+                    mm3.information("Predicting trap regions for (512,512) slice through all frames.")
+
+                    data_gen_args = {'batch_size':batch_size,
+                             'n_channels':1,
+                             'normalize_to_one':True,
+                             'shuffle':False}
+                    predict_gen_args = {'verbose':1,
+                            'use_multiprocessing':True,
+                            'workers':p['num_analyzers']}
+
+                    img_generator = mm3.TrapSegmentationDataGenerator(align_region_stack, **data_gen_args)
+
+                    align_region_predictions = model.predict_generator(img_generator, **predict_gen_args)
+                    #align_region_stack = mm3.apply_median_filter_and_normalize(align_region_stack)
+                    #align_region_predictions = model.predict(align_region_stack, batch_size=batch_size)
+                    # reduce dimensionality such that the class predictions are now (frame_number,512,512), and each voxel is labelled as the predicted region, i.e., 0=trap, 1=central trough, 2=background.
+                    align_region_class_predictions = np.argmax(align_region_predictions, axis=3)
+
+                    # if p['debug']:
+                    #     colNum = 10
+                    #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
+
+                    #     for pltIdx in range(colNum):
+                    #         ax[pltIdx].imshow(align_region_class_predictions[pltIdx*10,:,:])
+
+                    #     plt.title('Alignment stack predictions');
+                    #     plt.show();
+
+                    # get boolean array where trap predictions are True
+                    align_traps = align_region_class_predictions == 0
+
+                    # if p['debug']:
+                    #     colNum = 10
+                    #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
+
+                    #     for pltIdx in range(colNum):
+                    #         ax[pltIdx].imshow(align_traps[pltIdx*10,:,:])
+
+                    #     plt.title('Alignment trap masks');
+                    #     plt.show();
+
+                    # allocate array to store filtered traps over time
+                    align_trap_mask_stack = np.zeros(align_traps.shape)
+                    for frame in range(trap_align_metadata['frame_count']):
+
+                        frame_trap_labels = measure.label(align_traps[frame,:,:])
+                        frame_trap_props = measure.regionprops(frame_trap_labels)
+
+                        trap_bboxes = mm3.get_frame_trap_bounding_boxes(frame_trap_labels,
+                                                                        frame_trap_props,
+                                                                        trapAreaThreshold=trap_area_threshold,
+                                                                        trapWidth=trap_align_metadata['trap_width'],
+                                                                        trapHeight=trap_align_metadata['trap_height'])
+
+                        for i,bbox in enumerate(trap_bboxes):
+                            align_trap_mask_stack[frame,bbox[0]:bbox[2],bbox[1]:bbox[3]] = True
+
+                    # if p['debug']:
+                    #     colNum = 10
+                    #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
+
+                    #     for pltIdx in range(colNum):
+                    #         ax[pltIdx].imshow(align_trap_mask_stack[pltIdx*10,:,:])
+
+                    #     plt.title('Filtered alignment trap masks');
+                    #     plt.show();
+
+                    labelled_align_trap_mask_stack = measure.label(align_trap_mask_stack)
+
+                    trapTriggered = False
+                    for frame in range(trap_align_metadata['frame_count']):
+                        anyTraps = np.any(labelled_align_trap_mask_stack[frame,:,:] > 0)
+                        # if anyTraps is False, that means no traps were detected for this frame. This usuall occurs due to a bug in our imaging system,
+                        #    which can cause it to miss the occasional frame. Should be fine to snag labels from prior frame.
+                        if not anyTraps:
+                            trapTriggered = True
+                            mm3.information("Frame at index {} has no detected traps. Borrowing labels from an adjacent frame.".format(frame))
+                            if frame > 0:
+                                labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame-1,:,:]
+                            else:
+                                labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame+1,:,:]
+
+                    if trapTriggered:
+                        repaired_align_trap_mask_stack = labelled_align_trap_mask_stack > 0
+                        labelled_align_trap_mask_stack = measure.label(repaired_align_trap_mask_stack)
+
+                    align_trap_props = measure.regionprops(labelled_align_trap_mask_stack)
+
+                    areas = np.array([trap.area for trap in align_trap_props])
+                    labels = [trap.label for trap in align_trap_props]
+                    good_align_trap_props = []
+                    bad_align_trap_props = []
+                    #mode_area = stats.mode(areas)[0]
+                    expected_area = trap_align_metadata['trap_width'] * trap_align_metadata['trap_height'] * trap_align_metadata['frame_count']
+
+                    if p['debug']:
+                        pprint(areas)
+                        print(expected_area)
+
+                        if not expected_area in areas:
+                            print("No trap has expected total area. Saving labelled masks for debugging as labelled_align_trap_mask_stack.tif")
+                            io.imsave("labelled_align_trap_mask_stack.tif", labelled_align_trap_mask_stack.astype('uint8'))
+                            io.imsave("masks.tif", align_traps.astype('uint8'))
+                            # occasionally our microscope misses an image, resulting in no traps for a single frame. This obviously messes up image alignment here....
+
+                    for trap in align_trap_props:
+                        if trap.area != expected_area:
+                            bad_align_trap_props.append(trap.label)
                         else:
-                            labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame+1,:,:]
-
-                if trapTriggered:
-                    repaired_align_trap_mask_stack = labelled_align_trap_mask_stack > 0
-                    labelled_align_trap_mask_stack = measure.label(repaired_align_trap_mask_stack)
-
-                align_trap_props = measure.regionprops(labelled_align_trap_mask_stack)
-
-                areas = np.array([trap.area for trap in align_trap_props])
-                labels = [trap.label for trap in align_trap_props]
-                good_align_trap_props = []
-                bad_align_trap_props = []
-                #mode_area = stats.mode(areas)[0]
-                expected_area = trap_align_metadata['trap_width'] * trap_align_metadata['trap_height'] * trap_align_metadata['frame_count']
-
-                if p['debug']:
-                    pprint(areas)
-                    print(expected_area)
-
-                    if not expected_area in areas:
-                        print("No trap has expected total area. Saving labelled masks for debugging as labelled_align_trap_mask_stack.tif")
-                        io.imsave("labelled_align_trap_mask_stack.tif", labelled_align_trap_mask_stack.astype('uint8'))
-                        io.imsave("masks.tif", align_traps.astype('uint8'))
-                        # occasionally our microscope misses an image, resulting in no traps for a single frame. This obviously messes up image alignment here....
-
-                for trap in align_trap_props:
-                    if trap.area != expected_area:
-                        bad_align_trap_props.append(trap.label)
-                    else:
-                        good_align_trap_props.append(trap)
+                            good_align_trap_props.append(trap)
 
-                for label in bad_align_trap_props:
-                    labelled_align_trap_mask_stack[labelled_align_trap_mask_stack == label] = 0
+                    for label in bad_align_trap_props:
+                        labelled_align_trap_mask_stack[labelled_align_trap_mask_stack == label] = 0
 
-                align_centroids = []
-                for frame in range(trap_align_metadata['frame_count']):
-                    align_centroids.append([reg.centroid for reg in measure.regionprops(labelled_align_trap_mask_stack[frame,:,:])])
+                    align_centroids = []
+                    for frame in range(trap_align_metadata['frame_count']):
+                        align_centroids.append([reg.centroid for reg in measure.regionprops(labelled_align_trap_mask_stack[frame,:,:])])
 
-                align_centroids = np.asarray(align_centroids)
-                shifts = np.mean(align_centroids - align_centroids[0,:,:], axis=1)
-                integer_shifts = np.round(shifts).astype('int16')
+                    align_centroids = np.asarray(align_centroids)
+                    shifts = np.mean(align_centroids - align_centroids[0,:,:], axis=1)
+                    integer_shifts = np.round(shifts).astype('int16')
 
                 good_trap_bboxes_dict = {}
                 for trap in good_trap_props:
@@ -561,12 +602,19 @@ if __name__ == "__main__":
                         # Or write it to hdf5
                         mm3.save_hdf5(trap_images_fov_dict, fov_file_names, analyzed_imgs, fov_id, channel_masks)
 
-        # save metadata to a .pkl and a human readable txt file
+                    elif p['output'] == "zarr":
+                        mm3.save_zarr(trap_images_fov_dict, fov_file_names, analyzed_imgs, fov_id, channel_masks)
+
+            if alignment_method == 'phase_correlation':
+                drift_pool.join()
+
+        # save metadata to the index. Unet finds channels for all images again,
+        # otherwise only the newly analyzed images need to be written
         mm3.information('Saving metadata from analyzed images...')
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.pkl'), 'wb') as tiff_metadata:
-            pickle.dump(analyzed_imgs, tiff_metadata, protocol=pickle.HIGHEST_PROTOCOL)
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.txt'), 'w') as tiff_metadata:
-            pprint(analyzed_imgs, stream=tiff_metadata)
+        if p['compile']['find_channels_method'] == 'Unet':
+            mm3.update_tif_metadata_index(analyzed_imgs)
+        else:
+            mm3.update_tif_metadata_index({fn : analyzed_imgs[fn] for fn in files_to_analyze})
 
         mm3.information('Saved metadata from analyzed images.')
 
@@ -577,10 +625,11 @@ if __name__ == "__main__":
         time_table = mm3.make_time_table(analyzed_imgs)
 
     ### Make consensus channel masks and get other shared metadata #################################
-    if not p['compile']['do_channel_masks'] and p['compile']['do_slicing']:
+    # appended images must be sliced with the masks (and peak ids) of the previous run
+    if (not p['compile']['do_channel_masks'] or append) and p['compile']['do_slicing']:
         channel_masks = mm3.load_channel_masks()
 
-    elif p['compile']['do_channel_masks']:
+    elif p['compile']['do_channel_masks'] and not append:
 
         if p['compile']['find_channels_method'] == 'peaks':
             # only calculate channels masks from images before t_end in case it is specified
@@ -607,27 +656,65 @@ if __name__ == "__main__":
 
         if p['compile']['find_channels_method'] == 'peaks':
 
-            # do it by FOV. Not set up for multiprocessing
-            for fov, peaks in six.iteritems(channel_masks):
-
-                # skip fov if not in the group
-                if user_spec_fovs and fov not in user_spec_fovs:
-                    continue
-
-                mm3.information("Loading images for FOV %03d." % fov)
-
-                # get filenames just for this fov along with the julian date of acquistion
-                send_to_write = [[k, v['t']] for k, v in six.iteritems(analyzed_imgs) if v['fov'] == fov]
-
-                # sort the filenames by jdn
-                send_to_write = sorted(send_to_write, key=lambda time: time[1])
-
-                if p['output'] == 'TIFF':
-                    #This is for loading the whole raw tiff stack and then slicing through it
-                    mm3.tiff_stack_slice_and_write(send_to_write, channel_masks, analyzed_imgs)
-
-                elif p['output'] == 'HDF5':
-                    # Or write it to hdf5
-                    mm3.hdf5_stack_slice_and_write(send_to_write, channel_masks, analyzed_imgs)
+            # each FOV goes to its own file(s), so FOVs can be sliced in parallel
+            fovs_to_slice = [fov for fov in sorted(channel_masks.keys())
+                             if not user_spec_fovs or fov in user_spec_fovs]
+
+            # get filenames just for each fov along with the time point of acquistion
+            fov_images = {fov : [] for fov in fovs_to_slice}
+            for k, v in six.iteritems(analyzed_imgs):
+                if v['fov'] in fov_images:
+                    fov_images[v['fov']].append([k, v['t']])
+            fovs_to_slice = [fov for fov in fovs_to_slice if fov_images[fov]]
+
+            if fovs_to_slice:
+                # cap the number of workers so the frames they hold fit in memory
+                slicing_processes = mm3.get_slicing_processes(
+                                        analyzed_imgs[fov_images[fovs_to_slice[0]][0][0]],
+                                        len(fovs_to_slice))
+                mm3.information('Slicing %d FOVs with %d processes.' % (len(fovs_to_slice), slicing_processes))
+
+                slicing_start = time.time()
+                pool = Pool(slicing_processes)
+                slicing_results = {}
+
+                for fov in fovs_to_slice:
+                    # sort the filenames by time
+                    send_to_write = sorted(fov_images[fov], key=lambda time: time[1])
+
+                    # only send the metadata and masks of this fov to the worker
+                    fov_imgs = {k : analyzed_imgs[k] for k, t in send_to_write}
+                    fov_masks = {fov : channel_masks[fov]}
+
+                    # This is the non-parallelized version (useful for debug)
+                    # slicing_results[fov] = mm3.slice_and_write_fov(send_to_write, fov_masks, fov_imgs, append=append)
+
+                    slicing_results[fov] = pool.apply_async(mm3.slice_and_write_fov,
+                                                            args=(send_to_write, fov_masks, fov_imgs),
+                                                            kwds={'append': append})
+
+                pool.close() # tells the process nothing more will be added.
+                pool.join() # blocks script until everything has been processed and workers exit
+
+                # report throughput per fov
+                total_frames = 0
+                for fov in fovs_to_slice:
+                    result = slicing_results[fov]
+                    if result.successful():
+                        slice_info = result.get()
+                        total_frames += slice_info['frames']
+                        mm3.information('FOV %d: sliced %d frames in %.1f s (%.2f frames/s).' %
+                                        (fov, slice_info['frames'], slice_info['seconds'],
+                                         slice_info['frames'] / max(slice_info['seconds'], 1e-6)))
+                    else:
+                        mm3.warning('Slicing failed for FOV %d.' % fov)
+                        try:
+                            result.get()
+                        except Exception as e:
+                            mm3.warning(e)
+
+                slicing_seconds = time.time() - slicing_start
+                mm3.information('Sliced %d frames in %.1f s (%.2f frames/s).' %
+                                (total_frames, slicing_seconds, total_frames / max(slicing_seconds, 1e-6)))
 
             mm3.information("Channel slices saved.")
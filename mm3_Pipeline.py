@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+from __future__ import print_function, division
+import six
+
+# import modules
+import sys
+import os
+import time
+import inspect
+import argparse
+try:
+    import cPickle as pickle
+except:
+    import pickle
+from multiprocessing import Pool
+
+# user modules
+# realpath() will make your script run, even if you symlink it
+cmd_folder = os.path.realpath(os.path.abspath(
+                              os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+# This makes python look for modules in ./external_lib
+cmd_subfolder = os.path.realpath(os.path.abspath(
+                                 os.path.join(os.path.split(inspect.getfile(
+                                 inspect.currentframe()))[0], "external_lib")))
+if cmd_subfolder not in sys.path:
+    sys.path.insert(0, cmd_subfolder)
+
+import mm3_helpers as mm3
+
+# when using this script as a function and not as a library the following will execute
+if __name__ == "__main__":
+    '''mm3_Pipeline.py does what mm3_Subtract.py, mm3_Segment-Otsu.py and
+    mm3_Track-Standard.py do, one channel at a time and in memory. The subtracted
+    and segmented stacks are only written out if asked for with -s.
+    Segmentation is with Otsu, as the U-net is best run on whole FOVs on the GPU.
+    '''
+
+    # set switches and parameters
+    parser = argparse.ArgumentParser(prog='python mm3_Pipeline.py',
+                                     description='Subtract, segment and track channels in one pass.')
+    parser.add_argument('-f', '--paramfile',  type=str,
+                        required=True, help='Yaml file containing parameters.')
+    parser.add_argument('-o', '--fov',  type=str,
+                        required=False, help='List of fields of view to analyze. Input "1", "1,2,3", or "1-10", etc.')
+    parser.add_argument('-j', '--nproc',  type=int,
+                        required=False, help='Number of processors to use.')
+    parser.add_argument('-s', '--save', type=str, default='',
+                        required=False, help='Stacks to save as well, "sub", "seg" or "sub,seg". Default is none.')
+    namespace = parser.parse_args()
+
+    # Load the project parameters file
+    mm3.information('Loading experiment parameters.')
+    p = mm3.init_mm3_helpers(namespace.paramfile) # initialized the helper library
+
+    if namespace.fov:
+        if '-' in namespace.fov:
+            user_spec_fovs = range(int(namespace.fov.split("-")[0]),
+                                   int(namespace.fov.split("-")[1])+1)
+        else:
+            user_spec_fovs = [int(val) for val in namespace.fov.split(",")]
+    else:
+        user_spec_fovs = []
+
+    # number of threads for multiprocessing
+    if namespace.nproc:
+        p['num_analyzers'] = namespace.nproc
+    mm3.information('Using {} threads for multiprocessing.'.format(p['num_analyzers']))
+
+    save_outputs = [output.strip() for output in namespace.save.split(',') if output.strip()]
+    for output in save_outputs:
+        if output not in ('sub', 'seg'):
+            mm3.warning('Unknown output %s, choose from sub and seg.' % output)
+            sys.exit(1)
+    mm3.information('Saving stacks: %s.' % (', '.join(save_outputs) if save_outputs else 'none'))
+
+    # the segmented stacks are the same as from mm3_Segment-Otsu.py
+    p['seg_img'] = 'seg_otsu'
+    sub_plane = p['phase_plane']
+
+    # create folders if they don't exist
+    if p['output'] == 'TIFF':
+        if not os.path.exists(p['empty_dir']):
+            os.makedirs(p['empty_dir'])
+        if 'sub' in save_outputs and not os.path.exists(p['sub_dir']):
+            os.makedirs(p['sub_dir'])
+        if 'seg' in save_outputs and not os.path.exists(p['seg_dir']):
+            os.makedirs(p['seg_dir'])
+    if not os.path.exists(p['cell_dir']):
+        os.makedirs(p['cell_dir'])
+
+    # load specs file
+    specs = mm3.load_specs()
+
+    # make list of FOVs to process (keys of specs file)
+    fov_id_list = sorted([fov_id for fov_id in specs.keys()])
+
+    # remove fovs if the user specified so
+    if user_spec_fovs:
+        fov_id_list[:] = [fov for fov in fov_id_list if fov in user_spec_fovs]
+
+    mm3.information("Found %d FOVs to process." % len(fov_id_list))
+
+    # Load time table, which goes into params, before the workers are given params
+    mm3.load_time_table()
+
+    # one pool of workers for averaging the empties and processing the channels. It is
+    # made while no HDF5 file is open, so the workers do not inherit open files.
+    mm3.close_h5_files()
+    pool = Pool(processes=p['num_analyzers'], initializer=mm3.init_pool_worker, initargs=(p,))
+
+    ### Make average empty channels, same as mm3_Subtract.py ######################################
+    if not p['subtract']['do_empties']:
+        mm3.information("Loading precalculated empties.")
+
+    else:
+        mm3.information("Calculating averaged empties for channel {}.".format(sub_plane))
+
+        need_empty = [] # list holds fov_ids of fov's that did not have empties
+        for fov_id in fov_id_list:
+            with mm3.h5_session():
+                averaging_result = mm3.average_empties_stack(fov_id, specs,
+                                                             color=sub_plane, align=True, pool=pool)
+            if not averaging_result:
+                need_empty.append(fov_id)
+
+        # deal with those problem FOVs without empties
+        have_empty = list(set(fov_id_list).difference(set(need_empty))) # fovs with empties
+        for fov_id in need_empty:
+            from_fov = min(have_empty, key=lambda x: abs(x-fov_id)) # find closest FOV with an empty
+            copy_result = mm3.copy_empty_stack(from_fov, fov_id, color=sub_plane)
+
+    ### Subtract, segment and track each channel ##################################################
+    # the workers open the HDF5 files themselves
+    chnl_results = {}
+    for fov_id in fov_id_list:
+        ana_peak_ids = sorted([peak_id for peak_id, spec in six.iteritems(specs[fov_id]) if spec == 1])
+        chnl_results[fov_id] = [(peak_id, pool.apply_async(mm3.process_chnl_stack,
+                                                           args=(fov_id, peak_id),
+                                                           kwds={'save_outputs': save_outputs}))
+                                for peak_id in ana_peak_ids]
+    pool.close() # tells the process nothing more will be added.
+
+    # This dictionary holds information for all cells
+    Cells = {}
+
+    # collect the results an FOV at a time, while the workers carry on with the next
+    start_time = time.time()
+    total_chnls = 0
+    for fov_id in fov_id_list:
+        fov_results = []
+        for peak_id, result in chnl_results[fov_id]:
+            try:
+                fov_results.append(result.get())
+            except Exception as e:
+                mm3.warning('Processing failed for FOV %d, channel %d.' % (fov_id, peak_id))
+                mm3.warning(e)
+
+        for chnl_result in fov_results:
+            Cells.update(chnl_result['cells'])
+
+            # HDF5 stacks come back to be written here, once no worker has the file open
+            if 'sub' in chnl_result:
+                mm3.save_subtracted_stack(fov_id, chnl_result['peak'], chnl_result['sub'], color=sub_plane)
+            if 'seg' in chnl_result:
+                mm3.save_segmented_stack(fov_id, chnl_result['peak'], chnl_result['seg'])
+        mm3.close_h5_file(fov_id)
+
+        total_chnls += len(fov_results)
+        mm3.information('FOV %d: %d channels, %d cells so far, %.2f channels/s.'
+                        % (fov_id, len(fov_results), len(Cells),
+                           total_chnls / max(time.time() - start_time, 1e-6)))
+
+    pool.join() # blocks script until everything has been processed and workers exit
+    mm3.information("Finished lineage creation.")
+
+    ### Now prune and save the data, same as mm3_Track-Standard.py
+    mm3.information("Curating and saving cell data.")
+
+    # this returns only cells with a parent and daughters
+    Complete_Cells = mm3.find_complete_cells(Cells)
+
+    ### save the cell data. Use the script mm3_OutputData for additional outputs.
+    # All cell data (includes incomplete cells)
+    with open(p['cell_dir'] + '/all_cells.pkl', 'wb') as cell_file:
+        pickle.dump(Cells, cell_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Just the complete cells, those with mother and daugther
+    # This is a dictionary of cell objects.
+    with open(os.path.join(p['cell_dir'],'complete_cells.pkl'), 'wb') as cell_file:
+        pickle.dump(Complete_Cells, cell_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    mm3.information("Finished curating and saving cell data.")
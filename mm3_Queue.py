@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+from __future__ import print_function, division
+import six
+
+# import modules
+import sys
+import os
+import time
+import inspect
+import argparse
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+# user modules
+# realpath() will make your script run, even if you symlink it
+cmd_folder = os.path.realpath(os.path.abspath(
+                              os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+# This makes python look for modules in ./external_lib
+cmd_subfolder = os.path.realpath(os.path.abspath(
+                                 os.path.join(os.path.split(inspect.getfile(
+                                 inspect.currentframe()))[0], "external_lib")))
+if cmd_subfolder not in sys.path:
+    sys.path.insert(0, cmd_subfolder)
+
+import mm3_helpers as mm3
+
+# when using this script as a function and not as a library the following will execute
+if __name__ == "__main__":
+    '''mm3_Queue.py shares the work of a stage between machines which see the same
+    analysis folder, with a job queue kept in ana_dir/queue. For example
+
+    python mm3_Queue.py -f params.yaml submit -s empties
+    python mm3_Queue.py -f params.yaml work    (on each machine, as many as wanted)
+    python mm3_Queue.py -f params.yaml submit -s process
+    python mm3_Queue.py -f params.yaml work
+    python mm3_Queue.py -f params.yaml collect
+
+    Stages are empties, subtract, segment (Otsu), lineage (standard) and process
+    (subtract, segment and lineage in memory, see mm3_Pipeline.py). Submit a stage
+    once the one it needs is done; status shows how far along each stage is.
+    '''
+
+    # set switches and parameters
+    parser = argparse.ArgumentParser(prog='python mm3_Queue.py',
+                                     description='Share mm3 stages between machines with a job queue.')
+    parser.add_argument('command', type=str,
+                        choices=['submit', 'work', 'status', 'retry', 'collect'],
+                        help='What to do with the queue.')
+    parser.add_argument('-f', '--paramfile',  type=str,
+                        required=True, help='Yaml file containing parameters.')
+    parser.add_argument('-s', '--stage', type=str,
+                        required=False, help='Stages to submit, work on or retry, e.g. "process" or "subtract,segment". Default for work and retry is all.')
+    parser.add_argument('-o', '--fov',  type=str,
+                        required=False, help='List of fields of view to submit. Input "1", "1,2,3", or "1-10", etc.')
+    parser.add_argument('-n', '--number', type=int,
+                        required=False, help='Number of jobs this worker runs before it stops.')
+    parser.add_argument('-r', '--resubmit', action='store_true',
+                        required=False, help='Submit jobs again even if they are already in the queue.')
+    namespace = parser.parse_args()
+
+    # Load the project parameters file
+    mm3.information('Loading experiment parameters.')
+    p = mm3.init_mm3_helpers(namespace.paramfile) # initialized the helper library
+
+    if namespace.fov:
+        if '-' in namespace.fov:
+            user_spec_fovs = range(int(namespace.fov.split("-")[0]),
+                                   int(namespace.fov.split("-")[1])+1)
+        else:
+            user_spec_fovs = [int(val) for val in namespace.fov.split(",")]
+    else:
+        user_spec_fovs = []
+
+    stages = []
+    if namespace.stage:
+        stages = [stage.strip() for stage in namespace.stage.split(',')]
+        for stage in stages:
+            if stage not in mm3.queue_stages:
+                mm3.warning('Unknown stage %s, choose from %s.' % (stage, ', '.join(sorted(mm3.queue_stages))))
+                sys.exit(1)
+
+    # same settings as the stand alone scripts
+    p['seg_img'] = 'seg_otsu'
+    if 'seg_img' not in p['track'].keys():
+        p['track']['seg_img'] = 'seg_otsu'
+
+    if namespace.command == 'submit':
+        if not stages:
+            mm3.warning('Give the stage to submit with -s.')
+            sys.exit(1)
+
+        specs = mm3.load_specs()
+        fov_id_list = sorted([fov_id for fov_id in specs.keys()])
+        if user_spec_fovs:
+            fov_id_list[:] = [fov for fov in fov_id_list if fov in user_spec_fovs]
+
+        for stage in stages:
+            submitted = mm3.submit_queue_jobs(stage, fov_id_list, specs, resubmit=namespace.resubmit)
+            mm3.information('Submitted %d %s jobs for %d FOVs.' % (submitted, stage, len(fov_id_list)))
+
+    elif namespace.command == 'work':
+        # make the folders the stages write to
+        if p['output'] == 'TIFF':
+            for folder in (p['empty_dir'], p['sub_dir'], p['seg_dir']):
+                if not os.path.exists(folder):
+                    try:
+                        os.makedirs(folder)
+                    except OSError:
+                        pass # made by another worker in the meantime
+
+        # lineages need the time table
+        mm3.load_time_table()
+
+        mm3.information('Worker %s starting.' % mm3.get_queue_worker_id())
+        start_time = time.time()
+        worker_counts = mm3.work_queue(stages=stages, max_jobs=namespace.number)
+        mm3.information('Worker %s finished: %d jobs done, %d retried, %d failed, %d abandoned in %.1f s.'
+                        % (mm3.get_queue_worker_id(), worker_counts['done'],
+                           worker_counts['retried'], worker_counts['failed'],
+                           worker_counts['abandoned'], time.time() - start_time))
+
+    elif namespace.command == 'status':
+        queue_status = mm3.get_queue_status()
+        if not queue_status:
+            mm3.information('The queue is empty.')
+        for stage in sorted(queue_status.keys()):
+            mm3.information('%s: %s' % (stage, ', '.join(['%d %s' % (queue_status[stage][state], state)
+                                                         for state in mm3.queue_states])))
+
+    elif namespace.command == 'retry':
+        mm3.information('Put %d failed jobs back in the queue.' % mm3.retry_queue_jobs(stages))
+
+    elif namespace.command == 'collect':
+        # same outputs as mm3_Track-Standard.py
+        Cells = mm3.collect_queue_cells()
+        Complete_Cells = mm3.find_complete_cells(Cells)
+
+        with open(p['cell_dir'] + '/all_cells.pkl', 'wb') as cell_file:
+            pickle.dump(Cells, cell_file, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(p['cell_dir'],'complete_cells.pkl'), 'wb') as cell_file:
+            pickle.dump(Complete_Cells, cell_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        mm3.information('Saved %d cells, %d complete.' % (len(Cells), len(Complete_Cells)))
@@ -45,6 +45,8 @@ if __name__ == "__main__":
                         required=False, help='List of fields of view to analyze. Input "1", "1,2,3", or "1-10", etc.')
     parser.add_argument('-j', '--nproc',  type=int,
                         required=False, help='Number of processors to use.')
+    parser.add_argument('--force', action='store_true',
+                        required=False, help='Recompute outputs which are up to date with their inputs and parameters.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -70,6 +72,9 @@ if __name__ == "__main__":
         p['num_analyzers'] = namespace.nproc
     mm3.information('Using {} threads for multiprocessing.'.format(p['num_analyzers']))
 
+    # by default channels whose manifest is up to date are skipped
+    p['force_recompute'] = namespace.force
+
     # create segmenteation and cell data folder if they don't exist
     if not os.path.exists(p['seg_dir']) and p['output'] == 'TIFF':
         os.makedirs(p['seg_dir'])
@@ -102,8 +107,9 @@ if __name__ == "__main__":
                 ana_peak_ids.append(peak_id)
         ana_peak_ids = sorted(ana_peak_ids) # sort for repeatability
 
-        for peak_id in ana_peak_ids:
-            # send to segmentation
-            mm3.segment_chnl_stack(fov_id, peak_id)
+        with mm3.h5_session():
+            for peak_id in ana_peak_ids:
+                # send to segmentation
+                mm3.segment_chnl_stack(fov_id, peak_id)
 
     mm3.information("Finished segmentation.")
@@ -53,6 +53,8 @@ if __name__ == "__main__":
                         required=False, help='Number of processors to use.')
     parser.add_argument('-c', '--color', type=str,
                         required=False, help='Color plane to subtract. "c1", "c2", etc.')
+    parser.add_argument('--force', action='store_true',
+                        required=False, help='Recompute outputs which are up to date with their inputs and parameters.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -78,6 +80,9 @@ if __name__ == "__main__":
         p['num_analyzers'] = namespace.nproc
     mm3.information('Using {} threads for multiprocessing.'.format(p['num_analyzers']))
 
+    # by default channels whose manifest is up to date are skipped
+    p['force_recompute'] = namespace.force
+
     # which color channel with which to do subtraction
     if namespace.color:
         sub_plane = namespace.color
@@ -111,6 +116,9 @@ if __name__ == "__main__":
         align = False
         sub_method = 'fluor'
 
+    # one pool of workers for all FOVs, for both averaging and subtraction
+    pool = Pool(processes=p['num_analyzers'], initializer=mm3.init_pool_worker, initargs=(p,))
+
     ### Make average empty channels ###############################################################
     if not p['subtract']['do_empties']:
         mm3.information("Loading precalculated empties.")
@@ -122,8 +130,9 @@ if __name__ == "__main__":
         need_empty = [] # list holds fov_ids of fov's that did not have empties
         for fov_id in fov_id_list:
             # send to function which will create empty stack for each fov.
-            averaging_result = mm3.average_empties_stack(fov_id, specs,
-                                                         color=sub_plane, align=align)
+            with mm3.h5_session():
+                averaging_result = mm3.average_empties_stack(fov_id, specs,
+                                                             color=sub_plane, align=align, pool=pool)
             # add to list for FOVs that need to be given empties from other FOvs
             if not averaging_result:
                 need_empty.append(fov_id)
@@ -139,11 +148,15 @@ if __name__ == "__main__":
         mm3.information("Subtracting channels for channel {}.".format(sub_plane))
         for fov_id in fov_id_list:
             # send to function which will create empty stack for each fov.
-            subtraction_result = mm3.subtract_fov_stack(fov_id, specs,
-                                                        color=sub_plane, method=sub_method)
+            with mm3.h5_session():
+                subtraction_result = mm3.subtract_fov_stack(fov_id, specs,
+                                                            color=sub_plane, method=sub_method, pool=pool)
         mm3.information("Finished subtraction.")
 
     # Else just end, they only wanted to do empty averaging.
     else:
         mm3.information("Skipping subtraction.")
         pass
+
+    pool.close() # tells the process nothing more will be added.
+    pool.join() # blocks script until everything has been processed and workers exit
@@ -11,6 +11,12 @@ import datetime
 import inspect # get passed parameters
 import yaml # parameter importing
 import json # for importing tiff metadata
+import atexit # closing cached HDF5 files
+import contextlib # HDF5 sessions
+import hashlib # fingerprinting parameters of the metadata index
+import zlib # compressing zarr chunks
+import socket # naming job queue workers
+import threading # job queue heartbeats
 try:
     import cPickle as pickle # loading and saving python objects
 except:
@@ -22,10 +28,17 @@ from pprint import pprint # for human readable file output
 import traceback # for error messaging
 import warnings # error messaging
 import copy # not sure this is needed
+import shutil # removing directories
 import h5py # working with HDF5 files
+try:
+    import hdf5plugin # more HDF5 compression filters, see get_h5_compression
+except ImportError:
+    hdf5plugin = None
 import pandas as pd
 import networkx as nx
 import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor # reading images ahead
 
 # scipy and image analysis
 from scipy.signal import find_peaks_cwt # used in channel finding
@@ -101,6 +114,7 @@ def init_mm3_helpers(param_file_path):
     params['TIFF_dir'] = os.path.join(params['experiment_directory'], params['image_directory'])
     params['ana_dir'] = os.path.join(params['experiment_directory'], params['analysis_directory'])
     params['hdf5_dir'] = os.path.join(params['ana_dir'], 'hdf5')
+    params['zarr_dir'] = os.path.join(params['ana_dir'], 'zarr')
     params['chnl_dir'] = os.path.join(params['ana_dir'], 'channels')
     params['empty_dir'] = os.path.join(params['ana_dir'], 'empties')
     params['sub_dir'] = os.path.join(params['ana_dir'], 'subtracted')
@@ -111,6 +125,8 @@ def init_mm3_helpers(param_file_path):
     params['cell_dir'] = os.path.join(params['ana_dir'], 'cell_data')
     params['track_dir'] = os.path.join(params['ana_dir'], 'tracking')
     params['foci_track_dir'] = os.path.join(params['ana_dir'], 'tracking_foci')
+    params['queue_dir'] = os.path.join(params['ana_dir'], 'queue')
+    params['align_dir'] = os.path.join(params['ana_dir'], 'alignment')
 
     # use jd time in image metadata to make time table. Set to false if no jd time
     if params['TIFF_source'] == 'elements' or params['TIFF_source'] == 'nd2ToTIFF':
@@ -159,12 +175,312 @@ def get_time(filepath):
     else:
         return None
 
+# open HDF5 files of this process, keyed by (fov_id, mode). See get_h5_file.
+h5_files = {}
+h5_files_pid = os.getpid()
+h5_inherited_files = [] # handles from a parent process, kept so they are never closed here
+h5_session_depth = 0 # how many h5_session scopes this process is in
+
+# path of the HDF5 file of an FOV
+def get_h5_path(fov_id):
+    return os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id)
+
+# start afresh in a forked worker
+def check_h5_files_pid():
+    '''Handles inherited by a forked worker are dropped (but not closed, they
+    belong to the parent), and the worker is not in the parent's sessions.'''
+    global h5_files, h5_files_pid, h5_session_depth
+
+    if h5_files_pid != os.getpid():
+        h5_inherited_files.extend(h5_files.values())
+        h5_files = {}
+        h5_files_pid = os.getpid()
+        h5_session_depth = 0
+
+# keep HDF5 files open while in a scope
+@contextlib.contextmanager
+def h5_session():
+    '''Within a with h5_session(): block, HDF5 files opened by get_h5_file, load_stack
+    and the writers stay open, so many stacks are read and written with one open
+    of each file. All of them are closed when the outermost block is left.
+
+    Outside a session, files are closed after each read and after writers call
+    flush_h5_file, so a process never holds the lock of a file other processes may
+    want to write, and it always sees what they wrote. For the same reason, a
+    session should not span files another process writes in the meantime.
+
+    Used by the scripts around the work on each FOV.
+    '''
+    global h5_session_depth
+
+    check_h5_files_pid()
+    h5_session_depth += 1
+    try:
+        yield
+    finally:
+        h5_session_depth -= 1
+        if h5_session_depth == 0:
+            close_h5_files()
+
+# get an open HDF5 file for an FOV, opening it only when needed
+def get_h5_file(fov_id, mode='r'):
+    '''Returns the HDF5 file of an FOV from a cache of open files, so that reading
+    many stacks from the same FOV only opens and parses the file once.
+
+    Parameters
+    ----------
+    fov_id : int
+    mode : str
+        'r' to read, 'r+' to write, or 'w' to make a new file. A file open for
+        writing is also used for reading. HDF5 does not allow the same file to be
+        open read only and writable at once, so asking for 'r+' or 'w' closes the
+        cached handles of the FOV first. 'w' files are cached as 'r+'.
+
+    Writers should call flush_h5_file when they are done with a dataset, which
+    also closes the file outside an h5_session. Readers should use read_h5_file,
+    which does not leave the file open outside a session.
+    The cache belongs to one process, see check_h5_files_pid.
+    '''
+
+    check_h5_files_pid()
+
+    # a writable handle serves both reads and writes
+    h5f = h5_files.get((fov_id, 'r+'))
+    if h5f is None and mode == 'r':
+        h5f = h5_files.get((fov_id, 'r'))
+    if mode != 'w' and h5f is not None and h5f.id.valid:
+        return h5f
+
+    # reopening, so nothing stale is left in the cache
+    close_h5_file(fov_id)
+    if mode != 'r':
+        invalidate_stack_cache(fov_id)
+
+    if mode == 'w':
+        h5f = h5py.File(get_h5_path(fov_id), 'w', libver='earliest')
+        mode = 'r+'
+    else:
+        h5f = h5py.File(get_h5_path(fov_id), mode)
+    h5_files[(fov_id, mode)] = h5f
+
+    return h5f
+
+# the HDF5 file of an FOV for reading, only kept open in a session
+@contextlib.contextmanager
+def read_h5_file(fov_id):
+    '''Yields the open HDF5 file of an FOV. Inside an h5_session, or if this
+    process has the file open for writing, it is the cached file. Otherwise the
+    file is opened for the block and closed after it.'''
+
+    check_h5_files_pid()
+    h5f = h5_files.get((fov_id, 'r+')) or h5_files.get((fov_id, 'r'))
+    if h5_session_depth > 0 or (h5f is not None and h5f.id.valid):
+        yield get_h5_file(fov_id)
+    else:
+        with h5py.File(get_h5_path(fov_id), 'r') as h5f:
+            yield h5f
+
+# write out pending changes to the HDF5 file of an FOV
+def flush_h5_file(fov_id):
+    '''Writes out changes to the file, and closes it if not in an h5_session.'''
+    check_h5_files_pid()
+    if h5_session_depth == 0:
+        close_h5_file(fov_id)
+        return
+    h5f = h5_files.get((fov_id, 'r+'))
+    if h5f is not None and h5f.id.valid:
+        h5f.flush()
+
+# close the cached handles of an FOV
+def close_h5_file(fov_id):
+    if h5_files_pid != os.getpid():
+        return # nothing of this process is cached yet
+    for mode in ('r', 'r+'):
+        h5f = h5_files.pop((fov_id, mode), None)
+        if h5f is not None and h5f.id.valid:
+            h5f.close()
+
+# close all cached HDF5 files, also done when the process exits
+def close_h5_files():
+    if h5_files_pid != os.getpid():
+        return
+    for fov_id, mode in list(h5_files.keys()):
+        close_h5_file(fov_id)
+
+atexit.register(close_h5_files)
+
+# turns a frame selection into a list of frame indexes
+def get_frame_indexes(frames, frame_count):
+    '''frames can be None (all frames), a slice, or a list of frame indexes.
+    Negative indexes count from the end like numpy. Returns a list.'''
+
+    if frames is None:
+        return list(range(frame_count))
+    if isinstance(frames, slice):
+        return list(range(*frames.indices(frame_count)))
+
+    frame_indexes = []
+    for frame_index in frames:
+        frame_index = int(frame_index)
+        if frame_index < 0:
+            frame_index += frame_count
+        if frame_index < 0 or frame_index >= frame_count:
+            raise IndexError('Frame %d is out of range for a stack of %d frames.'
+                             % (frame_index, frame_count))
+        frame_indexes.append(frame_index)
+
+    return frame_indexes
+
+# read some frames from an HDF5 dataset
+def read_h5_frames(h5ds, frames=None):
+    '''Reads the frames of a (t, y, x) dataset with a single hyperslab selection.
+    Slices with a positive step are passed straight to HDF5, lists are read as a
+    sorted point selection (which h5py requires) and put back in the asked order.'''
+
+    if frames is None:
+        return h5ds[:]
+    if isinstance(frames, slice) and (frames.step is None or frames.step > 0):
+        return h5ds[frames]
+
+    frame_indexes = get_frame_indexes(frames, h5ds.shape[0])
+    if not frame_indexes:
+        return np.zeros((0,) + h5ds.shape[1:], dtype=h5ds.dtype)
+    unique_indexes, order = np.unique(frame_indexes, return_inverse=True)
+    return h5ds[unique_indexes.tolist()][order]
+
+# read some frames from a TIFF stack
+def read_tif_frames(tif, frames=None):
+    '''Reads the frames of a (t, y, x) TIFF stack, decoding only the pages asked for.'''
+
+    if frames is None:
+        return tif.asarray()
+
+    series_shape = tif.series[0].shape
+    frame_shape = series_shape[-2:]
+
+    # single page files with the whole stack in one page can't be read in part
+    if len(tif.pages) == 1:
+        img_stack = tif.asarray().reshape((-1,) + frame_shape)
+        return img_stack[get_frame_indexes(frames, img_stack.shape[0])]
+
+    frame_indexes = get_frame_indexes(frames, len(tif.pages))
+    if not frame_indexes:
+        return np.zeros((0,) + frame_shape, dtype=tif.pages[0].dtype)
+    img_stack = tif.asarray(key=frame_indexes)
+
+    return img_stack.reshape((len(frame_indexes),) + frame_shape)
+
+# file name of a TIFF stack, using mm3 conventions
+def get_stack_tif_path(fov_id, peak_id, color):
+    if 'empty' in color:
+        return os.path.join(params['empty_dir'],
+                            params['experiment_name'] + '_xy%03d_%s.tif' % (fov_id, color))
+
+    if color[0] == 'c':
+        img_dir = params['chnl_dir']
+    elif 'sub' in color:
+        img_dir = params['sub_dir']
+    elif 'foci' in color:
+        img_dir = params['foci_seg_dir']
+    elif 'seg' in color:
+        img_dir = params['seg_dir']
+
+    return os.path.join(img_dir, params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, color))
+
+# name of an HDF5 dataset or zarr array, using mm3 conventions
+def get_stack_array_name(peak_id, color):
+    if 'empty' in color:
+        return color
+    return 'channel_%04d/p%04d_%s' % (peak_id, peak_id, color)
+
+# stacks read by load_stack, least recently used first. See load_stack.
+stack_cache = collections.OrderedDict()
+stack_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+# size limit of the stack cache in bytes
+def get_stack_cache_limit():
+    '''params['stack_cache_mb'] sets the memory the stack cache may use in each
+    process. Default is 0, which turns it off, as most scripts read each stack once.'''
+    return int(params.get('stack_cache_mb', 0) * 1e6)
+
+# identifies the version of a stack on disk
+def get_stack_stamp(fov_id, peak_id, color):
+    '''Returns the modification time and size of the file (or zarr array directory)
+    holding a stack, or None if it does not exist. A cached stack is only used while
+    this is unchanged, so stacks rewritten by other processes are read again. HDF5
+    files are reopened for this outside an h5_session. Writers in this process also
+    drop what they rewrite with invalidate_stack_cache.'''
+
+    if params['output'] == 'TIFF':
+        stack_path = get_stack_tif_path(fov_id, peak_id, color)
+    elif params['output'] == 'HDF5':
+        stack_path = get_h5_path(fov_id)
+    elif params['output'] == 'zarr':
+        stack_path = get_zarr_path(fov_id, get_stack_array_name(peak_id, color))
+
+    try:
+        stack_stat = os.stat(stack_path)
+    except OSError:
+        return None
+
+    return (stack_stat.st_mtime, stack_stat.st_size)
+
+# add a stack to the cache, dropping the least recently used to stay under the limit
+def cache_stack(cache_key, stamp, img_stack):
+    '''Caches a copy of img_stack, so the caller can keep the one it has. Returns
+    True if the stack was cached, False if it is bigger than the limit.'''
+
+    cache_limit = get_stack_cache_limit()
+    if img_stack.nbytes > cache_limit:
+        return False
+    img_stack = img_stack.copy()
+
+    invalidate_stack_cache(*cache_key[1:])
+    while stack_cache and stack_cache_stats['bytes'] + img_stack.nbytes > cache_limit:
+        _, (_, old_stack) = stack_cache.popitem(last=False)
+        stack_cache_stats['bytes'] -= old_stack.nbytes
+        stack_cache_stats['evictions'] += 1
+
+    # cached stacks are shared, so they are made read only
+    img_stack.setflags(write=False)
+    stack_cache[cache_key] = (stamp, img_stack)
+    stack_cache_stats['bytes'] += img_stack.nbytes
+
+    return True
+
+# drop cached stacks
+def invalidate_stack_cache(fov_id=None, peak_id=None, color=None):
+    '''Removes the cached stacks matching fov_id, peak_id and color, where None
+    matches everything. Called when stacks are written.'''
+
+    for cache_key in list(stack_cache.keys()):
+        _, key_fov_id, key_peak_id, key_color = cache_key
+        if ((fov_id is None or key_fov_id == fov_id) and
+            (peak_id is None or key_peak_id == peak_id) and
+            (color is None or key_color == color)):
+            _, old_stack = stack_cache.pop(cache_key)
+            stack_cache_stats['bytes'] -= old_stack.nbytes
+
+# report how well the stack cache is doing
+def get_stack_cache_info():
+    stack_cache_info = dict(stack_cache_stats)
+    stack_cache_info['stacks'] = len(stack_cache)
+    stack_cache_info['limit'] = get_stack_cache_limit()
+    return stack_cache_info
+
 # loads and image stack from TIFF or HDF5 using mm3 conventions
-def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
+def load_stack(fov_id, peak_id, color='c1', frames=None):
     '''
     Loads an image stack.
 
-    Supports reading TIFF stacks or HDF5 files.
+    Supports reading TIFF stacks, HDF5 files, or the zarr directory store.
+    Only the frames asked for are read from disk.
+
+    If params['stack_cache_mb'] is set, whole stacks are kept in a least recently
+    used cache of that size, so that analysis functions run one after another on
+    the same channel read it only once. A cached stack is used while its file is
+    unchanged, and the caller always gets its own copy. See get_stack_cache_info
+    for hit and miss counts.
 
     Parameters
     ----------
@@ -179,6 +495,8 @@ def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
         sub : subtracted images
         seg : segmented images
         empty : get the empty channel for this fov, slightly different
+    frames : slice or list of ints
+        Which time points to return, e.g. slice(0, 10) or [0, -1]. Default is all.
 
     Returns
     -------
@@ -186,44 +504,70 @@ def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
         The image stack through time. Shape is (t, y, x)
     '''
 
-    # things are slightly different for empty channels
-    if 'empty' in color:
-        if params['output'] == 'TIFF':
-            img_filename = params['experiment_name'] + '_xy%03d_%s.tif' % (fov_id, color)
+    if get_stack_cache_limit() <= 0:
+        return read_stack(fov_id, peak_id, color, frames)
 
-            with tiff.TiffFile(os.path.join(params['empty_dir'],img_filename)) as tif:
-                img_stack = tif.asarray()
+    cache_key = (params['output'], fov_id, peak_id, color)
+    stamp = get_stack_stamp(fov_id, peak_id, color)
 
-        if params['output'] == 'HDF5':
-            with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r') as h5f:
-                img_stack = h5f[color][:]
+    if cache_key in stack_cache and stack_cache[cache_key][0] == stamp:
+        stack_cache_stats['hits'] += 1
+        img_stack = stack_cache.pop(cache_key)[1]
+        stack_cache[cache_key] = (stamp, img_stack) # now the most recently used
+        if frames is None:
+            return img_stack.copy()
+        # indexing with a list makes a copy
+        return img_stack[get_frame_indexes(frames, img_stack.shape[0])]
 
-        return img_stack
+    stack_cache_stats['misses'] += 1
+    img_stack = read_stack(fov_id, peak_id, color, frames)
 
-    # load normal images for either TIFF or HDF5
-    if params['output'] == 'TIFF':
-        if color[0] == 'c':
-            img_dir = params['chnl_dir']
-        elif 'sub' in color:
-            img_dir = params['sub_dir']
-        elif 'foci' in color:
-            img_dir = params['foci_seg_dir']
-        elif 'seg' in color:
-            img_dir = params['seg_dir']
+    # only whole stacks are cached
+    if frames is None:
+        cache_stack(cache_key, stamp, img_stack)
 
-        img_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, color)
+    return img_stack
+
+# reads an image stack, without the cache
+def read_stack(fov_id, peak_id, color='c1', frames=None):
+    '''Reads a stack from disk for load_stack, see there for the parameters.'''
 
-        with tiff.TiffFile(os.path.join(img_dir, img_filename)) as tif:
-            img_stack = tif.asarray()
+    if params['output'] == 'TIFF':
+        with tiff.TiffFile(get_stack_tif_path(fov_id, peak_id, color)) as tif:
+            img_stack = read_tif_frames(tif, frames)
 
     if params['output'] == 'HDF5':
-        with h5py.File(os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id), 'r') as h5f:
-            # normal naming
-            # need to use [:] to get a copy, else it references the closed hdf5 dataset
-            img_stack = h5f['channel_%04d/p%04d_%s' % (peak_id, peak_id, color)][:]
+        # in a session the file is kept open for the next stack, reading returns a copy
+        with read_h5_file(fov_id) as h5f:
+            img_stack = read_h5_frames(h5f[get_stack_array_name(peak_id, color)], frames)
+
+    if params['output'] == 'zarr':
+        img_stack = load_zarr_stack(fov_id, get_stack_array_name(peak_id, color), frames)
 
     return img_stack
 
+# get the shape of an image stack without loading it
+def get_stack_shape(fov_id, peak_id, color='c1'):
+    '''Returns the (t, y, x) shape of the stack load_stack would return.'''
+
+    if params['output'] == 'TIFF':
+        with tiff.TiffFile(get_stack_tif_path(fov_id, peak_id, color)) as tif:
+            stack_shape = tuple(tif.series[0].shape)
+        if len(stack_shape) == 2:
+            stack_shape = (1,) + stack_shape
+
+    if params['output'] == 'HDF5':
+        with read_h5_file(fov_id) as h5f:
+            stack_shape = h5f[get_stack_array_name(peak_id, color)].shape
+
+    if params['output'] == 'zarr':
+        zarr_meta = get_zarr_meta(fov_id, get_stack_array_name(peak_id, color))
+        if zarr_meta is None:
+            raise IOError('No zarr array for FOV %d, peak %s, %s.' % (fov_id, peak_id, color))
+        stack_shape = tuple(zarr_meta['shape'])
+
+    return tuple(stack_shape)
+
 # load the time table and add it to the global params
 def load_time_table():
     '''Add the time table dictionary to the params global dictionary.
@@ -279,6 +623,337 @@ def load_specs():
 
     return specs
 
+# function for loading the metadata of the raw images
+def load_tif_metadata():
+    '''Load the analyzed_imgs dictionary from the metadata index. Analyses made
+    before the index existed are loaded from TIFF_metadata.pkl.
+    '''
+
+    analyzed_imgs = load_tif_metadata_index(check_fingerprint=False)
+
+    if not analyzed_imgs:
+        information('No metadata index, loading TIFF_metadata.pkl.')
+        with open(os.path.join(params['ana_dir'], 'TIFF_metadata.pkl'), 'rb') as tiff_metadata:
+            analyzed_imgs = pickle.load(tiff_metadata)
+
+    return analyzed_imgs
+
+### functions for storage options
+# How stacks are compressed is set per kind of data in params['storage'], e.g.
+#
+# storage:
+#     default:
+#         codec: gzip
+#         level: 4
+#     subtracted:
+#         codec: lz4
+#         checksum: False
+#
+# The kinds are channels (sliced raw images), empty, subtracted, segmented and
+# predictions. Each entry may set codec, level, shuffle, checksum and chunk_frames,
+# anything left out is taken from default and then from default_storage_options.
+# HDF5 codecs are gzip, lzf, none, and lz4, blosc, blosc_zstd and zstd which need
+# the hdf5plugin package. TIFF stacks and zarr arrays can only be zlib compressed,
+# so for them only level is used (none means no compression).
+
+default_storage_options = {'codec': 'gzip', # compression filter
+                           'level': 4, # compression level, where the codec has one
+                           'shuffle': True, # byte shuffle before compressing
+                           'checksum': True, # fletcher32 checksum of each chunk
+                           'chunk_frames': 1} # time points in each chunk
+
+storage_data_classes = ['channels', 'empty', 'subtracted', 'segmented', 'predictions']
+
+# get the storage options for a kind of data
+def get_storage_options(data_class):
+    if data_class not in storage_data_classes:
+        raise ValueError('Unknown data class %s, use one of %s.'
+                         % (data_class, ', '.join(storage_data_classes)))
+
+    storage_params = params.get('storage', None) or {}
+    storage_options = dict(default_storage_options)
+    storage_options.update(storage_params.get('default', None) or {})
+    storage_options.update(storage_params.get(data_class, None) or {})
+
+    return storage_options
+
+# the compression arguments for h5py create_dataset
+def get_h5_compression(storage_options):
+    '''Turns storage options into the compression, compression_opts, shuffle and
+    fletcher32 arguments of h5py create_dataset. Codecs from hdf5plugin fall back to
+    gzip, with a warning, when it is not installed.'''
+
+    codec = str(storage_options['codec']).lower()
+    level = storage_options['level']
+    shuffle = bool(storage_options['shuffle'])
+
+    if codec in ('lz4', 'blosc', 'blosc_zstd', 'zstd') and hdf5plugin is None:
+        warning('Codec %s needs the hdf5plugin package, using gzip.' % codec)
+        codec = 'gzip'
+
+    if codec == 'none':
+        compression = {}
+    elif codec == 'gzip':
+        compression = {'compression': 'gzip', 'compression_opts': level}
+    elif codec == 'lzf':
+        compression = {'compression': 'lzf'}
+    elif codec == 'lz4':
+        compression = dict(hdf5plugin.LZ4())
+    elif codec == 'zstd':
+        compression = dict(hdf5plugin.Zstd(clevel=level))
+    elif codec in ('blosc', 'blosc_zstd'):
+        # blosc does its own shuffling
+        compression = dict(hdf5plugin.Blosc(cname='lz4' if codec == 'blosc' else 'zstd',
+                                            clevel=level,
+                                            shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle
+                                                    else hdf5plugin.Blosc.NOSHUFFLE))
+        shuffle = False
+    else:
+        raise ValueError('Unknown codec %s.' % codec)
+
+    # the shuffle filter does nothing without compression
+    compression['shuffle'] = shuffle and codec != 'none'
+    compression['fletcher32'] = bool(storage_options['checksum'])
+
+    return compression
+
+# all the options for h5py create_dataset of a (t, y, x) stack
+def get_h5_dataset_options(data_class, frame_shape, storage_options=None):
+    '''Returns keyword arguments for h5py create_dataset for a stack of frames of
+    frame_shape, with chunks and compression set by params['storage'] for data_class.
+    storage_options can be given directly instead, as in aux/mm3_Benchmark.py.'''
+
+    if storage_options is None:
+        storage_options = get_storage_options(data_class)
+
+    frame_shape = tuple(frame_shape)
+    dataset_options = {'chunks': (int(storage_options['chunk_frames']),) + frame_shape,
+                       'maxshape': (None,) + frame_shape}
+    dataset_options.update(get_h5_compression(storage_options))
+
+    return dataset_options
+
+# the compressor of a zarr array
+def get_zarr_compressor(data_class):
+    '''Returns the zarr compressor metadata for data_class, or None for no
+    compression. zarr arrays are zlib compressed at the level of the storage
+    options. gzip maps to zlib. Other codecs fall back to zlib with a warning.
+    Chunks are always one frame.'''
+
+    storage_options = get_storage_options(data_class)
+    codec = str(storage_options['codec']).lower()
+
+    if codec == 'none':
+        return None
+    if codec not in ('gzip', 'zlib'):
+        warning('Codec %s is not supported for zarr output, using zlib.' % codec)
+
+    return {'id': 'zlib', 'level': int(storage_options['level'])}
+
+# zlib levels TIFF stacks were always saved with, where they are not 4
+tiff_default_levels = {'segmented': 5}
+
+# the compress argument for tiff.imsave
+def get_tiff_compress(data_class, default_level=None):
+    '''Returns the zlib level for a TIFF stack of data_class. If params['storage']
+    does not set a level, the level the stack was always saved with is used:
+    default_level if given, else tiff_default_levels, else 4.'''
+
+    storage_options = get_storage_options(data_class)
+    if str(storage_options['codec']).lower() == 'none':
+        return 0
+
+    storage_params = params.get('storage', None) or {}
+    if not any(['level' in (storage_params.get(key, None) or {}) for key in ('default', data_class)]):
+        if default_level is None:
+            default_level = tiff_default_levels.get(data_class, default_storage_options['level'])
+        return int(default_level)
+
+    return int(storage_options['level'])
+
+### functions for the zarr directory store
+# With params['output'] set to 'zarr', each FOV is a directory in params['zarr_dir']
+# laid out like the HDF5 file for the FOV, e.g. xy001/channel_0001/p0001_c1.
+# Each array stores every frame as its own chunk file, zlib compressed as set by
+# params['storage'] (see get_zarr_compressor), so different
+# peaks of an FOV can be written by different processes at once, and a range of
+# frames can be read without the rest. The layout is zarr format 2, so the arrays
+# can also be opened with the zarr package.
+
+# path to an FOV group or an array in it
+def get_zarr_path(fov_id, array_name=None):
+    fov_path = os.path.join(params['zarr_dir'], 'xy%03d' % fov_id)
+    if array_name is None:
+        return fov_path
+    return os.path.join(fov_path, *array_name.split('/'))
+
+# write a small json file so readers never see it half written
+def write_json_atomic(file_path, data):
+    tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, file_path)
+
+# make the directories and group files down to a path
+def make_zarr_groups(group_path):
+    relative_path = os.path.relpath(group_path, params['zarr_dir'])
+    path = params['zarr_dir']
+    for part in [''] + relative_path.split(os.sep):
+        path = os.path.join(path, part)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass # made by another process in the meantime
+        if not os.path.exists(os.path.join(path, '.zgroup')):
+            write_json_atomic(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+
+# add attributes to an FOV group or array
+def set_zarr_attrs(fov_id, attrs, array_name=None):
+    '''Merges attrs into the attributes of an FOV group or an array in it.
+    Values must be things json can write.'''
+
+    attrs_path = os.path.join(get_zarr_path(fov_id, array_name), '.zattrs')
+    old_attrs = {}
+    if os.path.exists(attrs_path):
+        with open(attrs_path, 'r') as attrs_file:
+            old_attrs = json.load(attrs_file)
+    old_attrs.update(attrs)
+    write_json_atomic(attrs_path, old_attrs)
+
+# get the attributes of an FOV group or array
+def get_zarr_attrs(fov_id, array_name=None):
+    attrs_path = os.path.join(get_zarr_path(fov_id, array_name), '.zattrs')
+    if not os.path.exists(attrs_path):
+        return {}
+    with open(attrs_path, 'r') as attrs_file:
+        return json.load(attrs_file)
+
+# make an empty array, replacing any array of the same name
+def create_zarr_array(fov_id, array_name, frame_shape, dtype, data_class, frame_count=0):
+    '''Makes an array of frame_count frames of frame_shape, chunked one frame per
+    chunk and compressed as the storage options of data_class say. Frames are
+    filled in with write_zarr_frame. Returns the array metadata.
+
+    Called by
+    save_zarr_stack
+    zarr_stack_slice_and_write
+    '''
+
+    array_path = get_zarr_path(fov_id, array_name)
+    if os.path.exists(array_path):
+        shutil.rmtree(array_path)
+    invalidate_stack_cache(fov_id)
+    make_zarr_groups(os.path.dirname(array_path))
+    os.makedirs(array_path)
+
+    zarr_meta = {'zarr_format': 2,
+                 'shape': [int(frame_count)] + [int(dim) for dim in frame_shape],
+                 'chunks': [1] + [int(dim) for dim in frame_shape],
+                 'dtype': np.dtype(dtype).str,
+                 'compressor': get_zarr_compressor(data_class),
+                 'fill_value': 0,
+                 'order': 'C',
+                 'filters': None}
+    write_json_atomic(os.path.join(array_path, '.zarray'), zarr_meta)
+
+    return zarr_meta
+
+# get the metadata of an array, or None if it does not exist
+def get_zarr_meta(fov_id, array_name):
+    meta_path = os.path.join(get_zarr_path(fov_id, array_name), '.zarray')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as meta_file:
+        return json.load(meta_file)
+
+# name of the chunk file of a frame
+def get_zarr_chunk_name(zarr_meta, frame_index):
+    return '.'.join([str(frame_index)] + ['0'] * (len(zarr_meta['shape']) - 1))
+
+# write one frame to its chunk
+def write_zarr_frame(fov_id, array_name, zarr_meta, frame_index, frame):
+    '''Compresses and writes one frame. The array must be long enough, see
+    resize_zarr_array.'''
+
+    chunk_path = os.path.join(get_zarr_path(fov_id, array_name),
+                              get_zarr_chunk_name(zarr_meta, frame_index))
+    frame = np.ascontiguousarray(frame, dtype=np.dtype(zarr_meta['dtype']))
+    chunk = frame.tobytes()
+    if zarr_meta['compressor'] is not None:
+        chunk = zlib.compress(chunk, zarr_meta['compressor']['level'])
+
+    tmp_path = '%s.%d.tmp' % (chunk_path, os.getpid())
+    with open(tmp_path, 'wb') as chunk_file:
+        chunk_file.write(chunk)
+    os.replace(tmp_path, chunk_path)
+
+# change the number of frames of an array
+def resize_zarr_array(fov_id, array_name, zarr_meta, frame_count):
+    zarr_meta['shape'][0] = int(frame_count)
+    write_json_atomic(os.path.join(get_zarr_path(fov_id, array_name), '.zarray'), zarr_meta)
+    return zarr_meta
+
+# save a whole image stack as an array
+def save_zarr_stack(image_stack, fov_id, array_name, data_class, attrs=None):
+    '''Saves a (t, y, x) stack as an array of an FOV, replacing any array of the same
+    name. This is the zarr counterpart of making an HDF5 dataset.
+
+    Parameters
+    ----------
+    image_stack : np.ndarray
+    fov_id : int
+    array_name : str
+        Path of the array in the FOV, the same as the HDF5 dataset path,
+        e.g. 'channel_0001/p0001_sub_c1' or 'empty_c1'.
+    data_class : str
+        Kind of data, one of storage_data_classes, for the compression.
+    attrs : dict
+        Optional attributes for the array.
+    '''
+
+    zarr_meta = create_zarr_array(fov_id, array_name, image_stack.shape[1:],
+                                  image_stack.dtype, data_class, frame_count=image_stack.shape[0])
+    for frame_index, frame in enumerate(image_stack):
+        write_zarr_frame(fov_id, array_name, zarr_meta, frame_index, frame)
+
+    if attrs:
+        set_zarr_attrs(fov_id, attrs, array_name)
+
+    return
+
+# load an array, or some frames of it
+def load_zarr_stack(fov_id, array_name, frames=None):
+    '''Loads a (t, y, x) array of an FOV. If frames is given (a list of frame
+    indexes or a slice), only those chunks are read.
+
+    Called by
+    load_stack
+    '''
+
+    zarr_meta = get_zarr_meta(fov_id, array_name)
+    if zarr_meta is None:
+        raise IOError('No zarr array %s for FOV %d.' % (array_name, fov_id))
+
+    frame_indexes = get_frame_indexes(frames, zarr_meta['shape'][0])
+
+    dtype = np.dtype(zarr_meta['dtype'])
+    frame_shape = tuple(zarr_meta['shape'][1:])
+    image_stack = np.full((len(frame_indexes),) + frame_shape, zarr_meta['fill_value'], dtype=dtype)
+
+    array_path = get_zarr_path(fov_id, array_name)
+    for n, frame_index in enumerate(frame_indexes):
+        chunk_path = os.path.join(array_path, get_zarr_chunk_name(zarr_meta, frame_index))
+        if not os.path.exists(chunk_path):
+            continue # missing chunks are the fill value
+        with open(chunk_path, 'rb') as chunk_file:
+            chunk = chunk_file.read()
+        if zarr_meta['compressor'] is not None:
+            chunk = zlib.decompress(chunk)
+        image_stack[n] = np.frombuffer(chunk, dtype=dtype).reshape(frame_shape)
+
+    return image_stack
+
 ### functions for dealing with raw TIFF images
 
 # get params is the major function which processes raw TIFF images
@@ -307,13 +982,13 @@ def get_initial_tif_params(image_filename):
     try:
         # open up file and get metadata
         with tiff.TiffFile(os.path.join(params['TIFF_dir'],image_filename)) as tif:
-            image_data = tif.asarray()
-            #print(image_data.shape) # uncomment for debug
-            #if len(image_data.shape) == 2:
-            #    img_shape = [image_data.shape[0],image_data.shape[1]]
-            #else:
-            img_shape = [image_data.shape[1],image_data.shape[2]]
-            plane_list = [str(i+1) for i in range(image_data.shape[0])]
+            # the shape comes from the page headers, so no pixel data is decoded
+            data_shape = tif.series[0].shape
+            img_shape = [data_shape[-2], data_shape[-1]]
+            if len(data_shape) > 2:
+                plane_list = [str(i+1) for i in range(data_shape[0])]
+            else:
+                plane_list = ['1']
             #print(plane_list) # uncomment for debug
 
             if params['TIFF_source'] == 'elements':
@@ -370,7 +1045,20 @@ def get_tif_params(image_filename, find_channels=True):
     try:
         # open up file and get metadata
         with tiff.TiffFile(os.path.join(params['TIFF_dir'],image_filename)) as tif:
-            image_data = tif.asarray()
+            # get shape of single plane from the page headers
+            data_shape = tif.series[0].shape
+            img_shape = [data_shape[-2], data_shape[-1]]
+
+            # pixel data is only needed to find channels, and then only the phase plane
+            if find_channels:
+                ph_index = int(params['phase_plane'][1:]) - 1
+                if len(data_shape) > 2 and len(tif.pages) == data_shape[0]:
+                    # one page per plane, so only the phase page is decoded
+                    image_data = read_tif_page(tif, ph_index)
+                else:
+                    image_data = tif.asarray()
+                    if len(image_data.shape) > 2:
+                        image_data = image_data[ph_index]
 
             if params['TIFF_source'] == 'elements':
                 image_metadata = get_tif_metadata_elements(tif)
@@ -380,20 +1068,11 @@ def get_tif_params(image_filename, find_channels=True):
                 image_metadata = get_tif_metadata_filename(tif)
 
         # look for channels if flagged
+        chnl_loc_dict = None
         if find_channels:
-            # fix the image orientation and get the number of planes
+            # fix the image orientation of the phase plane
             image_data = fix_orientation(image_data)
 
-            # if the image data has more than 1 plane restrict image_data to phase,
-            # which should have highest mean pixel data
-            if len(image_data.shape) > 2:
-                #ph_index = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
-                ph_index = int(params['phase_plane'][1:]) - 1
-                image_data = image_data[ph_index]
-
-            # get shape of single plane
-            img_shape = [image_data.shape[0], image_data.shape[1]]
-
             # find channels on the processed image
             chnl_loc_dict = find_channel_locs(image_data)
 
@@ -418,6 +1097,27 @@ def get_tif_params(image_filename, find_channels=True):
         print(traceback.print_tb(sys.exc_info()[2]))
         return {'filepath': os.path.join(params['TIFF_dir'],image_filename), 'analyze_success': False}
 
+# decode one page of an open TIFF
+def read_tif_page(tif, page_index):
+    '''Returns the image data of a single page (plane) of a TIFF, without decoding
+    the other planes.
+
+    If params['compile']['memmap_tiffs'] is True and the page is stored uncompressed
+    and contiguously, it is memory-mapped from the file instead of read, so only the
+    bytes which are used get loaded.
+
+    Called by
+    get_tif_params
+    '''
+
+    if params['compile'].get('memmap_tiffs', False) and tif.pages[page_index].is_contiguous:
+        try:
+            return tif.asarray(key=page_index, memmap=True)
+        except TypeError:
+            pass # this version of tifffile can not memory-map
+
+    return tif.asarray(key=page_index)
+
 # finds metdata in a tiff image which has been expoted with Nikon Elements.
 def get_tif_metadata_elements(tif):
     '''This function pulls out the metadata from a tif file and returns it as a dictionary.
@@ -585,6 +1285,278 @@ def get_tif_metadata_filename(tif):
 
     return idata
 
+### functions for the image metadata index
+# The metadata of the raw images is kept in TIFF_metadata.hdf5 in the analysis directory.
+# It is columnar, with one dataset per field and one row per image. Rows are keyed by
+# file name, size, and modification time, so a rescan only needs to analyze images which
+# are new or have changed since they were indexed.
+
+# columns of the index and their HDF5 data types. planes and channels are JSON strings.
+tif_metadata_index_columns = [('filename', 'str'),
+                              ('size', 'i8'),
+                              ('mtime', 'f8'),
+                              ('fov', 'i4'),
+                              ('t', 'i4'),
+                              ('jd', 'f8'),
+                              ('x', 'f8'),
+                              ('y', 'f8'),
+                              ('shape', 'i4'),
+                              ('planes', 'str'),
+                              ('channels', 'str')]
+
+# returns a string which identifies the parameters used to make image metadata
+def get_tif_metadata_fingerprint():
+    '''Index rows are only reused if they were made with the same channel finding
+    parameters, otherwise the channel locations could be stale.
+
+    Called by
+    load_tif_metadata_index
+    update_tif_metadata_index
+    '''
+
+    fingerprint_params = {'TIFF_source' : params['TIFF_source'],
+                          'phase_plane' : params['phase_plane']}
+    for key in ['find_channels_method', 'channel_detection_method', 'channel_width',
+                'channel_separation', 'channel_width_pad', 'channel_detection_snr',
+                'image_orientation']:
+        fingerprint_params[key] = params['compile'].get(key)
+
+    fingerprint_string = json.dumps(fingerprint_params, sort_keys=True)
+    return hashlib.md5(fingerprint_string.encode('utf8')).hexdigest()
+
+# get size and modification time of raw images
+def get_tif_file_stats(image_filenames):
+    '''Returns a dictionary of (size, mtime) tuples keyed by image file name.
+    Images which do not exist in the TIFF directory get (-1, 0.0).
+
+    Called by
+    mm3_Compile.py __main__
+    update_tif_metadata_index
+    '''
+
+    file_stats = {}
+    for image_filename in image_filenames:
+        try:
+            file_stat = os.stat(os.path.join(params['TIFF_dir'], image_filename))
+            file_stats[image_filename] = (file_stat.st_size, file_stat.st_mtime)
+        except OSError:
+            file_stats[image_filename] = (-1, 0.0)
+
+    return file_stats
+
+# convert h5py strings, which may be bytes, to str
+def decode_h5_string(value):
+    if isinstance(value, bytes):
+        return value.decode('utf8')
+    return value
+
+# turn the channels entry of an image into something json can write
+def channels_to_json(channels):
+    '''Peak keys and pixel values are often numpy integers, which json does not know.'''
+
+    if channels is None:
+        return json.dumps(None)
+
+    channels_dict = {}
+    for peak, ends in six.iteritems(channels):
+        channels_dict[str(int(peak))] = {key : int(value) for key, value in six.iteritems(ends)}
+
+    return json.dumps(channels_dict)
+
+# and back again
+def channels_from_json(channels_string):
+    channels_dict = json.loads(channels_string)
+
+    if channels_dict is None:
+        return None
+
+    return {int(peak) : ends for peak, ends in six.iteritems(channels_dict)}
+
+# load image metadata from the index
+def load_tif_metadata_index(fov_id=None, t_start=None, t_end=None, file_stats=None,
+                            check_fingerprint=True):
+    '''Loads rows of the metadata index as an analyzed_imgs dictionary, the same
+    format get_tif_params returns, keyed by image file name.
+
+    Only the fov and t columns are read to select rows, so a query for one FOV or
+    time range does not decode the planes and channels of every image.
+
+    Parameters
+    ----------
+    fov_id : int
+        Only return images from this FOV.
+    t_start, t_end : int
+        Only return images with t_start <= t <= t_end.
+    file_stats : dict
+        Output of get_tif_file_stats. If given, only images in it whose size and
+        modification time match the index are returned.
+    check_fingerprint : bool
+        If True, nothing is returned when the index was made with different parameters.
+
+    Returns
+    -------
+    analyzed_imgs : dict
+        Empty if there is no index.
+
+    Called by
+    load_tif_metadata
+    mm3_Compile.py __main__
+    '''
+
+    index_path = os.path.join(params['ana_dir'], 'TIFF_metadata.hdf5')
+    analyzed_imgs = {}
+
+    if not os.path.exists(index_path):
+        return analyzed_imgs
+
+    with h5py.File(index_path, 'r') as h5f:
+        if check_fingerprint and \
+           decode_h5_string(h5f.attrs['fingerprint']) != get_tif_metadata_fingerprint():
+            information('Compile parameters have changed, not reusing the metadata index.')
+            return analyzed_imgs
+
+        # pick rows with the small numeric columns first
+        use_rows = np.ones(h5f['filename'].shape[0], dtype=bool)
+        if fov_id is not None:
+            use_rows &= h5f['fov'][:] == fov_id
+        if t_start is not None:
+            use_rows &= h5f['t'][:] >= t_start
+        if t_end is not None:
+            use_rows &= h5f['t'][:] <= t_end
+
+        filenames = np.array([decode_h5_string(name) for name in h5f['filename'][:]])
+
+        if file_stats is not None:
+            sizes = h5f['size'][:]
+            mtimes = h5f['mtime'][:]
+            for i in np.where(use_rows)[0]:
+                use_rows[i] = filenames[i] in file_stats and \
+                              file_stats[filenames[i]] == (sizes[i], mtimes[i])
+
+        rows = np.where(use_rows)[0]
+        if len(rows) == 0:
+            return analyzed_imgs
+
+        columns = {}
+        for column, _ in tif_metadata_index_columns[3:]:
+            columns[column] = h5f[column][:][rows]
+
+    for n, i in enumerate(rows):
+        image_params = {'filepath' : os.path.join(params['TIFF_dir'], filenames[i]),
+                        'fov' : int(columns['fov'][n]),
+                        't' : int(columns['t'][n]),
+                        'jd' : float(columns['jd'][n]),
+                        'x' : float(columns['x'][n]),
+                        'y' : float(columns['y'][n]),
+                        'planes' : json.loads(decode_h5_string(columns['planes'][n])),
+                        'shape' : [int(columns['shape'][n][0]), int(columns['shape'][n][1])]}
+
+        channels = channels_from_json(decode_h5_string(columns['channels'][n]))
+        if channels is not None:
+            image_params['channels'] = channels
+
+        analyzed_imgs[filenames[i]] = image_params
+
+    return analyzed_imgs
+
+# add or replace rows of the metadata index
+def update_tif_metadata_index(analyzed_imgs):
+    '''Writes the metadata of analyzed images to the index. Images already in the
+    index have their rows replaced and new images are appended, so the rest of the
+    index is left alone. Images which failed analysis are not written, so they are
+    analyzed again on the next scan.
+
+    If the index was made with different parameters it is started over.
+
+    Parameters
+    ----------
+    analyzed_imgs : dict
+        Output of get_tif_params or get_initial_tif_params keyed by image file name.
+
+    Called by
+    mm3_Compile.py __main__
+    '''
+
+    index_path = os.path.join(params['ana_dir'], 'TIFF_metadata.hdf5')
+    fingerprint = get_tif_metadata_fingerprint()
+
+    image_filenames = sorted([fn for fn, image_params in six.iteritems(analyzed_imgs)
+                              if image_params and image_params.get('analyze_success', True)])
+    file_stats = get_tif_file_stats(image_filenames)
+
+    # put the new rows into columns
+    new_rows = {column : [] for column, _ in tif_metadata_index_columns}
+    for fn in image_filenames:
+        image_params = analyzed_imgs[fn]
+        new_rows['filename'].append(fn)
+        new_rows['size'].append(file_stats[fn][0])
+        new_rows['mtime'].append(file_stats[fn][1])
+        for column in ['fov', 't', 'jd', 'x', 'y', 'shape']:
+            new_rows[column].append(image_params[column])
+        new_rows['planes'].append(json.dumps([str(plane) for plane in image_params['planes']]))
+        new_rows['channels'].append(channels_to_json(image_params.get('channels')))
+
+    # start a new index if there is none or it is out of date
+    start_over = True
+    if os.path.exists(index_path):
+        with h5py.File(index_path, 'r') as h5f:
+            start_over = decode_h5_string(h5f.attrs['fingerprint']) != fingerprint
+
+    str_dtype = h5py.special_dtype(vlen=six.text_type)
+
+    if start_over:
+        with h5py.File(index_path, 'w') as h5f:
+            h5f.attrs['fingerprint'] = fingerprint
+            for column, dtype in tif_metadata_index_columns:
+                data = new_rows[column]
+                if dtype == 'str':
+                    h5f.create_dataset(column, data=np.array(data, dtype=object),
+                                       dtype=str_dtype, maxshape=(None,), chunks=True)
+                elif column == 'shape':
+                    h5f.create_dataset(column, data=np.array(data, dtype=dtype).reshape(-1, 2),
+                                       maxshape=(None, 2), chunks=True)
+                else:
+                    h5f.create_dataset(column, data=np.array(data, dtype=dtype),
+                                       maxshape=(None,), chunks=True)
+
+        information('Wrote metadata index for %d images.' % len(image_filenames))
+        return
+
+    with h5py.File(index_path, 'r+') as h5f:
+        row_lookup = {decode_h5_string(name) : i for i, name in enumerate(h5f['filename'][:])}
+
+        replace = [n for n, fn in enumerate(image_filenames) if fn in row_lookup]
+        replace_rows = [row_lookup[image_filenames[n]] for n in replace]
+        append = [n for n, fn in enumerate(image_filenames) if fn not in row_lookup]
+        start_index = len(row_lookup)
+
+        for column, dtype in tif_metadata_index_columns:
+            if dtype == 'str':
+                data = np.array(new_rows[column], dtype=object)
+            elif column == 'shape':
+                data = np.array(new_rows[column], dtype=dtype).reshape(-1, 2)
+            else:
+                data = np.array(new_rows[column], dtype=dtype)
+            h5ds = h5f[column]
+
+            # replace in memory and write back the whole column, which is small
+            if replace:
+                column_data = h5ds[:]
+                if dtype == 'str':
+                    column_data = np.array([decode_h5_string(value) for value in column_data],
+                                           dtype=object)
+                column_data[replace_rows] = data[replace]
+                h5ds[:] = column_data
+
+            if append:
+                h5ds.resize(start_index + len(append), axis=0)
+                h5ds[start_index:] = data[append]
+
+    information('Updated metadata index, %d images replaced and %d added.'
+                % (len(replace), len(append)))
+
+    return
+
 # make a lookup time table for converting nominal time to elapsed time in seconds
 def make_time_table(analyzed_imgs):
     '''
@@ -664,70 +1636,114 @@ def save_tiffs(imgDict, analyzed_imgs, fov_id):
             channel_filename = os.path.join(savePath, params['experiment_name'] + '_xy{0:0=3}_p{1:0=4}_c{2}.tif'.format(fov_id, peak, planeNumber))
             io.imsave(channel_filename, img[:,:,:,int(planeNumber)-1])
 
-# slice_and_write cuts up the image files one at a time and writes them out to tiff stacks
-def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
-    '''Writes out 4D stacks of TIFF images per channel.
-    Loads all tiffs from and FOV into memory and then slices all time points at once.
+# loads one raw TIFF and puts it in the form used for slicing out channels
+def load_tif_frame(filepath):
+    '''Loads a single raw TIFF and returns the pixel data as [y, x, plane].
+    The orientation is fixed the same way it was for channel finding.
 
     Called by
-    __main__
+    load_tif_frames
     '''
 
-    # make an array of images and then concatenate them into one big stack
-    image_fov_stack = []
+    # load the tif
+    with tiff.TiffFile(filepath) as tif:
+        image_data = tif.asarray()
+
+    return prepare_frame_for_slicing(image_data)
+
+# puts raw image data in the form used for slicing out channels
+def prepare_frame_for_slicing(image_data):
+    '''Takes [plane, y, x] or [y, x] raw image data, fixes the orientation, and
+    returns it as [y, x, plane].
+
+    Called by
+    load_tif_frame
+    aux/mm3_nd2ToTIFF.py
+    '''
+
+    # channel finding was also done on images after orientation was fixed
+    image_data = fix_orientation(image_data)
+
+    # add additional axis if the image is flat
+    if len(image_data.shape) == 2:
+        image_data = np.expand_dims(image_data, 0)
+
+    # change axis so it goes Y, X, Plane
+    image_data = np.rollaxis(image_data, 0, 3)
+
+    return image_data
 
-    # go through list of images and get the file path
-    for n, image in enumerate(images_to_write):
-        # analyzed_imgs dictionary will be found in main scope. [0] is the key, [1] is jd
-        image_params = analyzed_imgs[image[0]]
+# generator which loads the raw TIFFs for slicing one time point at a time
+def load_tif_frames(image_names, analyzed_imgs):
+    '''Yields the [y, x, plane] pixel data of each image in image_names, in order.
+    Only one frame is held in memory at a time.
+
+    Called by
+    tiff_stack_slice_and_write
+    hdf5_stack_slice_and_write
+    '''
 
+    for image_name in image_names:
+        # analyzed_imgs dictionary will be found in main scope.
+        image_params = analyzed_imgs[image_name]
         information("Loading %s." % image_params['filepath'].split('/')[-1])
 
-        if n == 1:
-            # declare identification variables for saving using first image
-            fov_id = image_params['fov']
+        yield load_tif_frame(image_params['filepath'])
 
-        # load the tif and store it in array
-        with tiff.TiffFile(image_params['filepath']) as tif:
-            image_data = tif.asarray()
+# slice_and_write cuts up the image files one at a time and writes them out to tiff stacks
+def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
+    '''Writes out 4D stacks of TIFF images per channel.
+    Images are loaded one time point at a time and each channel slice is added as a
+    page to an open TIFF writer per channel and color, so memory use is bounded by a
+    single frame no matter how long the experiment is. The first page describes the
+    shape of the whole stack, so the pages are read back as one series.
 
-        # channel finding was also done on images after orientation was fixed
-        image_data = fix_orientation(image_data)
+    Called by
+    __main__
+    '''
 
-        # add additional axis if the image is flat
-        if len(image_data.shape) == 2:
-            image_data = np.expand_dims(image_data, 0)
+    # [0] is the key, [1] is jd
+    image_names = [image[0] for image in images_to_write]
+    frame_count = len(image_names)
 
-        # change axis so it goes Y, X, Plane
-        image_data = np.rollaxis(image_data, 0, 3)
+    # declare identification variables for saving using first image
+    fov_id = analyzed_imgs[image_names[0]]['fov']
 
-        # add it to list. The images should be in time order
-        image_fov_stack.append(image_data)
+    # drop the cached copies of the stacks being rewritten
+    invalidate_stack_cache(fov_id)
 
-    # concatenate the list into one big ass stack
-    image_fov_stack = np.stack(image_fov_stack, axis=0)
+    compress = get_tiff_compress('channels')
 
-    # cut out the channels as per channel masks for this fov
-    for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
-        #information('Slicing and saving channel peak %s.' % channel_filename.split('/')[-1])
-        information('Slicing and saving channel peak %d.' % peak)
+    # TIFF writers for each channel and color, keyed by (peak, color_index)
+    channel_writers = {}
 
-        # channel masks should only contain ints, but you can use this for hard fix
-        # for i in range(len(channel_loc)):
-        #     for j in range(len(channel_loc[i])):
-        #         channel_loc[i][j] = int(channel_loc[i][j])
+    try:
+        for n, image_data in enumerate(load_tif_frames(image_names, analyzed_imgs)):
+            # cut out the channels as per channel masks for this fov
+            for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+                channel_slice = cut_slice(image_data, channel_loc)
+
+                # save a different time stack for all colors
+                for color_index in range(channel_slice.shape[2]):
+                    if n == 0:
+                        # this is the filename for the channel
+                        channel_filename = os.path.join(params['chnl_dir'], params['experiment_name'] + '_xy%03d_p%04d_c%1d.tif' % (fov_id, peak, color_index+1))
+                        channel_writers[(peak, color_index)] = tiff.TiffWriter(channel_filename)
+
+                        # the shape of the whole stack, written once with the first page
+                        stack_shape = [frame_count, channel_slice.shape[0], channel_slice.shape[1]]
+                        description = json.dumps({'shape': stack_shape})
+                    else:
+                        description = None
 
-        # slice out channel.
-        # The function should recognize the shape length as 4 and cut all time points
-        channel_stack = cut_slice(image_fov_stack, channel_loc)
+                    channel_writers[(peak, color_index)].save(channel_slice[:,:,color_index],
+                                                              compress=compress,
+                                                              description=description,
+                                                              metadata=None)
 
-        # save a different time stack for all colors
-        for color_index in range(channel_stack.shape[3]):
-            # this is the filename for the channel
-            # # chnl_dir and p will be looked for in the scope above (__main__)
-            channel_filename = os.path.join(params['chnl_dir'], params['experiment_name'] + '_xy%03d_p%04d_c%1d.tif' % (fov_id, peak, color_index+1))
-            # save stack
-            tiff.imsave(channel_filename, channel_stack[:,:,:,color_index], compress=4)
+    finally:
+        for channel_writer in six.itervalues(channel_writers):
+            channel_writer.close()
 
     return
 
@@ -760,7 +1776,8 @@ def save_hdf5(imgDict, img_names, analyzed_imgs, fov_id, channel_masks):
 
     fov_channel_masks = channel_masks[fov_id]
 
-    with h5py.File(os.path.join(savePath,'{}_xy{:0=2}.hdf5'.format(params['experiment_name'],fov_id)), 'w', libver='earliest') as h5f:
+    # the file is closed when done, as it is read by other processes next
+    with get_h5_file(fov_id, 'w') as h5f:
 
         # add in metadata for this FOV
         # these attributes should be common for all channel
@@ -805,9 +1822,7 @@ def save_hdf5(imgDict, img_names, analyzed_imgs, fov_id, channel_masks):
                 # create the dataset for the image. Review docs for these options.
                 h5ds = h5g.create_dataset(u'p%04d_c%1d' % (peak, color_index+1),
                                 data=channel_stack[:,:,:,color_index],
-                                chunks=(1, channel_stack.shape[1], channel_stack.shape[2]),
-                                maxshape=(None, channel_stack.shape[1], channel_stack.shape[2]),
-                                compression="gzip", shuffle=True, fletcher32=True)
+                                **get_h5_dataset_options('channels', channel_stack.shape[1:3]))
 
                 # h5ds.attrs.create('plane', image_planes[color_index].encode('utf8'))
 
@@ -817,133 +1832,386 @@ def save_hdf5(imgDict, img_names, analyzed_imgs, fov_id, channel_masks):
     return
 
 # same thing as tiff_stack_slice_and_write but do it for hdf5
-def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
+def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs, append=False):
     '''Writes out 4D stacks of TIFF images to an HDF5 file.
+    Images are loaded one time point at a time and each channel slice is written
+    straight into the HDF5 datasets, so memory use is bounded by a single frame.
+
+    If append is True and the HDF5 file for the FOV exists, only images which are
+    not yet in its 'filenames' dataset are loaded, and they are added to the end
+    of the existing datasets.
+
+    Returns the number of frames written.
 
     Called by
-    __main__
+    slice_and_write_fov
     '''
 
-    # make an array of images and then concatenate them into one big stack
-    image_fov_stack = []
+    # [0] is the key, [1] is jd
+    image_names = [image[0] for image in images_to_write]
 
-    # make arrays for filenames and times
-    image_filenames = []
-    image_times = [] # times is still an integer but may be indexed arbitrarily
-    image_jds = [] # jds = julian dates (times)
+    if append:
+        fov_id = analyzed_imgs[image_names[0]]['fov']
+        if os.path.exists(get_h5_path(fov_id)):
+            # skip images which were written in a previous run
+            with read_h5_file(fov_id) as h5f:
+                written_names = set(name.decode('utf8') if isinstance(name, bytes) else name
+                                    for name in h5f['filenames'][:, 0])
+            image_names = [image_name for image_name in image_names
+                           if image_name not in written_names]
 
-    # go through list of images, load and fix them, and create arrays of metadata
-    for n, image in enumerate(images_to_write):
-        image_name = image[0] # [0] is the key, [1] is jd
+            if not image_names:
+                information('No new images to append for FOV %d.' % fov_id)
+                return 0
 
-        # analyzed_imgs dictionary will be found in main scope.
-        image_params = analyzed_imgs[image_name]
-        information("Loading %s." % image_params['filepath'].split('/')[-1])
+            information('Appending %d images to FOV %d.' % (len(image_names), fov_id))
+        else:
+            append = False
 
-        # add information to metadata arrays
-        image_filenames.append(image_name)
-        image_times.append(image_params['t'])
-        image_jds.append(image_params['jd'])
+    return hdf5_slice_and_write_frames(image_names, load_tif_frames(image_names, analyzed_imgs),
+                                       channel_masks, analyzed_imgs, append=append)
 
-        # declare identification variables for saving using first image
-        if n == 1:
-            # same across fov
-            fov_id = image_params['fov']
-            x_loc = image_params['x']
-            y_loc = image_params['y']
-            image_shape = image_params['shape']
-            image_planes = image_params['planes']
+# writes channel slices into an HDF5 file for an fov as frames come in
+def hdf5_slice_and_write_frames(image_names, frames, channel_masks, analyzed_imgs, append=False):
+    '''Creates the HDF5 file for an FOV and fills it one time point at a time.
+    With append=True the frames are added to the end of the existing file instead,
+    extending every dataset along the time axis. Images which are not all after the
+    existing ones are not appended, so the time axis stays in order.
 
-        # load the tif and store it in array
-        with tiff.TiffFile(image_params['filepath']) as tif:
-            image_data = tif.asarray()
+    Parameters
+    ----------
+    image_names : list
+        Keys to analyzed_imgs for each frame, in time order.
+    frames : iterable
+        Yields the [y, x, plane] pixel data for each name in image_names.
+    channel_masks : dict
+        Channel masks for all FOVs.
+    analyzed_imgs : dict
+        Image metadata, as made by get_tif_params.
+    append : boolean
+        Add to the existing file rather than making a new one.
 
-        # channel finding was also done on images after orientation was fixed
-        image_data = fix_orientation(image_data)
+    Returns the number of frames written, 0 if an append was refused.
+
+    Called by
+    hdf5_stack_slice_and_write
+    aux/mm3_nd2ToTIFF.py
+    '''
 
-        # add additional axis if the image is flat
-        if len(image_data.shape) == 2:
-            image_data = np.expand_dims(image_data, 0)
+    frame_count = len(image_names)
 
-        #change axis so it goes X, Y, Plane
-        image_data = np.rollaxis(image_data, 0, 3)
+    # declare identification variables for saving using first image
+    image_params = analyzed_imgs[image_names[0]]
+    fov_id = image_params['fov']
 
-        # add it to list. The images should be in time order
-        image_fov_stack.append(image_data)
+    # make arrays for filenames and times
+    # times is still an integer but may be indexed arbitrarily
+    # jds = julian dates (times)
+    image_times = [analyzed_imgs[image_name]['t'] for image_name in image_names]
+    image_jds = [analyzed_imgs[image_name]['jd'] for image_name in image_names]
+
+    # datasets for each peak, a list with one per color
+    channel_datasets = {}
+
+    if append:
+        h5f = get_h5_file(fov_id, 'r+')
+
+        # new frames go after the ones already there. Frames past the end of 'times'
+        # are left from an append which did not finish, and are written over.
+        start_index = h5f['times'].shape[0]
+        if start_index and min(image_times) <= h5f['times'][start_index-1, 0]:
+            warning('Appended images for FOV %d are not after the existing ones, not appending. '
+                    'Compile again without appending to add them.' % fov_id)
+            flush_h5_file(fov_id)
+            return 0
+
+        # extend the channel datasets, one per color
+        for peak in channel_masks[fov_id].keys():
+            h5g = h5f['channel_%04d' % peak]
+            color_names = sorted([name for name in h5g.keys()
+                                  if re.match(r'p%04d_c\d$' % peak, name)])
+            channel_datasets[peak] = [h5g[name] for name in color_names]
+            for h5ds in channel_datasets[peak]:
+                h5ds.resize(start_index + frame_count, axis=0)
 
-    # concatenate the list into one big ass stack
-    image_fov_stack = np.stack(image_fov_stack, axis=0)
+    else:
+        start_index = 0
 
-    # create the HDF5 file for the FOV, first time this is being done.
-    with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'w', libver='earliest') as h5f:
+        # create the HDF5 file for the FOV, first time this is being done.
+        h5f = get_h5_file(fov_id, 'w')
 
         # add in metadata for this FOV
         # these attributes should be common for all channel
         h5f.attrs.create('fov_id', fov_id)
-        h5f.attrs.create('stage_x_loc', x_loc)
-        h5f.attrs.create('stage_y_loc', y_loc)
-        h5f.attrs.create('image_shape', image_shape)
+        h5f.attrs.create('stage_x_loc', image_params['x'])
+        h5f.attrs.create('stage_y_loc', image_params['y'])
+        h5f.attrs.create('image_shape', image_params['shape'])
         # encoding is because HDF5 has problems with numpy unicode
-        h5f.attrs.create('planes', [plane.encode('utf8') for plane in image_planes])
+        h5f.attrs.create('planes', [plane.encode('utf8') for plane in image_params['planes']])
         h5f.attrs.create('peaks', sorted(channel_masks[fov_id].keys()))
 
-        # this is for things that change across time, for these create a dataset
-        h5ds = h5f.create_dataset(u'filenames', data=np.expand_dims(image_filenames, 1),
+        # this is for things that change across time, for these create a dataset.
+        # They are filled in once the frames are written, see below.
+        h5ds = h5f.create_dataset(u'filenames', shape=(0, 1),
                                   chunks=True, maxshape=(None, 1), dtype='S100',
                                   compression="gzip", shuffle=True, fletcher32=True)
-        h5ds = h5f.create_dataset(u'times', data=np.expand_dims(image_times, 1),
+        h5ds = h5f.create_dataset(u'times', shape=(0, 1),
                                   chunks=True, maxshape=(None, 1),
+                                  dtype=np.asarray(image_times).dtype,
                                   compression="gzip", shuffle=True, fletcher32=True)
-        h5ds = h5f.create_dataset(u'times_jd', data=np.expand_dims(image_jds, 1),
+        h5ds = h5f.create_dataset(u'times_jd', shape=(0, 1),
                                   chunks=True, maxshape=(None, 1),
+                                  dtype=np.asarray(image_jds).dtype,
                                   compression="gzip", shuffle=True, fletcher32=True)
 
+    # closed when done, as it is read by other processes next
+    with h5f:
+        for n, image_data in enumerate(frames):
+            # cut out the channels as per channel masks for this fov
+            for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+                channel_slice = cut_slice(image_data, channel_loc)
+
+                # create the group and datasets once the size of the slice is known
+                if peak not in channel_datasets:
+                    information('Creating datasets for channel peak %d.' % peak)
+
+                    # create group for this channel
+                    h5g = h5f.create_group('channel_%04d' % peak)
+
+                    # add attribute for peak_id, channel location
+                    h5g.attrs.create('peak_id', peak)
+                    h5g.attrs.create('channel_loc', channel_loc)
+
+                    # make a different dataset for all colors. Review docs for these options.
+                    slice_shape = (channel_slice.shape[0], channel_slice.shape[1])
+                    channel_datasets[peak] = [h5g.create_dataset(u'p%04d_c%1d' % (peak, color_index+1),
+                                    shape=(frame_count,) + slice_shape,
+                                    dtype=channel_slice.dtype,
+                                    **get_h5_dataset_options('channels', slice_shape))
+                                    for color_index in range(channel_slice.shape[2])]
+
+                # write this time point for all colors
+                for color_index, h5ds in enumerate(channel_datasets[peak]):
+                    h5ds[start_index + n] = channel_slice[:,:,color_index]
+
+        # the images are only listed once their frames are written, so a run which
+        # stops part way is appended again in full next time
+        for dataset_name, values in ((u'filenames', image_names),
+                                     (u'times', image_times),
+                                     (u'times_jd', image_jds)):
+            h5ds = h5f[dataset_name]
+            h5ds.resize(start_index + frame_count, axis=0)
+            h5ds[start_index:] = np.expand_dims(values, 1).astype(h5ds.dtype)
+
+    return frame_count
+
+# metadata for the FOV group of the zarr store, same as the HDF5 file attributes
+def set_zarr_fov_attrs(fov_id, image_names, analyzed_imgs, peaks):
+    '''Writes the FOV attributes and the per time point filenames, times and
+    julian dates to the .zattrs of the FOV group.
+
+    Called by
+    zarr_stack_slice_and_write
+    save_zarr
+    '''
+
+    image_params = analyzed_imgs[image_names[0]]
+
+    make_zarr_groups(get_zarr_path(fov_id))
+    set_zarr_attrs(fov_id, {'fov_id': int(fov_id),
+                            'stage_x_loc': float(image_params['x']),
+                            'stage_y_loc': float(image_params['y']),
+                            'image_shape': [int(dim) for dim in image_params['shape']],
+                            'planes': [str(plane) for plane in image_params['planes']],
+                            'peaks': sorted([int(peak) for peak in peaks]),
+                            'filenames': list(image_names),
+                            'times': [int(analyzed_imgs[name]['t']) for name in image_names],
+                            'times_jd': [float(analyzed_imgs[name]['jd']) for name in image_names]})
+
+    return
+
+# writes the trap stacks found with Unet to the zarr store
+def save_zarr(imgDict, img_names, analyzed_imgs, fov_id, channel_masks):
+    '''Writes out 4D stacks of images to the zarr store, like save_hdf5.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    set_zarr_fov_attrs(fov_id, img_names, analyzed_imgs, imgDict.keys())
+
+    for peak, channel_stack in six.iteritems(imgDict):
+        channel_stack = channel_stack.astype('uint16')
+
+        # save a different array for all colors
+        for color_index in range(channel_stack.shape[3]):
+            save_zarr_stack(channel_stack[:,:,:,color_index], fov_id,
+                            'channel_%04d/p%04d_c%1d' % (peak, peak, color_index+1), 'channels')
+
+        set_zarr_attrs(fov_id, {'peak_id': int(peak),
+                                'channel_loc': [[int(v) for v in pair]
+                                                for pair in channel_masks[fov_id][peak]]},
+                       'channel_%04d' % peak)
+
+    return
+
+# same thing as hdf5_stack_slice_and_write but for the zarr directory store
+def zarr_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
+    '''Slices the channels out of the TIFF images of one FOV and writes them to the
+    zarr store one time point at a time. Each frame of each channel and color is its
+    own chunk file, so memory use is bounded by a single frame.
+
+    Called by
+    slice_and_write_fov
+    '''
+
+    # [0] is the key, [1] is jd
+    image_names = [image[0] for image in images_to_write]
+    frame_count = len(image_names)
+    fov_id = analyzed_imgs[image_names[0]]['fov']
+
+    set_zarr_fov_attrs(fov_id, image_names, analyzed_imgs, channel_masks[fov_id].keys())
+
+    # array metadata for each peak, a list with one per color
+    channel_arrays = {}
+
+    for n, image_data in enumerate(load_tif_frames(image_names, analyzed_imgs)):
         # cut out the channels as per channel masks for this fov
         for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
-            #information('Slicing and saving channel peak %s.' % channel_filename.split('/')[-1])
-            information('Slicing and saving channel peak %d.' % peak)
+            channel_slice = cut_slice(image_data, channel_loc)
+
+            # create the group and arrays once the size of the slice is known
+            if peak not in channel_arrays:
+                channel_arrays[peak] = []
+                for color_index in range(channel_slice.shape[2]):
+                    array_name = 'channel_%04d/p%04d_c%1d' % (peak, peak, color_index+1)
+                    zarr_meta = create_zarr_array(fov_id, array_name, channel_slice.shape[:2],
+                                                  channel_slice.dtype, 'channels',
+                                                  frame_count=frame_count)
+                    channel_arrays[peak].append((array_name, zarr_meta))
+
+                # add attribute for peak_id, channel location
+                set_zarr_attrs(fov_id, {'peak_id': int(peak),
+                                        'channel_loc': [[int(v) for v in pair]
+                                                        for pair in channel_loc]},
+                               'channel_%04d' % peak)
+
+            # write this time point for all colors
+            for color_index, (array_name, zarr_meta) in enumerate(channel_arrays[peak]):
+                write_zarr_frame(fov_id, array_name, zarr_meta, n, channel_slice[:,:,color_index])
 
-            # create group for this channel
-            h5g = h5f.create_group('channel_%04d' % peak)
+    return
 
-            # add attribute for peak_id, channel location
-            h5g.attrs.create('peak_id', peak)
-            h5g.attrs.create('channel_loc', channel_loc)
+# slices one fov from the raw TIFFs, used by the slicing pool in mm3_Compile
+def slice_and_write_fov(images_to_write, channel_masks, analyzed_imgs, append=False):
+    '''Slices out and saves the channels for one FOV with
+    tiff_stack_slice_and_write, hdf5_stack_slice_and_write or
+    zarr_stack_slice_and_write, depending on params['output'].
+    append is passed on to hdf5_stack_slice_and_write. TIFF and zarr stacks are
+    always rewritten from all of images_to_write.
 
-            # channel masks should only contain ints, but you can use this for a hard fix
-            # for i in range(len(channel_loc)):
-            #     for j in range(len(channel_loc[i])):
-            #         channel_loc[i][j] = int(channel_loc[i][j])
+    Parameters
+    ----------
+    images_to_write : list
+        [image name, t] pairs for the FOV, in time order.
+    channel_masks : dict
+        Channel masks, must contain the FOV.
+    analyzed_imgs : dict
+        Image metadata, must contain the images in images_to_write.
+    append : boolean
+        Only add images which are not yet in the HDF5 file.
 
-            # slice out channel.
-            # The function should recognize the shape length as 4 and cut all time points
-            channel_stack = cut_slice(image_fov_stack, channel_loc)
+    Returns
+    -------
+    slice_info : dict
+        'fov', 'frames' written (only the new ones when appending) and 'seconds'
+        spent slicing, for reporting throughput.
 
-            # save a different dataset for all colors
-            for color_index in range(channel_stack.shape[3]):
+    Called by
+    mm3_Compile.py
+    '''
 
-                # create the dataset for the image. Review docs for these options.
-                h5ds = h5g.create_dataset(u'p%04d_c%1d' % (peak, color_index+1),
-                                data=channel_stack[:,:,:,color_index],
-                                chunks=(1, channel_stack.shape[1], channel_stack.shape[2]),
-                                maxshape=(None, channel_stack.shape[1], channel_stack.shape[2]),
-                                compression="gzip", shuffle=True, fletcher32=True)
+    fov_id = analyzed_imgs[images_to_write[0][0]]['fov']
+    information("Slicing FOV %d with %d frames." % (fov_id, len(images_to_write)))
 
-                # h5ds.attrs.create('plane', image_planes[color_index].encode('utf8'))
+    start_time = time.time()
 
-                # write the data even though we have more to write (free up memory)
-                h5f.flush()
+    frame_count = len(images_to_write)
+    if params['output'] == 'TIFF':
+        tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs)
+    elif params['output'] == 'HDF5':
+        frame_count = hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs,
+                                                 append=append)
+    elif params['output'] == 'zarr':
+        zarr_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs)
+
+    return {'fov': fov_id,
+            'frames': frame_count,
+            'seconds': time.time() - start_time}
+
+# decide how many fovs can be sliced at once
+def get_slicing_processes(image_params, fov_count):
+    '''Finds the number of processes to use for slicing, capped by
+    params['num_analyzers'], the number of FOVs and the memory budget.
+
+    Each slicing process holds about one raw frame at a time, plus decoding
+    and write buffers. The budget is params['compile']['slicing_memory_gb'],
+    which defaults to half of the physical memory.
 
-    return
+    Parameters
+    ----------
+    image_params : dict
+        Metadata of one raw image, used for the frame size.
+    fov_count : int
+        Number of FOVs to slice.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    # raw frames are 16 bit. Allow for decoding copies and the HDF5 chunk caches
+    frame_bytes = np.prod(image_params['shape']) * max(len(image_params['planes']), 1) * 2
+    process_bytes = 3 * frame_bytes + 64 * 2**20
+
+    memory_budget = params['compile'].get('slicing_memory_gb', None)
+    if memory_budget in (None, 'None'):
+        try:
+            memory_budget = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2.
+        except (ValueError, AttributeError, OSError):
+            memory_budget = None
+    else:
+        memory_budget = float(memory_budget) * 2**30
+
+    processes = min(params['num_analyzers'], fov_count)
+    if memory_budget:
+        processes = min(processes, int(memory_budget // process_bytes))
+
+    return max(processes, 1)
 
 def tileImage(img, subImageNumber):
+    '''Cuts a square image into subImageNumber square tiles, ordered row by row.
+    The inverse is untileImage.'''
     divisor = int(np.sqrt(subImageNumber))
     M = img.shape[0]//divisor
-    N = img.shape[0]//divisor
+    N = img.shape[1]//divisor
     #print(img.shape, M, N, divisor, subImageNumber)
-    tiles = np.asarray([img[x:x+M,y:y+N] for x in range(0,img.shape[0],M) for y in range(0,img.shape[1],N)])
+    # split each axis into (tile index, pixel in tile) and bring the tile indices together
+    tiles = img[:divisor*M,:divisor*N].reshape(divisor, M, divisor, N)
+    tiles = tiles.swapaxes(1, 2).reshape(divisor*divisor, M, N)
     return(tiles)
 
+def untileImage(tiles, subImageNumber):
+    '''Puts tiles made by tileImage back together. tiles has shape
+    (image number * subImageNumber, tile height, tile width, features) and the
+    result has shape (image number, height, width, features).'''
+    divisor = int(np.sqrt(subImageNumber))
+    imageNum = tiles.shape[0]//subImageNumber
+    M, N, featureNum = tiles.shape[1], tiles.shape[2], tiles.shape[3]
+    # the reverse of tileImage, with the image and feature axes carried along
+    bigImg = tiles.reshape(imageNum, divisor, divisor, M, N, featureNum)
+    bigImg = bigImg.transpose(0, 1, 3, 2, 4, 5).reshape(imageNum, divisor*M, divisor*N, featureNum)
+    return(bigImg.astype('float32', copy=False))
+
 def get_weights(img, subImageNumber):
     divisor = int(np.sqrt(subImageNumber))
     M = img.shape[0]//divisor
@@ -965,81 +2233,6 @@ def permute_image(img, trap_align_metadata):
 
     return(img)
 
-def imageConcatenatorFeatures(imgStack, subImageNumber = 64):
-
-    rowNumPerImage = int(np.sqrt(subImageNumber)) # here I'm assuming our large images are square, with equal number of crops in each dimension
-    #print(rowNumPerImage)
-    imageNum = int(imgStack.shape[0]/subImageNumber) # total number of sub-images divided by the number of sub-images in each original large image
-    iterNum = int(imageNum*rowNumPerImage)
-    imageDims = int(np.sqrt(imgStack.shape[1]*imgStack.shape[2]*subImageNumber))
-    featureNum = int(imgStack.shape[3])
-    bigImg = np.zeros(shape=(imageNum, imageDims, imageDims, featureNum), dtype='float32') # create array to store reconstructed images
-
-    featureRowDicts = []
-
-    for j in range(featureNum):
-
-        rowDict = {}
-
-        for i in range(iterNum):
-            baseNum = int(i*iterNum/imageNum)
-            # concatenate columns of 256x256 images to build each 256x2048 row
-            rowDict[i] = np.column_stack((imgStack[baseNum,:,:,j],imgStack[baseNum+1,:,:,j],
-                                          imgStack[baseNum+2,:,:,j], imgStack[baseNum+3,:,:,j]))#,
-                                          #imgStack[baseNum+4,:,:,j],imgStack[baseNum+5,:,:,j],
-                                          #imgStack[baseNum+6,:,:,j],imgStack[baseNum+7,:,:,j]))
-        featureRowDicts.append(rowDict)
-
-    for j in range(featureNum):
-
-        for i in range(imageNum):
-            baseNum = int(i*rowNumPerImage)
-            # concatenate appropriate 256x2048 rows to build a 2048x2048 image and place it into bigImg
-            bigImg[i,:,:,j] = np.row_stack((featureRowDicts[j][baseNum],featureRowDicts[j][baseNum+1],
-                                            featureRowDicts[j][baseNum+2],featureRowDicts[j][baseNum+3]))#,
-                                            #featureRowDicts[j][baseNum+4],featureRowDicts[j][baseNum+5],
-                                            #featureRowDicts[j][baseNum+6],featureRowDicts[j][baseNum+7]))
-
-    return(bigImg)
-
-def imageConcatenatorFeatures2(imgStack, subImageNumber = 81):
-
-    rowNumPerImage = int(np.sqrt(subImageNumber)) # here I'm assuming our large images are square, with equal number of crops in each dimension
-    imageNum = int(imgStack.shape[0]/subImageNumber) # total number of sub-images divided by the number of sub-images in each original large image
-    iterNum = int(imageNum*rowNumPerImage)
-    imageDims = int(np.sqrt(imgStack.shape[1]*imgStack.shape[2]*subImageNumber))
-    featureNum = int(imgStack.shape[3])
-    bigImg = np.zeros(shape=(imageNum, imageDims, imageDims, featureNum), dtype='float32') # create array to store reconstructed images
-
-    featureRowDicts = []
-
-    for j in range(featureNum):
-
-        rowDict = {}
-
-        for i in range(iterNum):
-            baseNum = int(i*iterNum/imageNum)
-            # concatenate columns of 256x256 images to build each 256x2048 row
-            rowDict[i] = np.column_stack((imgStack[baseNum,:,:,j],imgStack[baseNum+1,:,:,j],
-                                          imgStack[baseNum+2,:,:,j], imgStack[baseNum+3,:,:,j],
-                                          imgStack[baseNum+4,:,:,j]))#,imgStack[baseNum+5,:,:,j],
-                                          #imgStack[baseNum+6,:,:,j],imgStack[baseNum+7,:,:,j],
-                                         #imgStack[baseNum+8,:,:,j]))
-        featureRowDicts.append(rowDict)
-
-    for j in range(featureNum):
-
-        for i in range(imageNum):
-            baseNum = int(i*rowNumPerImage)
-            # concatenate appropriate 256x2048 rows to build a 2048x2048 image and place it into bigImg
-            bigImg[i,:,:,j] = np.row_stack((featureRowDicts[j][baseNum],featureRowDicts[j][baseNum+1],
-                                            featureRowDicts[j][baseNum+2],featureRowDicts[j][baseNum+3],
-                                            featureRowDicts[j][baseNum+4]))#,featureRowDicts[j][baseNum+5],
-                                            #featureRowDicts[j][baseNum+6],featureRowDicts[j][baseNum+7],
-                                            #featureRowDicts[j][baseNum+8]))
-
-    return(bigImg)
-
 def get_weights_array(arr=np.zeros((2048,2048)), shiftDistance=128, subImageNumber=64, padSubImageNumber=81):
 
     originalImageWeights = get_weights(arr, subImageNumber=subImageNumber)
@@ -1116,8 +2309,17 @@ def predict_first_image_channels(img, model,
                                mode='constant', constant_values=((0,0),(0,0)))[:-shiftDistance,:]
     #print(imgStackShiftUp.shape)
 
-    crops = tileImage(imgStack, subImageNumber=subImageNumber)
-    crops = np.expand_dims(crops, -1)
+    # tile all six versions of the image and run them through the model together.
+    # Tile sets with the same tile size share one generator and one prediction call,
+    # and each tile is normalized on its own so the results are the same. The tiles
+    # of the expanded image are only the same size as the others for some image
+    # sizes and shifts (e.g. 2048 with a shift of 256), otherwise they go on their own.
+    allCrops = [tileImage(imgStack, subImageNumber=subImageNumber),
+                tileImage(imgStackExpand, subImageNumber=padSubImageNumber),
+                tileImage(imgStackShiftLeft, subImageNumber=subImageNumber),
+                tileImage(imgStackShiftRight, subImageNumber=subImageNumber),
+                tileImage(imgStackShiftUp, subImageNumber=subImageNumber),
+                tileImage(imgStackShiftDown, subImageNumber=subImageNumber)]
 
     data_gen_args = {'batch_size':params['compile']['channel_prediction_batch_size'],
                          'n_channels':1,
@@ -1127,52 +2329,53 @@ def predict_first_image_channels(img, model,
                         'use_multiprocessing':True,
                         'workers':params['num_analyzers']}
 
-    img_generator = TrapSegmentationDataGenerator(crops, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    prediction = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
+    tileShapes = []
+    for cropSet in allCrops:
+        if cropSet.shape[1:] not in tileShapes:
+            tileShapes.append(cropSet.shape[1:])
+
+    allPredictionSets = [None] * len(allCrops)
+    for tileShape in tileShapes:
+        setIndexes = [n for n, cropSet in enumerate(allCrops) if cropSet.shape[1:] == tileShape]
+        cropBounds = np.cumsum([0] + [allCrops[n].shape[0] for n in setIndexes])
+        shapeCrops = np.expand_dims(np.concatenate([allCrops[n] for n in setIndexes], axis=0), -1)
+
+        img_generator = TrapSegmentationDataGenerator(shapeCrops, **data_gen_args)
+        shapePredictions = model.predict_generator(img_generator, **predict_gen_args)
+
+        # scatter the tile predictions back to their versions of the image
+        for m, n in enumerate(setIndexes):
+            allPredictionSets[n] = shapePredictions[cropBounds[m]:cropBounds[m+1]]
+
+    predictions = allPredictionSets[0]
+    prediction = untileImage(predictions, subImageNumber=subImageNumber)
     #print(prediction.shape)
 
-    cropsExpand = tileImage(imgStackExpand, subImageNumber=padSubImageNumber)
-    cropsExpand = np.expand_dims(cropsExpand, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsExpand, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionExpand = imageConcatenatorFeatures2(predictions, subImageNumber=padSubImageNumber)
+    predictions = allPredictionSets[1]
+    predictionExpand = untileImage(predictions, subImageNumber=padSubImageNumber)
     predictionExpand = util.crop(predictionExpand, ((0,0),(shiftDistance,shiftDistance),(shiftDistance,shiftDistance),(0,0)))
     #print(predictionExpand.shape)
 
-    cropsShiftLeft = tileImage(imgStackShiftLeft, subImageNumber=subImageNumber)
-    cropsShiftLeft = np.expand_dims(cropsShiftLeft, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftLeft, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionLeft = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
+    predictions = allPredictionSets[2]
+    predictionLeft = untileImage(predictions, subImageNumber=subImageNumber)
     predictionLeft = np.pad(predictionLeft, pad_width=((0,0),(0,0),(0,shiftDistance),(0,0)),
                       mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:,shiftDistance:,:]
     #print(predictionLeft.shape)
 
-    cropsShiftRight = tileImage(imgStackShiftRight, subImageNumber=subImageNumber)
-    cropsShiftRight = np.expand_dims(cropsShiftRight, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftRight, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionRight = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
+    predictions = allPredictionSets[3]
+    predictionRight = untileImage(predictions, subImageNumber=subImageNumber)
     predictionRight = np.pad(predictionRight, pad_width=((0,0),(0,0),(shiftDistance,0),(0,0)),
                       mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:,:(-1*shiftDistance),:]
     #print(predictionRight.shape)
 
-    cropsShiftUp = tileImage(imgStackShiftUp, subImageNumber=subImageNumber)
-    #print(cropsShiftUp.shape)
-    cropsShiftUp = np.expand_dims(cropsShiftUp, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftUp, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionUp = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
+    predictions = allPredictionSets[4]
+    predictionUp = untileImage(predictions, subImageNumber=subImageNumber)
     predictionUp = np.pad(predictionUp, pad_width=((0,0),(0,shiftDistance),(0,0),(0,0)),
                       mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,shiftDistance:,:,:]
     #print(predictionUp.shape)
 
-    cropsShiftDown = tileImage(imgStackShiftDown, subImageNumber=subImageNumber)
-    cropsShiftDown = np.expand_dims(cropsShiftDown, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftDown, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionDown = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
+    predictions = allPredictionSets[5]
+    predictionDown = untileImage(predictions, subImageNumber=subImageNumber)
     predictionDown = np.pad(predictionDown, pad_width=((0,0),(shiftDistance,0),(0,0),(0,0)),
                       mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:(-1*shiftDistance),:,:]
     #print(predictionDown.shape)
@@ -1219,29 +2422,64 @@ def get_frame_trap_bounding_boxes(trapLabels, trapProps, trapAreaThreshold=2000,
 
     return(trapBboxes)
 
+# yields results of a read function in order while threads read ahead
+def prefetch(read_function, items, read_ahead=4):
+    '''Calls read_function on each item in a thread pool and yields the results in
+    the order of items. At most read_ahead items are being read or waiting to be
+    used at once, which bounds memory, and reading overlaps with whatever the caller
+    does with each result.
+
+    Called by
+    crop_traps
+    '''
+
+    with ThreadPoolExecutor(max_workers=read_ahead) as executor:
+        items = iter(items)
+        pending = collections.deque(executor.submit(read_function, item)
+                                    for item in itertools.islice(items, read_ahead))
+
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(executor.submit(read_function, item))
+            yield result
+
+# reads a raw image for crop_traps with the planes last
+def read_trap_frame(imgPath):
+    fullFrameImg = io.imread(imgPath)
+    if len(fullFrameImg.shape) == 3:
+        if fullFrameImg.shape[0] < 3: # for tifs with less than three imaging channels, the first dimension separates channels
+            fullFrameImg = np.transpose(fullFrameImg, (1,2,0))
+    return fullFrameImg
+
 # this function performs image alignment as defined by the shifts passed as an argument
 def crop_traps(fileNames, trapProps, labelledTraps, bboxesDict, trap_align_metadata):
 
     frameNum = trap_align_metadata['frame_count']
     channelNum = trap_align_metadata['plane_number']
-    trapImagesDict = {key:np.zeros((frameNum,
-                                       trap_align_metadata['trap_height'],
-                                       trap_align_metadata['trap_width'],
-                                       channelNum)) for key in bboxesDict}
+    trapImagesDict = None # allocated with the dtype of the first frame
     trapClosedEndPxDict = {}
     flipImageDict = {}
     trapMask = labelledTraps
 
-    for frame in range(frameNum):
+    # frames are read by a few threads ahead of the cropping
+    imgPaths = [os.path.join(params['experiment_directory'],params['image_directory'],fileName)
+                for fileName in fileNames[:frameNum]]
+    frameReader = prefetch(read_trap_frame, imgPaths,
+                           read_ahead=params['compile'].get('read_ahead_frames', 4))
+
+    for frame, fullFrameImg in enumerate(frameReader):
 
         if (frame+1) % 20 == 0:
             print("Cropping trap regions for frame number {} of {}.".format(frame+1, frameNum))
 
-        imgPath = os.path.join(params['experiment_directory'],params['image_directory'],fileNames[frame])
-        fullFrameImg = io.imread(imgPath)
-        if len(fullFrameImg.shape) == 3:
-            if fullFrameImg.shape[0] < 3: # for tifs with less than three imaging channels, the first dimension separates channels
-                fullFrameImg = np.transpose(fullFrameImg, (1,2,0))
+        # keep the trap stacks in the image dtype (usually uint16) rather than float64
+        if trapImagesDict is None:
+            trapImagesDict = {key:np.zeros((frameNum,
+                                               trap_align_metadata['trap_height'],
+                                               trap_align_metadata['trap_width'],
+                                               channelNum), dtype=fullFrameImg.dtype) for key in bboxesDict}
+
         trapClosedEndPxDict[fileNames[frame]] = {key:{} for key in bboxesDict.keys()}
 
         for key in trapImagesDict.keys():
@@ -1303,6 +2541,142 @@ def shift_bounding_boxes(bboxesDict, shifts, imgSize):
 
     return(bboxesShiftDict)
 
+# estimate rigid drift between frames by phase correlation
+def get_drift_phase_correlation(image_stack, batch_size=16):
+    '''Returns the (row, column) shift of each image in a stack relative to the first,
+    found by phase correlation. The shift is how far the image content has moved,
+    the same sense as the change in trap centroids.
+
+    Parameters
+    ----------
+    image_stack : np.array
+        Shape (frames, y, x).
+    batch_size : int
+        Number of frames Fourier transformed at once.
+
+    Returns
+    -------
+    shifts : np.array
+        Float array of shape (frames, 2), with subpixel precision.
+
+    For the images of an FOV use get_fov_drift, which does not hold them all in memory.
+    '''
+
+    frame_count = image_stack.shape[0]
+    drift_reference = get_drift_reference(image_stack[0])
+
+    shifts = np.zeros((frame_count, 2))
+    for start in range(0, frame_count, batch_size):
+        shifts[start:start+batch_size] = get_drift_batch(image_stack[start:start+batch_size],
+                                                         drift_reference)
+
+    return shifts
+
+# the window and Fourier transform of the reference image for phase correlation
+def get_drift_reference(reference):
+    '''Returns (window, reference_fft) for get_drift_batch, from the (y, x) image
+    the drift is measured against.
+
+    Called by
+    get_drift_phase_correlation
+    get_fov_drift
+    '''
+    rows, cols = reference.shape
+
+    # a window keeps the image borders from dominating the correlation
+    window = np.outer(np.hanning(rows), np.hanning(cols))
+
+    reference = reference.astype(np.float64)
+    reference_fft = np.conj(np.fft.fft2((reference - reference.mean()) * window))
+
+    return window, reference_fft
+
+# phase correlation of a batch of frames against the reference
+def get_drift_batch(frames, drift_reference):
+    '''Returns the (frames, 2) float shifts of a (frames, y, x) batch relative to
+    the reference of get_drift_reference, see get_drift_phase_correlation.
+
+    Called by
+    get_drift_phase_correlation
+    get_fov_drift
+    '''
+    window, reference_fft = drift_reference
+    rows, cols = window.shape
+
+    frames = frames.astype(np.float64)
+    frames -= frames.mean(axis=(1,2), keepdims=True)
+    cross_power = np.fft.fft2(frames * window, axes=(1,2)) * reference_fft
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.ifft2(cross_power, axes=(1,2)).real
+
+    shifts = np.zeros((correlation.shape[0], 2))
+    for n in range(correlation.shape[0]):
+        corr = correlation[n]
+        peak_row, peak_col = np.unravel_index(np.argmax(corr), corr.shape)
+
+        # refine the peak with a parabola in each direction, wrapping at the edges
+        offsets = []
+        for before, center, after in [(corr[peak_row-1, peak_col], corr[peak_row, peak_col],
+                                       corr[(peak_row+1) % rows, peak_col]),
+                                      (corr[peak_row, peak_col-1], corr[peak_row, peak_col],
+                                       corr[peak_row, (peak_col+1) % cols])]:
+            denom = before - 2 * center + after
+            offsets.append(0.5 * (before - after) / denom if denom != 0 else 0.)
+
+        shift_row = peak_row + offsets[0]
+        shift_col = peak_col + offsets[1]
+        # shifts past the middle wrap around and are negative
+        if shift_row > rows / 2:
+            shift_row -= rows
+        if shift_col > cols / 2:
+            shift_col -= cols
+        shifts[n] = (shift_row, shift_col)
+
+    return shifts
+
+# find the drift of all frames of an FOV for Unet compile
+def get_fov_drift(fov_id, fov_file_names, trap_align_metadata):
+    '''Loads a central crop of the phase plane of each image of an FOV and returns the
+    integer shifts of the images relative to the first, for shift_bounding_boxes.
+    This replaces running the trap model on every frame when compile: alignment_method
+    is 'phase_correlation'.
+
+    The crop size is compile: alignment_crop_size (default 1024 pixels). Crops are
+    read and correlated compile: alignment_batch_size (default 16) frames at a time,
+    so only one batch is in memory.
+
+    Called by
+    mm3_Compile.py __main__
+    '''
+
+    crop_size = params['compile'].get('alignment_crop_size', 1024)
+    batch_size = params['compile'].get('alignment_batch_size', 16)
+
+    # central crop of the phase plane of an image
+    def read_align_region(fn):
+        frame_img = io.imread(os.path.join(params['TIFF_dir'], fn))
+        # detect if there are multiple imaging channels, keeping only the phase image
+        frame_img = permute_image(frame_img, trap_align_metadata)
+
+        crop_rows = min(crop_size, frame_img.shape[0])
+        crop_cols = min(crop_size, frame_img.shape[1])
+        row_start = (frame_img.shape[0] - crop_rows) // 2
+        col_start = (frame_img.shape[1] - crop_cols) // 2
+        return frame_img[row_start:row_start+crop_rows, col_start:col_start+crop_cols]
+
+    # the first frame is the reference for all batches
+    drift_reference = get_drift_reference(read_align_region(fov_file_names[0]))
+
+    shifts = np.zeros((len(fov_file_names), 2))
+    for start in range(0, len(fov_file_names), batch_size):
+        align_regions = np.stack([read_align_region(fn)
+                                  for fn in fov_file_names[start:start+batch_size]], axis=0)
+        shifts[start:start+batch_size] = get_drift_batch(align_regions, drift_reference)
+    information('Found drift for FOV %d, largest shift is %.1f pixels.'
+                % (fov_id, np.max(np.abs(shifts))))
+
+    return np.round(shifts).astype('int16')
+
 # finds the location of channels in a tif
 def find_channel_locs(image_data):
     '''Finds the location of channels from a phase contrast image. The channels are returned in
@@ -1319,15 +2693,13 @@ def find_channel_locs(image_data):
     chan_w = params['compile']['channel_width']
     chan_sep = params['compile']['channel_separation']
     crop_wp = int(params['compile']['channel_width_pad'] + chan_w/2)
-    chan_snr = params['compile']['channel_detection_snr']
 
     # Detect peaks in the x projection (i.e. find the channels)
     projection_x = image_data.sum(axis=0).astype(np.int32)
-    # find_peaks_cwt is a function which attempts to find the peaks in a 1-D array by
-    # convolving it with a wave. here the wave is the default Mexican hat wave
-    # but the minimum signal to noise ratio is specified
-    # *** The range here should be a parameter or changed to a fraction.
-    peaks = find_peaks_cwt(projection_x, np.arange(chan_w-5,chan_w+5), min_snr=chan_snr)
+    if params['compile'].get('channel_detection_method', 'cwt') == 'fft':
+        peaks = find_channel_peaks_fft(projection_x)
+    else:
+        peaks = find_channel_peaks_cwt(projection_x)
 
     # If the left-most peak position is within half of a channel separation,
     # discard the channel from the list.
@@ -1382,6 +2754,107 @@ def find_channel_locs(image_data):
 
     return chnl_loc_dict
 
+# find channel x positions with a wavelet transform
+def find_channel_peaks_cwt(projection_x):
+    '''Returns the x positions of channels in the x projection of a phase image.
+
+    Called by
+    find_channel_locs
+    find_channel_peaks_fft
+    '''
+
+    chan_w = params['compile']['channel_width']
+    chan_snr = params['compile']['channel_detection_snr']
+
+    # find_peaks_cwt is a function which attempts to find the peaks in a 1-D array by
+    # convolving it with a wave. here the wave is the default Mexican hat wave
+    # but the minimum signal to noise ratio is specified
+    # *** The range here should be a parameter or changed to a fraction.
+    peaks = find_peaks_cwt(projection_x, np.arange(chan_w-5,chan_w+5), min_snr=chan_snr)
+
+    return np.asarray(peaks, dtype=int)
+
+# find channel x positions from the period of the channels
+def find_channel_peaks_fft(projection_x):
+    '''Returns the x positions of channels in the x projection of a phase image,
+    using that channels are evenly spaced by about channel_separation.
+
+    The period and phase of the channels come from the Fourier transform of the
+    projection. This gives a comb of expected positions, each of which is moved to the
+    nearest maximum of the smoothed projection. Positions where the channel does not
+    stand out from the noise by channel_detection_snr are dropped, e.g. at gaps in the
+    device. This is much faster than find_peaks_cwt, which convolves the projection
+    with ten wavelets.
+
+    If no periodic signal is found it falls back to find_peaks_cwt.
+
+    Called by
+    find_channel_locs
+    '''
+
+    chan_w = params['compile']['channel_width']
+    chan_sep = params['compile']['channel_separation']
+    chan_snr = params['compile']['channel_detection_snr']
+
+    # remove the background, which varies on scales longer than the channel spacing
+    projection_x = projection_x.astype(np.float64)
+    background = ndi.uniform_filter1d(projection_x, size=2*chan_sep+1, mode='reflect')
+    signal = projection_x - background
+    smoothed = ndi.uniform_filter1d(signal, size=max(chan_w//2, 1), mode='reflect')
+
+    # look for the spectral peak near the expected channel spacing
+    n_px = signal.shape[0]
+    spectrum = np.abs(np.fft.rfft(signal * np.hanning(n_px)))
+    freqs = np.fft.rfftfreq(n_px)
+    in_range = np.where((freqs > 0.75 / chan_sep) & (freqs < 1.33 / chan_sep))[0]
+    if len(in_range) == 0:
+        warning('No channel period found, using find_peaks_cwt.')
+        return find_channel_peaks_cwt(projection_x)
+    k = in_range[np.argmax(spectrum[in_range])]
+
+    # refine the frequency with a parabola through the neighboring bins
+    if 0 < k < len(spectrum) - 1:
+        left, center, right = spectrum[k-1], spectrum[k], spectrum[k+1]
+        denom = left - 2 * center + right
+        offset = 0.5 * (left - right) / denom if denom != 0 else 0.
+    else:
+        offset = 0.
+    period = n_px / (k + offset)
+
+    # phase of the channel pattern at the refined frequency
+    x = np.arange(n_px)
+    coeff = np.sum(signal * np.exp(-2j * np.pi * x / period))
+    first_peak = (-np.angle(coeff) / (2 * np.pi) * period) % period
+
+    # the noise level for judging peaks is from the unsmoothed residual
+    residual = signal - smoothed
+    noise = 1.4826 * np.median(np.abs(residual - np.median(residual)))
+    noise = max(noise, 1e-6)
+
+    # move every position of the comb to the nearest local maximum
+    search_w = max(int(period / 4), 1)
+    peaks = []
+    for expected in np.arange(first_peak, n_px, period):
+        expected = int(round(expected))
+        lo, hi = max(expected - search_w, 0), min(expected + search_w + 1, n_px)
+        if hi <= lo:
+            continue
+        peak = lo + int(np.argmax(smoothed[lo:hi]))
+
+        # compare the peak height to the lowest point on either side
+        neighborhood = smoothed[max(peak - int(period / 2), 0):min(peak + int(period / 2) + 1, n_px)]
+        if smoothed[peak] - neighborhood.min() < chan_snr * noise:
+            continue
+        if peaks and peak - peaks[-1] < period / 2:
+            continue
+        peaks.append(peak)
+
+    if not peaks:
+        warning('No channels found with the FFT detector, using find_peaks_cwt.')
+        return find_channel_peaks_cwt(projection_x)
+
+    return np.asarray(peaks, dtype=int)
+
 # make masks from initial set of images (same images as clusters)
 def make_masks(analyzed_imgs):
     '''
@@ -1627,12 +3100,15 @@ def fix_orientation(image_data):
 
     # setting image_orientation to 'auto' will use autodetection
     if image_orientation == "auto":
-         # use 'phase_plane' to find the phase plane in image_data, assuming c1, c2, c3... naming scheme here.
-        try:
-            ph_channel = int(re.search('[0-9]', params['phase_plane']).group(0)) - 1
-        except:
-            # Pick the plane to analyze with the highest mean px value (should be phase)
-            ph_channel = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
+        if flat:
+            ph_channel = 0 # a single plane is taken to be phase
+        else:
+            # use 'phase_plane' to find the phase plane in image_data, assuming c1, c2, c3... naming scheme here.
+            try:
+                ph_channel = int(re.search('[0-9]', params['phase_plane']).group(0)) - 1
+            except:
+                # Pick the plane to analyze with the highest mean px value (should be phase)
+                ph_channel = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
 
         # flip based on the index of the higest average row value
         # this should be closer to the opening
@@ -1643,7 +3119,7 @@ def fix_orientation(image_data):
 
     # flip if up is chosen
     elif image_orientation == "up":
-        return image_data[:,::-1,:]
+        image_data = image_data[:,::-1,:]
 
     # do not flip the images if "down is the specified image orientation"
     elif image_orientation == "down":
@@ -1694,12 +3170,12 @@ def cut_slice(image_data, channel_loc):
     channel_slice = image_data[channel_slicer]
 
     # pad y of channel if slice happened to be outside of image
-    y_difference  = (channel_loc[0][1] - channel_loc[0][0]) - channel_slice.shape[1]
+    # y is the first axis unless there is a time axis
+    y_axis = 1 if len(image_data.shape) == 4 else 0
+    y_difference  = (channel_loc[0][1] - channel_loc[0][0]) - channel_slice.shape[y_axis]
     if y_difference > 0:
-        paddings = [[0, 0], # t
-                    [0, y_difference], # y
-                    [0, 0], # x
-                    [0, 0]] # c
+        paddings = [[0, 0] for axis in channel_slice.shape]
+        paddings[y_axis] = [0, y_difference]
         channel_slice = np.pad(channel_slice, paddings, mode='edge')
 
     return channel_slice
@@ -1720,32 +3196,185 @@ def channel_xcorr(fov_id, peak_id):
     # Use this number of images to calculate cross correlations
     number_of_images = 20
 
-    # load the phase contrast images
-    image_data = load_stack(fov_id, peak_id, color=params['phase_plane'])
+    # if there are more images than number_of_images, use number_of_images images evenly
+    # spaced across the range
+    frame_count = get_stack_shape(fov_id, peak_id, color=params['phase_plane'])[0]
+    frames = None
+    if frame_count > number_of_images:
+        spacing = int(frame_count / number_of_images)
+        frames = slice(0, spacing * number_of_images, spacing)
+
+    # load only those phase contrast images
+    image_data = load_stack(fov_id, peak_id, color=params['phase_plane'], frames=frames)
+
+    # we will compare all images to this one, needs to be padded to account for image drift
+    first_img = np.pad(image_data[0,:,:], pad_size, mode='reflect')
+
+    xcorr_array = [] # array holds cross correlation vaues
+    for img in image_data:
+        # use match_template to find all cross correlations for the
+        # current image against the first image.
+        xcorr_array.append(np.max(match_template(first_img, img)))
+
+    return xcorr_array
+
+### functions for stage manifests
+# Each output of empties, subtract and segment has a manifest in
+# ana_dir/manifests/<stage>/, recording the checksums of the input stacks, the
+# parameters the stage uses and a hash of its code. When a stage is run again
+# and all of these are unchanged, and the output is still what was written,
+# the unit is skipped. Changing a segmentation parameter redoes segmentation,
+# but not subtraction. Set params['force_recompute'] to redo everything.
+#
+# Stacks written with a manifest carry their checksum with them (an HDF5 or
+# zarr attribute, or a file in manifests/checksums for TIFF), so the next stage
+# does not need to read them to know if they changed.
+
+# parameters and functions each stage depends on
+manifest_stages = {'empties': {'params': [('subtract', 'alignment_pad')],
+                               'code': ['average_empties_stack', 'average_empties_block',
+                                        'get_alignment_offsets', 'window_sum_stack',
+                                        'reflect_index', 'shift_stack']},
+                   'subtract': {'params': [('subtract', 'alignment_pad')],
+                                'code': ['subtract_fov_stack', 'subtract_frames', 'subtract_phase_stack',
+                                         'get_alignment_offsets', 'window_sum_stack',
+                                         'reflect_index', 'shift_stack',
+                                         'subtract_fluor_stack', 'subtract_fluor']},
+                   'segment': {'params': [('segment', 'min_object_size'), ('segment', 'otsu')],
+                               'code': ['segment_chnl_stack', 'segment_image']}}
+
+# checksum of an image stack
+def hash_stack(img_stack):
+    stack_hash = hashlib.sha1()
+    stack_hash.update(('%s %s' % (img_stack.dtype.str, img_stack.shape)).encode('utf8'))
+    stack_hash.update(np.ascontiguousarray(img_stack).data)
+    return stack_hash.hexdigest()
+
+# hash of the code of a stage
+def get_manifest_code_hash(stage):
+    code_hash = hashlib.sha1()
+    for function_name in manifest_stages[stage]['code']:
+        code_hash.update(inspect.getsource(globals()[function_name]).encode('utf8'))
+    return code_hash.hexdigest()
+
+# the parameters a stage uses
+def get_manifest_params(stage, extra_params=None):
+    stage_params = {}
+    for section, key in manifest_stages[stage]['params']:
+        stage_params['%s.%s' % (section, key)] = params[section].get(key, None)
+    if extra_params:
+        stage_params.update(extra_params)
+    # through json so it compares equal to what is read back
+    return json.loads(json.dumps(stage_params, sort_keys=True))
+
+# file holding the checksum of a TIFF stack
+def get_tif_checksum_path(fov_id, peak_id, color):
+    return os.path.join(params['ana_dir'], 'manifests', 'checksums',
+                        os.path.basename(get_stack_tif_path(fov_id, peak_id, color)) + '.json')
+
+# get the checksum stored with a stack, or work it out
+def get_stack_checksum(fov_id, peak_id, color):
+    '''Returns the checksum of a stack, None if it does not exist.'''
+
+    array_name = get_stack_array_name(peak_id, color)
+    checksum = None
+
+    try:
+        if params['output'] == 'TIFF':
+            checksum_path = get_tif_checksum_path(fov_id, peak_id, color)
+            if os.path.exists(checksum_path):
+                with open(checksum_path, 'r') as checksum_file:
+                    stored = json.load(checksum_file)
+                # only good if the file was not written again since
+                if stored['stamp'] == list(get_stack_stamp(fov_id, peak_id, color)):
+                    checksum = stored['sha1']
+        elif params['output'] == 'HDF5':
+            with read_h5_file(fov_id) as h5f:
+                if 'sha1' in h5f[array_name].attrs:
+                    checksum = decode_h5_string(h5f[array_name].attrs['sha1'])
+        elif params['output'] == 'zarr':
+            checksum = get_zarr_attrs(fov_id, array_name).get('sha1', None)
+
+        if checksum is None:
+            checksum = hash_stack(load_stack(fov_id, peak_id, color=color))
+    except (IOError, OSError, KeyError, TypeError):
+        return None # no such stack
+
+    return checksum
+
+# store the checksum with a stack
+def set_stack_checksum(fov_id, peak_id, color, checksum):
+    if params['output'] == 'TIFF':
+        checksum_path = get_tif_checksum_path(fov_id, peak_id, color)
+        if not os.path.exists(os.path.dirname(checksum_path)):
+            os.makedirs(os.path.dirname(checksum_path))
+        write_json_atomic(checksum_path, {'sha1': checksum,
+                                          'stamp': list(get_stack_stamp(fov_id, peak_id, color))})
+    elif params['output'] == 'HDF5':
+        get_h5_file(fov_id, 'r+')[get_stack_array_name(peak_id, color)].attrs['sha1'] = checksum.encode('utf8')
+        flush_h5_file(fov_id)
+    elif params['output'] == 'zarr':
+        set_zarr_attrs(fov_id, {'sha1': checksum}, get_stack_array_name(peak_id, color))
+
+# path of the manifest of an output
+def get_manifest_path(stage, fov_id, peak_id, color):
+    if peak_id is None:
+        unit_name = 'xy%03d_%s.json' % (fov_id, color)
+    else:
+        unit_name = 'xy%03d_p%04d_%s.json' % (fov_id, peak_id, color)
+    return os.path.join(params['ana_dir'], 'manifests', stage, unit_name)
+
+# what the manifest of an output should say if it is up to date
+def make_manifest(stage, fov_id, inputs, extra_params=None):
+    '''inputs is a list of (peak_id, color) stacks of the FOV the output is made from.'''
+    return {'inputs': dict([('%s_%s' % (peak_id, color), get_stack_checksum(fov_id, peak_id, color))
+                            for peak_id, color in inputs]),
+            'params': get_manifest_params(stage, extra_params),
+            'code': get_manifest_code_hash(stage)}
+
+# check if an output can be skipped
+def is_output_up_to_date(stage, fov_id, peak_id, color, manifest):
+    '''Returns True if the manifest stored for the output matches manifest (made
+    with make_manifest) and the output is still the stack which was written.'''
+
+    if params.get('force_recompute', False):
+        return False
+
+    manifest_path = get_manifest_path(stage, fov_id, peak_id, color)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, 'r') as manifest_file:
+        stored = json.load(manifest_file)
 
-    # if there are more images than number_of_images, use number_of_images images evenly
-    # spaced across the range
-    if image_data.shape[0] > number_of_images:
-        spacing = int(image_data.shape[0] / number_of_images)
-        image_data = image_data[::spacing,:,:]
-        if image_data.shape[0] > number_of_images:
-            image_data = image_data[:number_of_images,:,:]
+    if None in manifest['inputs'].values():
+        return False
+    for key in ('inputs', 'params', 'code'):
+        if stored.get(key, None) != manifest[key]:
+            return False
 
-    # we will compare all images to this one, needs to be padded to account for image drift
-    first_img = np.pad(image_data[0,:,:], pad_size, mode='reflect')
+    return stored.get('output', None) == get_stack_checksum(fov_id, peak_id or 0, color)
 
-    xcorr_array = [] # array holds cross correlation vaues
-    for img in image_data:
-        # use match_template to find all cross correlations for the
-        # current image against the first image.
-        xcorr_array.append(np.max(match_template(first_img, img)))
+# write the manifest of an output which was just saved
+def record_manifest(stage, fov_id, peak_id, color, manifest, output_stack):
+    checksum = hash_stack(output_stack)
+    set_stack_checksum(fov_id, peak_id or 0, color, checksum)
 
-    return xcorr_array
+    manifest = dict(manifest)
+    manifest['output'] = checksum
+    manifest['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    manifest_path = get_manifest_path(stage, fov_id, peak_id, color)
+    if not os.path.exists(os.path.dirname(manifest_path)):
+        try:
+            os.makedirs(os.path.dirname(manifest_path))
+        except OSError:
+            pass # made by another process in the meantime
+    write_json_atomic(manifest_path, manifest)
 
 ### functions about subtraction
 
 # average empty channels from stacks, making another TIFF stack
-def average_empties_stack(fov_id, specs, color='c1', align=True):
+def average_empties_stack(fov_id, specs, color='c1', align=True, pool=None):
     '''Takes the fov file name and the peak names of the designated empties,
     averages them and saves the image
 
@@ -1758,8 +3387,11 @@ def average_empties_stack(fov_id, specs, color='c1', align=True):
     color : string
         Which plane to use.
     align : boolean
-        Flag that is passed to the worker function average_empties, indicates
+        Flag that is passed to the worker function average_empties_block, indicates
         whether images should be aligned be for averaging (use False for fluorescent images)
+    pool : multiprocessing.Pool
+        Pool to use, made with init_pool_worker as the initializer. If not given,
+        a pool is made for this FOV when there is more than one empty.
 
     Returns
         True if succesful.
@@ -1782,8 +3414,15 @@ def average_empties_stack(fov_id, specs, color='c1', align=True):
         information("No empty channel designated for FOV %d." % fov_id)
         return False
 
+    # skip if the empties, parameters and code are the same as last time
+    manifest = make_manifest('empties', fov_id, [(peak_id, color) for peak_id in empty_peak_ids],
+                             extra_params={'align': align})
+    if is_output_up_to_date('empties', fov_id, None, 'empty_%s' % color, manifest):
+        information("Empty channel for FOV %d is up to date." % fov_id)
+        return True
+
     # if there is just one then you can just copy that channel
-    elif len(empty_peak_ids) == 1:
+    if len(empty_peak_ids) == 1:
         peak_id = empty_peak_ids[0]
         information("One empty channel (%d) designated for FOV %d." % (peak_id, fov_id))
 
@@ -1802,26 +3441,42 @@ def average_empties_stack(fov_id, specs, color='c1', align=True):
 
         information("%d empty channels designated for FOV %d." % (len(empty_stacks), fov_id))
 
-        # go through time points and create list of averaged empties
-        avg_empty_stack = [] # list will be later concatentated into numpy array
-        time_points = range(image_data.shape[0]) # index is time
-        for t in time_points:
-            # get images from one timepoint at a time and send to alignment and averaging
-            imgs = [stack[t] for stack in empty_stacks]
-            avg_empty = average_empties(imgs, align=align) # function is in mm3
-            avg_empty_stack.append(avg_empty)
+        # (empty, t, y, x), cut to the shortest stack
+        frame_count = min([stack.shape[0] for stack in empty_stacks])
+        empty_stacks = np.stack([stack[:frame_count] for stack in empty_stacks], axis=0)
+
+        # set up multiprocessing pool to do the averaging, if one was not passed in
+        own_pool = pool is None
+        if own_pool:
+            pool = Pool(processes=params['num_analyzers'], initializer=init_pool_worker, initargs=(params,))
 
-        # concatenate list and then save out to tiff stack
-        avg_empty_stack = np.stack(avg_empty_stack, axis=0)
+        # send blocks of time points to be aligned and averaged
+        frames_per_task = params['subtract'].get('frames_per_task', 20)
+        block_results = [pool.apply_async(average_empties_block,
+                                          args=(empty_stacks[:, t:t+frames_per_task], align))
+                         for t in range(0, frame_count, frames_per_task)]
+
+        # linear loop for debug
+        # avg_empty_stack = average_empties_block(empty_stacks, align=align)
+
+        # concatenate blocks and then save out
+        avg_empty_stack = np.concatenate([result.get() for result in block_results], axis=0)
+
+        if own_pool:
+            pool.close() # tells the process nothing more will be added.
+            pool.join() # blocks script until everything has been processed and workers exit
+
+    # drop the cached copy of the stack being rewritten
+    invalidate_stack_cache(fov_id, color='empty_%s' % color)
 
     # save out data
     if params['output'] == 'TIFF':
         # make new name and save it
         empty_filename = params['experiment_name'] + '_xy%03d_empty_%s.tif' % (fov_id, color)
-        tiff.imsave(os.path.join(params['empty_dir'],empty_filename), avg_empty_stack, compress=4)
+        tiff.imsave(os.path.join(params['empty_dir'],empty_filename), avg_empty_stack, compress=get_tiff_compress('empty'))
 
     if params['output'] == 'HDF5':
-        h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
+        h5f = get_h5_file(fov_id, 'r+')
 
         # delete the dataset if it exists (important for debug)
         if 'empty_%s' % color in h5f:
@@ -1830,74 +3485,72 @@ def average_empties_stack(fov_id, specs, color='c1', align=True):
         # the empty channel should be it's own dataset
         h5ds = h5f.create_dataset(u'empty_%s' % color,
                         data=avg_empty_stack,
-                        chunks=(1, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-                        maxshape=(None, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-                        compression="gzip", shuffle=True, fletcher32=True)
+                        **get_h5_dataset_options('empty', avg_empty_stack.shape[1:]))
 
         # give attribute which says which channels contribute
         h5ds.attrs.create('empty_channels', empty_peak_ids)
-        h5f.close()
+        flush_h5_file(fov_id)
+
+    if params['output'] == 'zarr':
+        save_zarr_stack(avg_empty_stack, fov_id, 'empty_%s' % color, 'empty',
+                        attrs={'empty_channels': [int(peak_id) for peak_id in empty_peak_ids]})
+
+    record_manifest('empties', fov_id, None, 'empty_%s' % color, manifest, avg_empty_stack)
 
     information("Saved empty channel for FOV %d." % fov_id)
 
     return True
 
-# averages a list of empty channels
-def average_empties(imgs, align=True):
+# averages a block of time points of the empty channels
+def average_empties_block(empty_stacks, align=True):
     '''
-    This function averages a set of images (empty channels) and returns a single image
-    of the same size. It first aligns the images to the first image before averaging.
+    This function averages a set of empty channels at each time point and returns
+    a (t, y, x) stack of the same size as one empty channel. It first aligns the
+    empties to the first empty before averaging.
+
+    Alignment is done as if the first image was enlarged using reflect padding, and
+    the others were matched to it with match_template, padded so they were in the
+    aligned place and averaged, with the padding trimmed off at the end. Here the
+    offsets for all time points are found at once with get_alignment_offsets, and
+    only the part of each aligned image inside the trimmed area is made, with
+    shift_stack, and added to a running sum.
 
-    Alignment is done by enlarging the first image using edge padding.
-    Subsequent images are then aligned to this image and the offset recorded.
-    These images are padded such that they are the same size as the first (padded) image but
-    with the image in the correct (aligned) place. Edge padding is again used.
-    The images are then placed in a stack and aveaged. This image is trimmed so it is the size
-    of the original images
+    Parameters
+    empty_stacks : np.array (empty, t, y, x)
+        Empty channel stacks of an FOV, for a block of time points.
+    align : boolean
+        Align the empties to the first one (use False for fluorescent images).
+
+    Returns
+    avg_empty_stack : np.array (t, y, x) of uint16
 
     Called by
     average_empties_stack
     '''
 
-    aligned_imgs = [] # list contains the aligned, padded images
+    empty_count, frame_count = empty_stacks.shape[:2]
+    frame_shape = empty_stacks.shape[2:]
+
+    # the first empty is the reference and goes in unchanged
+    empty_sum = empty_stacks[0].astype('float64')
 
     if align:
         # pixel size to use for padding (ammount that alignment could be off)
         pad_size = params['subtract']['alignment_pad']
+        ref_stack = np.pad(empty_stacks[0], [[0, 0], [pad_size, pad_size], [pad_size, pad_size]],
+                           mode='reflect') # padded reference images
+
+    for n in range(1, empty_count):
+        if align:
+            # find index of highest correlation (relative to top left corner of the padded reference)
+            offsets = get_alignment_offsets(ref_stack, empty_stacks[n])
+            # move the empty there, then trim off the padding
+            empty_sum += shift_stack(empty_stacks[n], offsets - pad_size, frame_shape)
+        else:
+            empty_sum += empty_stacks[n]
 
-        for n, img in enumerate(imgs):
-            # if this is the first image, pad it and add it to the stack
-            if n == 0:
-                ref_img = np.pad(img, pad_size, mode='reflect') # padded reference image
-                aligned_imgs.append(ref_img)
-
-            # otherwise align this image to the first padded image
-            else:
-                # find correlation between a convolution of img against the padded reference
-                match_result = match_template(ref_img, img)
-
-                # find index of highest correlation (relative to top left corner of img)
-                y, x = np.unravel_index(np.argmax(match_result), match_result.shape)
-
-                # pad img so it aligns and is the same size as reference image
-                pad_img = np.pad(img, ((y, ref_img.shape[0] - (y + img.shape[0])),
-                                       (x, ref_img.shape[1] - (x + img.shape[1]))), mode='reflect')
-                aligned_imgs.append(pad_img)
-    else:
-        # don't align, just link the names to go forward easily
-        aligned_imgs = imgs
-
-    # stack the aligned data along 3rd axis
-    aligned_imgs = np.dstack(aligned_imgs)
-    # get a mean image along 3rd axis
-    avg_empty = np.nanmean(aligned_imgs, axis=2)
-    # trim off the padded edges (only if images were alinged, otherwise there was no padding)
-    if align:
-        avg_empty = avg_empty[pad_size:-1*pad_size, pad_size:-1*pad_size]
-    # change type back to unsigned 16 bit not floats
-    avg_empty = avg_empty.astype(dtype='uint16')
-
-    return avg_empty
+    # get the mean image and change type back to unsigned 16 bit not floats
+    return (empty_sum / empty_count).astype(dtype='uint16')
 
 # this function is used when one FOV doesn't have an empty
 def copy_empty_stack(from_fov, to_fov, color='c1'):
@@ -1907,14 +3560,17 @@ def copy_empty_stack(from_fov, to_fov, color='c1'):
     information('Loading empty stack from FOV {} to save for FOV {}.'.format(from_fov, to_fov))
     avg_empty_stack = load_stack(from_fov, 0, color='empty_{}'.format(color))
 
+    # drop the cached copy of the stack being rewritten
+    invalidate_stack_cache(to_fov, color='empty_%s' % color)
+
     # save out data
     if params['output'] == 'TIFF':
         # make new name and save it
         empty_filename = params['experiment_name'] + '_xy%03d_empty_%s.tif' % (to_fov, color)
-        tiff.imsave(os.path.join(params['empty_dir'],empty_filename), avg_empty_stack, compress=4)
+        tiff.imsave(os.path.join(params['empty_dir'],empty_filename), avg_empty_stack, compress=get_tiff_compress('empty'))
 
     if params['output'] == 'HDF5':
-        h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % to_fov), 'r+')
+        h5f = get_h5_file(to_fov, 'r+')
 
         # delete the dataset if it exists (important for debug)
         if 'empty_%s' % color in h5f:
@@ -1923,32 +3579,47 @@ def copy_empty_stack(from_fov, to_fov, color='c1'):
         # the empty channel should be it's own dataset
         h5ds = h5f.create_dataset(u'empty_%s' % color,
                         data=avg_empty_stack,
-                        chunks=(1, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-                        maxshape=(None, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-                        compression="gzip", shuffle=True, fletcher32=True)
+                        **get_h5_dataset_options('empty', avg_empty_stack.shape[1:]))
 
         # give attribute which says which channels contribute. Just put 0
         h5ds.attrs.create('empty_channels', [0])
-        h5f.close()
+        flush_h5_file(to_fov)
+
+    if params['output'] == 'zarr':
+        save_zarr_stack(avg_empty_stack, to_fov, 'empty_%s' % color, 'empty',
+                        attrs={'empty_channels': [0]})
 
     information("Saved empty channel for FOV %d." % to_fov)
 
 # Do subtraction for an fov over many timepoints
-def subtract_fov_stack(fov_id, specs, color='c1', method='phase'):
+def subtract_fov_stack(fov_id, specs, color='c1', method='phase', pool=None):
     '''
     For a given FOV, loads the precomputed empty stack and does subtraction on
     all peaks in the FOV designated to be analyzed
 
+    The frames of each channel are sent to the pool in blocks of
+    params['subtract']['frames_per_task'] (default 20). The next channel is
+    loaded and sent while the current one is being worked on, so the workers
+    are not left waiting on loading and saving.
+
+    Phase subtraction saves how far each empty frame was moved to line it up
+    with the channel (see save_alignment_shifts). Fluorescence subtraction moves
+    its empties by the same amounts, unless params['subtract']['align_fluor'] is
+    False or the phase channel has not been subtracted yet.
+
     Parameters
     ----------
     color : string, 'c1', 'c2', etc.
         This is the channel to subtraction. will be appended to the word empty.
+    pool : multiprocessing.Pool
+        Pool to use, made with init_pool_worker as the initializer, so that one
+        pool can be used for all FOVs. If not given, a pool is made for this FOV.
 
     Called by
     mm3_Subtract.py
 
     Calls
-    mm3.subtract_phase
+    mm3.subtract_frames
 
     '''
 
@@ -1969,60 +3640,197 @@ def subtract_fov_stack(fov_id, specs, color='c1', method='phase'):
     if not ana_peak_ids:
         return False
 
-    # load images for the peak and get phase images
+    # fluorescence empties are aligned with the shifts from phase subtraction
+    align_fluor = method == 'fluor' and params['subtract'].get('align_fluor', True)
+    phase_color = params['phase_plane']
+
+    # skip channels if the channel, empty, parameters and code are the same as last time
+    peak_manifests = []
+    peak_shifts = {}
     for peak_id in ana_peak_ids:
-        information('Subtracting peak %d.' % peak_id)
+        inputs = [(peak_id, color), (0, 'empty_{}'.format(color))]
+        if align_fluor:
+            peak_shifts[peak_id] = load_alignment_shifts(fov_id, peak_id)
+            frame_count = get_stack_shape(fov_id, peak_id, color)[0]
+            if peak_shifts[peak_id] is None or peak_shifts[peak_id].shape[0] < frame_count:
+                warning('No phase alignment for FOV %d, peak %d, subtracting without it.'
+                        % (fov_id, peak_id))
+                peak_shifts[peak_id] = None
+            else:
+                # the shifts change when the phase subtraction does
+                inputs.append((peak_id, 'sub_{}'.format(phase_color)))
+
+        manifest = make_manifest('subtract', fov_id, inputs,
+                                 extra_params={'method': method,
+                                               'aligned': peak_shifts.get(peak_id) is not None})
+        if (is_output_up_to_date('subtract', fov_id, peak_id, 'sub_{}'.format(color), manifest)
+                and (method != 'phase' or os.path.exists(get_alignment_path(fov_id, peak_id)))):
+            information('Subtracted peak %d is up to date.' % peak_id)
+        else:
+            peak_manifests.append((peak_id, manifest))
 
-        image_data = load_stack(fov_id, peak_id, color=color)
+    if not peak_manifests:
+        return True
+
+    # set up multiprocessing pool to do subtraction, if one was not passed in
+    own_pool = pool is None
+    if own_pool:
+        pool = Pool(processes=params['num_analyzers'], initializer=init_pool_worker, initargs=(params,))
+
+    frames_per_task = params['subtract'].get('frames_per_task', 20)
 
-        # make a list for all time points to send to a multiprocessing pool
-        # list will length of image_data with tuples (image, empty)
-        subtract_pairs = zip(image_data, avg_empty_stack)
+    # send the frames of a channel to the pool in blocks of (images, empties, shifts)
+    def send_peak(peak_id):
+        information('Subtracting peak %d.' % peak_id)
+        image_data = load_stack(fov_id, peak_id, color=color)
+        shifts = peak_shifts.get(peak_id)
+        return [pool.apply_async(subtract_frames,
+                                 args=(method, image_data[t:t+frames_per_task],
+                                       avg_empty_stack[t:t+frames_per_task],
+                                       None if shifts is None else shifts[t:t+frames_per_task]))
+                for t in range(0, image_data.shape[0], frames_per_task)]
+
+    # linear loop for debug
+    # subtracted_stack, shifts = subtract_frames(method, load_stack(fov_id, peak_id, color=color),
+    #                                            avg_empty_stack, peak_shifts.get(peak_id))
+
+    next_results = send_peak(peak_manifests[0][0])
+    for n, (peak_id, manifest) in enumerate(peak_manifests):
+        peak_results = next_results
+        if n + 1 < len(peak_manifests):
+            next_results = send_peak(peak_manifests[n+1][0])
 
-        # set up multiprocessing pool to do subtraction. Should wait until finished
-        pool = Pool(processes=params['num_analyzers'])
+        # stack them up along a time axis
+        subtracted_blocks, shift_blocks = zip(*[result.get() for result in peak_results])
+        subtracted_stack = np.concatenate(subtracted_blocks, axis=0)
 
+        # save out the subtracted stack, and the alignment for the fluorescence channels
         if method == 'phase':
-            subtracted_imgs = pool.map(subtract_phase, subtract_pairs, chunksize=10)
-        elif method == 'fluor':
-            subtracted_imgs = pool.map(subtract_fluor, subtract_pairs, chunksize=10)
+            save_alignment_shifts(fov_id, peak_id, np.concatenate(shift_blocks, axis=0))
+        save_subtracted_stack(fov_id, peak_id, subtracted_stack, color=color)
+        record_manifest('subtract', fov_id, peak_id, 'sub_{}'.format(color), manifest, subtracted_stack)
+
+        information("Saved subtracted channel %d." % peak_id)
 
+    if own_pool:
         pool.close() # tells the process nothing more will be added.
         pool.join() # blocks script until everything has been processed and workers exit
 
-        # linear loop for debug
-        # subtracted_imgs = [subtract_phase(subtract_pair) for subtract_pair in subtract_pairs]
+    return True
 
-        # stack them up along a time axis
-        subtracted_stack = np.stack(subtracted_imgs, axis=0)
+# sets up a pool worker process
+def init_pool_worker(worker_params):
+    '''Pool initializer which gives the worker the parameters of the run, so that it
+    does not depend on them being inherited when the process is forked.
 
-        # save out the subtracted stack
-        if params['output'] == 'TIFF':
-            sub_filename = params['experiment_name'] + '_xy%03d_p%04d_sub_%s.tif' % (fov_id, peak_id, color)
-            tiff.imsave(os.path.join(params['sub_dir'],sub_filename), subtracted_stack, compress=4) # save it
+    Called by
+    average_empties_stack
+    subtract_fov_stack
+    work_queue
+    mm3_Subtract.py
+    mm3_Pipeline.py
+    '''
+    global params
+    params = worker_params
 
-        if params['output'] == 'HDF5':
-            h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
+# path of the saved phase alignment of a channel
+def get_alignment_path(fov_id, peak_id):
+    return os.path.join(params['align_dir'], params['experiment_name'] +
+                        '_xy%03d_p%04d_shifts.npy' % (fov_id, peak_id))
 
-            # put subtracted channel in correct group
-            h5g = h5f['channel_%04d' % peak_id]
+# saves how far the empty was moved for each frame of a channel
+def save_alignment_shifts(fov_id, peak_id, shifts):
+    '''Saves the (t, 2) rows and columns the phase empty was moved by for each
+    frame of a channel, as found by subtract_phase_stack.
 
-            # delete the dataset if it exists (important for debug)
-            if 'p%04d_sub_%s' % (peak_id, color) in h5g:
-                del h5g['p%04d_sub_%s' % (peak_id, color)]
+    Called by
+    subtract_fov_stack
+    process_chnl_stack
+    '''
+    if not os.path.exists(params['align_dir']):
+        try:
+            os.makedirs(params['align_dir'])
+        except OSError:
+            pass # made by another process in the meantime
 
-            h5ds = h5g.create_dataset(u'p%04d_sub_%s' % (peak_id, color),
-                            data=subtracted_stack,
-                            chunks=(1, subtracted_stack.shape[1], subtracted_stack.shape[2]),
-                            maxshape=(None, subtracted_stack.shape[1], subtracted_stack.shape[2]),
-                            compression="gzip", shuffle=True, fletcher32=True)
+    # write to the side and rename so a reader never sees half a file
+    align_path = get_alignment_path(fov_id, peak_id)
+    with open(align_path + '.tmp', 'wb') as align_file:
+        np.save(align_file, np.asarray(shifts, dtype='int16'))
+    os.rename(align_path + '.tmp', align_path)
 
-        information("Saved subtracted channel %d." % peak_id)
+# loads the phase alignment of a channel
+def load_alignment_shifts(fov_id, peak_id):
+    '''Returns the (t, 2) shifts saved by save_alignment_shifts, or None if the
+    phase channel has not been subtracted.
+
+    Called by
+    subtract_fov_stack
+    '''
+    align_path = get_alignment_path(fov_id, peak_id)
+    if not os.path.exists(align_path):
+        return None
+
+    return np.load(align_path).astype('int64')
+
+# subtracts a block of frames, run in the pool
+def subtract_frames(method, images, empties, shifts=None):
+    '''Subtracts each of a (t, y, x) block of images from its empty, with
+    subtract_phase_stack, or subtract_fluor_stack when the phase shifts are given
+    and subtract_fluor when they are not.
+
+    Returns the (t, y, x) subtracted block and the (t, 2) shifts used, or None
+    if the empties were not aligned.
+
+    Called by
+    subtract_fov_stack
+    '''
+
+    if method == 'phase':
+        return subtract_phase_stack(images, empties, return_shifts=True)
+    elif method == 'fluor':
+        if shifts is not None:
+            return subtract_fluor_stack(images, empties, shifts), shifts
+        return np.stack([subtract_fluor(image_pair) for image_pair in zip(images, empties)], axis=0), None
+
+# write out the subtracted stack of a channel
+def save_subtracted_stack(fov_id, peak_id, subtracted_stack, color='c1'):
+    '''
+    Saves a subtracted stack as sub_<color>, replacing any previous one.
+
+    Called by
+    subtract_fov_stack
+    process_chnl_stack
+    mm3_Pipeline.py
+    '''
+
+    # drop the cached copy of the stack being rewritten
+    invalidate_stack_cache(fov_id, peak_id, 'sub_%s' % color)
+
+    if params['output'] == 'TIFF':
+        sub_filename = params['experiment_name'] + '_xy%03d_p%04d_sub_%s.tif' % (fov_id, peak_id, color)
+        tiff.imsave(os.path.join(params['sub_dir'],sub_filename), subtracted_stack, compress=get_tiff_compress('subtracted')) # save it
 
     if params['output'] == 'HDF5':
-        h5f.close()
+        h5f = get_h5_file(fov_id, 'r+')
 
-    return True
+        # put subtracted channel in correct group
+        h5g = h5f['channel_%04d' % peak_id]
+
+        # delete the dataset if it exists (important for debug)
+        if 'p%04d_sub_%s' % (peak_id, color) in h5g:
+            del h5g['p%04d_sub_%s' % (peak_id, color)]
+
+        h5ds = h5g.create_dataset(u'p%04d_sub_%s' % (peak_id, color),
+                        data=subtracted_stack,
+                        **get_h5_dataset_options('subtracted', subtracted_stack.shape[1:]))
+        flush_h5_file(fov_id)
+
+    if params['output'] == 'zarr':
+        save_zarr_stack(subtracted_stack, fov_id, 'channel_%04d/p%04d_sub_%s' % (peak_id, peak_id, color),
+                        'subtracted')
+
+    return
 
 # subtracts one phase contrast image from another.
 def subtract_phase(image_pair):
@@ -2075,6 +3883,162 @@ def subtract_phase(image_pair):
 
     return channel_subtracted
 
+# sums over every window of a given size in a stack of images
+def window_sum_stack(img_stack, window_shape):
+    '''Returns the sum over each (h, w) window of a (t, y, x) stack, for all
+    positions where the window fits in the image, using summed area tables.
+    '''
+    h, w = window_shape
+    summed = np.zeros((img_stack.shape[0], img_stack.shape[1]+1, img_stack.shape[2]+1))
+    summed[:, 1:, 1:] = np.cumsum(np.cumsum(img_stack, axis=1), axis=2)
+
+    return summed[:, h:, w:] - summed[:, :-h, w:] - summed[:, h:, :-w] + summed[:, :-h, :-w]
+
+# aligns a stack of templates to a stack of images with normalized cross correlation
+def get_alignment_offsets(img_stack, template_stack):
+    '''Finds where each frame of template_stack best matches the same frame of
+    img_stack. This is the same normalized cross correlation as match_template,
+    but done for all frames at once with FFTs along the image axes.
+
+    Parameters
+    img_stack : np.array (t, y, x)
+        Images to search in, e.g. padded phase channels.
+    template_stack : np.array (t, h, w)
+        Images to search for, no bigger than the images, e.g. empty channels.
+
+    Returns
+    offsets : np.array (t, 2) of int
+        Row and column of the top left corner of the best match of each template,
+        what np.unravel_index(np.argmax(match_template(image, template))) gives.
+
+    Called by
+    subtract_phase_stack
+    '''
+    # same scaling as match_template, which matters for the cut off for flat windows
+    img_stack = util.img_as_float(img_stack)
+    template_stack = util.img_as_float(template_stack)
+
+    frame_count = img_stack.shape[0]
+    img_shape = img_stack.shape[1:]
+    template_shape = template_stack.shape[1:]
+    template_volume = np.prod(template_shape)
+    result_shape = (img_shape[0] - template_shape[0] + 1, img_shape[1] - template_shape[1] + 1)
+
+    # cross correlation for each shift of the template in the image. Shifts where the
+    # template fits do not wrap around, so no more padding is needed for the FFT.
+    img_fft = np.fft.rfftn(img_stack, s=img_shape, axes=(1, 2))
+    template_fft = np.fft.rfftn(template_stack, s=img_shape, axes=(1, 2))
+    xcorr = np.fft.irfftn(img_fft * np.conj(template_fft), s=img_shape, axes=(1, 2))
+    xcorr = xcorr[:, :result_shape[0], :result_shape[1]]
+
+    # normalize by the image windows and the template
+    image_window_sum = window_sum_stack(img_stack, template_shape)
+    image_window_sum2 = window_sum_stack(img_stack ** 2, template_shape)
+    template_mean = template_stack.reshape(frame_count, -1).mean(axis=1)[:, None, None]
+    template_ssd = np.sum((template_stack - template_mean) ** 2, axis=(1, 2))[:, None, None]
+
+    numerator = xcorr - image_window_sum * template_mean
+    denominator = image_window_sum2 - image_window_sum ** 2 / template_volume
+    denominator = np.sqrt(np.maximum(denominator * template_ssd, 0))
+
+    response = np.zeros(numerator.shape)
+    mask = denominator > np.finfo(np.float64).eps
+    response[mask] = numerator[mask] / denominator[mask]
+
+    best_match = np.argmax(response.reshape(frame_count, -1), axis=1)
+
+    return np.stack(np.unravel_index(best_match, result_shape), axis=1)
+
+# index into an axis of length n as np.pad(mode='reflect') would for positions outside it
+def reflect_index(index, n):
+    if n == 1:
+        return np.zeros_like(index)
+    period = 2 * (n - 1)
+    index = np.mod(index, period)
+    return np.where(index >= n, period - index, index)
+
+# shifts each frame of a stack
+def shift_stack(img_stack, shifts, frame_shape):
+    '''Returns img_stack with frame t moved down by shifts[t, 0] and right by
+    shifts[t, 1] rows and columns, cut or extended to frame_shape. Pixels from
+    outside the image are filled by reflection, as np.pad(mode='reflect') does.
+    '''
+    # pixel (i, j) of the shifted frame comes from pixel (i - dy, j - dx), reflected at the edges
+    rows = reflect_index(np.arange(frame_shape[0])[None, :] - shifts[:, 0:1], img_stack.shape[1])
+    columns = reflect_index(np.arange(frame_shape[1])[None, :] - shifts[:, 1:2], img_stack.shape[2])
+    frames = np.arange(img_stack.shape[0])[:, None, None]
+
+    return img_stack[frames, rows[:, :, None], columns[:, None, :]]
+
+# subtracts a stack of phase contrast images from a stack of empties
+def subtract_phase_stack(img_stack, empty_stack, frames_per_batch=100, return_shifts=False):
+    '''Does what subtract_phase does for each frame, for a whole (t, y, x) stack.
+    The alignment offsets are found for frames_per_batch frames at a time with
+    get_alignment_offsets, and the empties are shifted and subtracted with array
+    indexing instead of padding and cropping each frame.
+
+    Parameters
+    img_stack : np.array (t, y, x)
+        Phase contrast channel stack.
+    empty_stack : np.array (t, y, x)
+        Empty channel for each frame.
+    return_shifts : bool
+        Also return the (t, 2) rows and columns each empty frame was moved by.
+
+    Returns
+    subtracted_stack : np.array (t, y, x) of uint16
+        Same as stacking the output of subtract_phase for each frame.
+
+    Called by
+    subtract_frames
+    process_chnl_stack
+    '''
+    pad_size = params['subtract']['alignment_pad'] # pixel size to use for padding (ammount that alignment could be off)
+
+    # pair up frames as zip would
+    frame_count = min(img_stack.shape[0], empty_stack.shape[0])
+    img_stack = img_stack[:frame_count]
+    empty_stack = np.asarray(empty_stack[:frame_count])
+    padded_stack = np.pad(img_stack, [[0, 0], [pad_size, pad_size], [pad_size, pad_size]],
+                          mode='reflect')
+
+    offsets = np.concatenate([get_alignment_offsets(padded_stack[t:t+frames_per_batch],
+                                                    empty_stack[t:t+frames_per_batch])
+                              for t in range(0, img_stack.shape[0], frames_per_batch)], axis=0)
+
+    # the empty is placed at the offset in the padded channel, which is then trimmed by the pad
+    shifts = offsets - pad_size
+    aligned_empty = shift_stack(empty_stack, shifts, img_stack.shape[1:])
+
+    # subtract cropped cell image from empty channel, and zero out anything less than 0.
+    subtracted_stack = aligned_empty.astype('int32') - img_stack.astype('int32')
+    subtracted_stack[subtracted_stack < 0] = 0
+    subtracted_stack = subtracted_stack.astype('uint16') # change back to 16bit
+
+    if return_shifts:
+        return subtracted_stack, shifts
+    return subtracted_stack
+
+# subtracts a stack of fluorescence images from a stack of empties
+def subtract_fluor_stack(img_stack, empty_stack, shifts):
+    '''Like subtract_fluor for each frame, but the empties are first moved by the
+    (t, 2) shifts found when subtracting the phase channel (see subtract_phase_stack),
+    so they line up with the channel as the phase empties did.
+
+    Called by
+    subtract_frames
+    '''
+    frame_count = min(img_stack.shape[0], empty_stack.shape[0], shifts.shape[0])
+    img_stack = img_stack[:frame_count]
+    aligned_empty = shift_stack(np.asarray(empty_stack[:frame_count]), shifts[:frame_count],
+                                img_stack.shape[1:])
+
+    # subtract the empty channel from the cell image, and zero out anything less than 0.
+    subtracted_stack = img_stack.astype('int32') - aligned_empty.astype('int32')
+    subtracted_stack[subtracted_stack < 0] = 0
+
+    return subtracted_stack.astype('uint16') # change back to 16bit
+
 # subtract one fluorescence image from another.
 def subtract_fluor(image_pair):
     ''' subtract_fluor does a simple subtraction of one image to another. Unlike subtract_phase,
@@ -2135,6 +4099,12 @@ def segment_chnl_stack(fov_id, peak_id):
     mm3.segment_image
     '''
 
+    # skip if the subtracted images, parameters and code are the same as last time
+    manifest = make_manifest('segment', fov_id, [(peak_id, 'sub_{}'.format(params['phase_plane']))])
+    if is_output_up_to_date('segment', fov_id, peak_id, params['seg_img'], manifest):
+        information('Segmented FOV %d, channel %d is up to date.' % (fov_id, peak_id))
+        return True
+
     information('Segmenting FOV %d, channel %d.' % (fov_id, peak_id))
 
     # load subtracted images
@@ -2159,13 +4129,34 @@ def segment_chnl_stack(fov_id, peak_id):
     segmented_imgs = segmented_imgs.astype('uint8')
 
     # save out the segmented stack
+    save_segmented_stack(fov_id, peak_id, segmented_imgs)
+    record_manifest('segment', fov_id, peak_id, params['seg_img'], manifest, segmented_imgs)
+
+    information("Saved segmented channel %d." % peak_id)
+
+    return True
+
+# write out the segmented stack of a channel
+def save_segmented_stack(fov_id, peak_id, segmented_imgs):
+    '''
+    Saves a segmented stack as params['seg_img'], replacing any previous one.
+
+    Called by
+    segment_chnl_stack
+    process_chnl_stack
+    mm3_Pipeline.py
+    '''
+
+    # drop the cached copy of the stack being rewritten
+    invalidate_stack_cache(fov_id, peak_id, params['seg_img'])
+
     if params['output'] == 'TIFF':
         seg_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['seg_img'])
         tiff.imsave(os.path.join(params['seg_dir'],seg_filename),
-                    segmented_imgs, compress=5)
+                    segmented_imgs, compress=get_tiff_compress('segmented'))
 
     if params['output'] == 'HDF5':
-        h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
+        h5f = get_h5_file(fov_id, 'r+')
 
         # put segmented channel in correct group
         h5g = h5f['channel_%04d' % peak_id]
@@ -2176,14 +4167,13 @@ def segment_chnl_stack(fov_id, peak_id):
 
         h5ds = h5g.create_dataset(u'p%04d_%s' % (peak_id, params['seg_img']),
                         data=segmented_imgs,
-                        chunks=(1, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                        maxshape=(None, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                        compression="gzip", shuffle=True, fletcher32=True)
-        h5f.close()
+                        **get_h5_dataset_options('segmented', segmented_imgs.shape[1:]))
+        flush_h5_file(fov_id)
 
-    information("Saved segmented channel %d." % peak_id)
+    if params['output'] == 'zarr':
+        save_zarr_stack(segmented_imgs, fov_id, 'channel_%04d/p%04d_%s' % (peak_id, peak_id, params['seg_img']), 'segmented')
 
-    return True
+    return
 
 # segmentation algorithm
 def segment_image(image):
@@ -2418,13 +4408,17 @@ def segment_cells_unet(ana_peak_ids, fov_id, pad_dict, unet_shape, model):
                              (0,pad_dict['right_trim'])),
                              mode='constant')
 
+        # drop the cached copies of the stacks being rewritten
+        invalidate_stack_cache(fov_id, peak_id, params['pred_img'])
+        invalidate_stack_cache(fov_id, peak_id, params['seg_img'])
+
         if params['segment']['save_predictions']:
             pred_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['pred_img'])
             if not os.path.isdir(params['pred_dir']):
                 os.makedirs(params['pred_dir'])
             int_preds = (predictions * 255).astype('uint8')
             tiff.imsave(os.path.join(params['pred_dir'], pred_filename),
-                            int_preds, compress=4)
+                            int_preds, compress=get_tiff_compress('predictions'))
 
         # binarized and label (if there is a threshold value, otherwise, save a grayscale for debug)
         if cellClassThreshold:
@@ -2454,11 +4448,12 @@ def segment_cells_unet(ana_peak_ids, fov_id, pad_dict, unet_shape, model):
         # save out the segmented stacks
         if params['output'] == 'TIFF':
             seg_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['seg_img'])
+            # U-net segmentations were always saved at level 4
             tiff.imsave(os.path.join(params['seg_dir'], seg_filename),
-                            segmented_imgs, compress=4)
+                            segmented_imgs, compress=get_tiff_compress('segmented', default_level=4))
 
         if params['output'] == 'HDF5':
-            h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
+            h5f = get_h5_file(fov_id, 'r+')
             # put segmented channel in correct group
             h5g = h5f['channel_%04d' % peak_id]
             # delete the dataset if it exists (important for debug)
@@ -2467,10 +4462,11 @@ def segment_cells_unet(ana_peak_ids, fov_id, pad_dict, unet_shape, model):
 
             h5ds = h5g.create_dataset(u'p%04d_%s' % (peak_id, params['seg_img']),
                                 data=segmented_imgs,
-                                chunks=(1, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                                maxshape=(None, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                                compression="gzip", shuffle=True, fletcher32=True)
-            h5f.close()
+                                **get_h5_dataset_options('segmented', segmented_imgs.shape[1:]))
+            flush_h5_file(fov_id)
+
+        if params['output'] == 'zarr':
+            save_zarr_stack(segmented_imgs, fov_id, 'channel_%04d/p%04d_%s' % (peak_id, peak_id, params['seg_img']), 'segmented')
 
 def segment_fov_unet(fov_id, specs, model, color=None):
     '''
@@ -2499,9 +4495,9 @@ def segment_fov_unet(fov_id, specs, model, color=None):
         if spec == 1:
             break # just break out with the current peak_id
 
-    img_stack = load_stack(fov_id, peak_id, color=color)
-    img_height = img_stack.shape[1]
-    img_width = img_stack.shape[2]
+    stack_shape = get_stack_shape(fov_id, peak_id, color=color)
+    img_height = stack_shape[1]
+    img_width = stack_shape[2]
 
     pad_dict = get_pad_distances(unet_shape, img_height, img_width)
 
@@ -2559,13 +4555,17 @@ def segment_foci_unet(ana_peak_ids, fov_id, pad_dict, unet_shape, model):
         predictions = predictions[:, pad_dict['top_pad']:unet_shape[0]-pad_dict['bottom_pad'],
                                      pad_dict['left_pad']:unet_shape[1]-pad_dict['right_pad'], 0]
 
+        # drop the cached copies of the stacks being rewritten
+        invalidate_stack_cache(fov_id, peak_id, params['pred_img'])
+        invalidate_stack_cache(fov_id, peak_id, params['seg_img'])
+
         if params['foci']['save_predictions']:
             pred_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['pred_img'])
             if not os.path.isdir(params['foci_pred_dir']):
                 os.makedirs(params['foci_pred_dir'])
             int_preds = (predictions * 255).astype('uint8')
             tiff.imsave(os.path.join(params['foci_pred_dir'], pred_filename),
-                            int_preds, compress=4)
+                            int_preds, compress=get_tiff_compress('predictions'))
 
         # binarized and label (if there is a threshold value, otherwise, save a grayscale for debug)
         if focusClassThreshold:
@@ -2595,11 +4595,12 @@ def segment_foci_unet(ana_peak_ids, fov_id, pad_dict, unet_shape, model):
         # save out the segmented stacks
         if params['output'] == 'TIFF':
             seg_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['seg_img'])
+            # U-net segmentations were always saved at level 4
             tiff.imsave(os.path.join(params['foci_seg_dir'], seg_filename),
-                            segmented_imgs, compress=4)
+                            segmented_imgs, compress=get_tiff_compress('segmented', default_level=4))
 
         if params['output'] == 'HDF5':
-            h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
+            h5f = get_h5_file(fov_id, 'r+')
             # put segmented channel in correct group
             h5g = h5f['channel_%04d' % peak_id]
             # delete the dataset if it exists (important for debug)
@@ -2608,10 +4609,11 @@ def segment_foci_unet(ana_peak_ids, fov_id, pad_dict, unet_shape, model):
 
             h5ds = h5g.create_dataset(u'p%04d_%s' % (peak_id, params['seg_img']),
                                 data=segmented_imgs,
-                                chunks=(1, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                                maxshape=(None, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                                compression="gzip", shuffle=True, fletcher32=True)
-            h5f.close()
+                                **get_h5_dataset_options('segmented', segmented_imgs.shape[1:]))
+            flush_h5_file(fov_id)
+
+        if params['output'] == 'zarr':
+            save_zarr_stack(segmented_imgs, fov_id, 'channel_%04d/p%04d_%s' % (peak_id, peak_id, params['seg_img']), 'segmented')
 
 def segment_fov_foci_unet(fov_id, specs, model, color=None):
     '''
@@ -2640,9 +4642,9 @@ def segment_fov_foci_unet(fov_id, specs, model, color=None):
         if spec == 1:
             break # just break out with the current peak_id
 
-    img_stack = load_stack(fov_id, peak_id, color=color)
-    img_height = img_stack.shape[1]
-    img_width = img_stack.shape[2]
+    stack_shape = get_stack_shape(fov_id, peak_id, color=color)
+    img_height = stack_shape[1]
+    img_width = stack_shape[2]
 
     # find padding and trimming distances
     pad_dict = get_pad_distances(unet_shape, img_height, img_width)
@@ -3282,7 +5284,7 @@ def get_tracking_model_dict():
     return(model_dict)
 
 # Creates lineage for a single channel
-def make_lineage_chnl_stack(fov_and_peak_id):
+def make_lineage_chnl_stack(fov_and_peak_id, image_data_seg=None):
     '''
     Create the lineage for a set of segmented images for one channel. Start by making the regions in the first time points potenial cells. Go forward in time and map regions in the timepoint to the potential cells in previous time points, building the life of a cell. Used basic checks such as the regions should overlap, and grow by a little and not shrink too much. If regions do not link back in time, discard them. If two regions map to one previous region, check if it is a sensible division event.
 
@@ -3290,6 +5292,8 @@ def make_lineage_chnl_stack(fov_and_peak_id):
     ----------
     fov_and_peak_ids : tuple.
         (fov_id, peak_id)
+    image_data_seg : np.ndarray
+        Segmented (t, y, x) stack to use instead of loading params['track']['seg_img'].
 
     Returns
     -------
@@ -3315,8 +5319,9 @@ def make_lineage_chnl_stack(fov_and_peak_id):
 
     information('Creating lineage for FOV %d, channel %d.' % (fov_id, peak_id))
 
-    # load segmented data
-    image_data_seg = load_stack(fov_id, peak_id, color=params['track']['seg_img'])
+    # load segmented data, unless it was passed in
+    if image_data_seg is None:
+        image_data_seg = load_stack(fov_id, peak_id, color=params['track']['seg_img'])
     # image_data_seg = load_stack(fov_id, peak_id, color='seg')
 
     # Calculate all data for all time points.
@@ -3465,6 +5470,453 @@ def make_lineage_chnl_stack(fov_and_peak_id):
     # return the dictionary with all the cells
     return Cells
 
+# subtract, segment and track one channel without going through the disk
+def process_chnl_stack(fov_id, peak_id, save_outputs=()):
+    '''
+    Runs phase subtraction, Otsu segmentation and standard lineage creation for
+    one channel in memory. This is what mm3_Subtract.py, mm3_Segment-Otsu.py and
+    mm3_Track-Standard.py do, without writing and reading back the subtracted and
+    segmented stacks in between. The empty stack for the FOV must already exist.
+
+    Parameters
+    ----------
+    fov_id : int
+    peak_id : int
+    save_outputs : list
+        Stacks to save as well, 'sub' and/or 'seg'. Each channel is its own TIFF
+        file or zarr array so these are saved here. An HDF5 file can only be written
+        by one process, so for HDF5 output the stacks are returned for the caller
+        to save instead.
+
+    Returns
+    -------
+    chnl_result : dict
+        'fov', 'peak', 'cells' (as from make_lineage_chnl_stack), 'frames' and
+        'seconds', plus 'sub' and 'seg' stacks still to be saved.
+
+    Called by
+    mm3_Pipeline.py
+    '''
+
+    try:
+        start_time = time.time()
+        color = params['phase_plane']
+
+        # the empty stack is shared by the channels of the FOV, so it is mostly cached
+    # when params['stack_cache_mb'] is set
+        avg_empty_stack = load_stack(fov_id, 0, color='empty_{}'.format(color))
+        image_data = load_stack(fov_id, peak_id, color=color)
+
+        subtracted_stack, shifts = subtract_phase_stack(image_data, avg_empty_stack, return_shifts=True)
+        save_alignment_shifts(fov_id, peak_id, shifts)
+        segmented_imgs = np.stack([segment_image(sub_image) for sub_image
+                                   in subtracted_stack], axis=0).astype('uint8')
+        Cells = make_lineage_chnl_stack((fov_id, peak_id), image_data_seg=segmented_imgs)
+
+        chnl_result = {'fov': fov_id,
+                       'peak': peak_id,
+                       'cells': Cells,
+                       'frames': image_data.shape[0],
+                       'seconds': time.time() - start_time}
+
+        for output, output_stack in (('sub', subtracted_stack), ('seg', segmented_imgs)):
+            if output not in save_outputs:
+                continue
+            if params['output'] == 'HDF5':
+                chnl_result[output] = output_stack
+            elif output == 'sub':
+                save_subtracted_stack(fov_id, peak_id, output_stack, color=color)
+            else:
+                save_segmented_stack(fov_id, peak_id, output_stack)
+    finally:
+        # let the caller open the file for writing once all channels of the FOV are done
+        if params['output'] == 'HDF5':
+            close_h5_file(fov_id)
+
+    return chnl_result
+
+### functions for the shared job queue
+# The queue lets workers on several machines, which see the same analysis folder,
+# share the work of a stage. Each job is a json file in params['queue_dir']:
+#
+#   pending/<stage>_xy001_p0003.json       waiting for a worker
+#   leased/<stage>_xy001_p0003.json@<host>.<pid>   being run by that worker
+#   done/, failed/                         finished, or out of attempts
+#
+# A worker leases a job by renaming it from pending to leased, which only one
+# worker can do. While it runs the job it touches the lease file every
+# heartbeat_seconds. Leases not touched for lease_seconds (the worker died or
+# its host went away) are put back in pending by any worker, until the job has
+# been tried max_attempts times. Settings are in params['queue'], and the clocks
+# of the machines should agree to well within lease_seconds.
+#
+# A worker whose lease was taken from it (it could not touch the lease file, e.g.
+# because another worker reaped it) leaves the job to whoever runs it now and does
+# not record it. A running job cannot be stopped, so it still finishes writing its
+# files; lease_seconds should be well above heartbeat_seconds so this is rare.
+#
+# An HDF5 file can only be written by one process, so for HDF5 output each job
+# covers all channels of an FOV. Otherwise each channel is its own job.
+
+queue_states = ['pending', 'leased', 'done', 'failed']
+
+# get a queue setting
+def get_queue_option(option_name):
+    queue_defaults = {'lease_seconds': 300, # a lease not renewed for this long is given up
+                      'heartbeat_seconds': 30, # how often a worker renews its lease
+                      'max_attempts': 3, # tries before a job goes to failed
+                      'poll_seconds': 10} # wait before looking for jobs again
+    queue_params = params.get('queue', None) or {}
+    return queue_params.get(option_name, queue_defaults[option_name])
+
+# folder of the jobs in one state
+def get_queue_path(state, job_file_name=None):
+    state_path = os.path.join(params['queue_dir'], state)
+    if job_file_name is None:
+        return state_path
+    return os.path.join(state_path, job_file_name)
+
+# name of the json file of a job
+def get_queue_job_name(stage, fov_id, peak_id=None):
+    if peak_id is None:
+        return '%s_xy%03d_all.json' % (stage, fov_id)
+    return '%s_xy%03d_p%04d.json' % (stage, fov_id, peak_id)
+
+# make the folders of the queue
+def make_queue_dirs():
+    for state in queue_states:
+        if not os.path.exists(get_queue_path(state)):
+            try:
+                os.makedirs(get_queue_path(state))
+            except OSError:
+                pass # made by another worker in the meantime
+
+# identifies this worker in lease file names
+def get_queue_worker_id():
+    return '%s.%d' % (socket.gethostname(), os.getpid())
+
+# put jobs for a stage in the queue
+def submit_queue_jobs(stage, fov_id_list, specs, resubmit=False):
+    '''Adds a job for each channel to analyze (spec 1) in each FOV of fov_id_list,
+    or one job per FOV for stages which work on whole FOVs and for HDF5 output.
+    Jobs already in the queue, in any state, are skipped unless resubmit is True.
+
+    Returns the number of jobs added.
+
+    Called by
+    mm3_Queue.py
+    '''
+
+    if stage not in queue_stages:
+        raise ValueError('Unknown stage %s, use one of %s.' % (stage, ', '.join(sorted(queue_stages))))
+
+    make_queue_dirs()
+
+    # names of all the jobs in the queue, leases have the worker after the @
+    queued_names = set()
+    for state in queue_states:
+        queued_names.update([file_name.split('@')[0] for file_name
+                             in os.listdir(get_queue_path(state))])
+
+    per_fov = queue_stages[stage][1] or params['output'] == 'HDF5'
+
+    submitted = 0
+    for fov_id in fov_id_list:
+        ana_peak_ids = sorted([peak_id for peak_id, spec in six.iteritems(specs[fov_id]) if spec == 1])
+        if not ana_peak_ids:
+            continue
+
+        if per_fov:
+            jobs = [(None, ana_peak_ids)]
+        else:
+            jobs = [(peak_id, [peak_id]) for peak_id in ana_peak_ids]
+
+        for peak_id, peak_ids in jobs:
+            job_name = get_queue_job_name(stage, fov_id, peak_id)
+            if job_name in queued_names and not resubmit:
+                continue
+
+            # remove old copies in other states
+            for state in ('done', 'failed'):
+                if os.path.exists(get_queue_path(state, job_name)):
+                    os.remove(get_queue_path(state, job_name))
+
+            write_json_atomic(get_queue_path('pending', job_name),
+                              {'stage': stage,
+                               'fov': int(fov_id),
+                               'peaks': [int(peak) for peak in peak_ids],
+                               'attempts': 0,
+                               'errors': []})
+            submitted += 1
+
+    return submitted
+
+# move a job to another state with updated contents
+def move_queue_job(job_path, job, state):
+    '''Writes job into the file at job_path and moves it to state. Returns False if
+    the file is gone, e.g. because the lease was given up and taken by another
+    worker.'''
+
+    job_name = os.path.basename(job_path).split('@')[0]
+    try:
+        with open(job_path, 'r+') as job_file:
+            job_file.seek(0)
+            job_file.truncate()
+            json.dump(job, job_file, indent=2, sort_keys=True)
+        os.rename(job_path, get_queue_path(state, job_name))
+    except (IOError, OSError):
+        return False
+    return True
+
+# put expired leases back in pending
+def reap_queue_leases():
+    '''Leases which were not renewed for lease_seconds go back to pending, or to
+    failed once the job has been tried max_attempts times. Returns the number of
+    leases given up.'''
+
+    lease_seconds = get_queue_option('lease_seconds')
+    max_attempts = get_queue_option('max_attempts')
+
+    reaped = 0
+    for lease_name in os.listdir(get_queue_path('leased')):
+        lease_path = get_queue_path('leased', lease_name)
+        try:
+            if time.time() - os.path.getmtime(lease_path) < lease_seconds:
+                continue
+            # take the lease over first, so only one worker reaps it
+            reap_path = '%s@reaped.%s' % (lease_path.split('@')[0], get_queue_worker_id())
+            os.rename(lease_path, reap_path)
+            with open(reap_path, 'r') as job_file:
+                job = json.load(job_file)
+        except (IOError, OSError, ValueError):
+            continue
+
+        job['attempts'] += 1
+        job['errors'].append('Lease of %s expired.' % lease_name.split('@')[-1])
+        warning('Lease %s expired.' % lease_name)
+        move_queue_job(reap_path, job, 'failed' if job['attempts'] >= max_attempts else 'pending')
+        reaped += 1
+
+    return reaped
+
+# take the next pending job
+def lease_queue_job(stages=None):
+    '''Leases a pending job, of one of stages if given. Returns the job and the path
+    of the lease file, or (None, None) if there are no pending jobs.'''
+
+    for job_name in sorted(os.listdir(get_queue_path('pending'))):
+        if stages and job_name.split('_xy')[0] not in stages:
+            continue
+
+        lease_path = '%s@%s' % (get_queue_path('leased', job_name), get_queue_worker_id())
+        try:
+            # the lease starts now, not when the job was submitted
+            os.utime(get_queue_path('pending', job_name), None)
+            os.rename(get_queue_path('pending', job_name), lease_path)
+        except OSError:
+            continue # another worker got it first
+
+        with open(lease_path, 'r') as job_file:
+            return json.load(job_file), lease_path
+
+    return None, None
+
+# keep a lease alive while the job runs, sets lease_lost if it cannot
+def renew_queue_lease(lease_path, stop_event, lease_lost):
+    heartbeat_seconds = get_queue_option('heartbeat_seconds')
+    while not stop_event.wait(heartbeat_seconds):
+        try:
+            os.utime(lease_path, None)
+        except OSError:
+            warning('Lost lease %s.' % os.path.basename(lease_path))
+            lease_lost.set()
+            return
+
+# run the function of a stage for a job
+def run_queue_job(job, pool):
+    stage_function = queue_stages[job['stage']][0]
+    stage_function(job['fov'], job['peaks'], pool)
+
+# work through the queue until it is empty
+def work_queue(stages=None, max_jobs=None):
+    '''Leases and runs jobs until there are no pending or leased jobs left, or
+    max_jobs have been run. A job which raises goes back to pending (retried), or to
+    failed after max_attempts, with the traceback added to its errors. A job whose
+    lease was lost while it ran is abandoned, it belongs to the worker which took
+    the lease over.
+
+    Returns a dict with the number of jobs done, retried, failed and abandoned by
+    this worker.
+
+    The worker makes one pool, with init_pool_worker, which the stages use for all
+    of its jobs.
+
+    Called by
+    mm3_Queue.py
+    '''
+
+    make_queue_dirs()
+    max_attempts = get_queue_option('max_attempts')
+
+    # made before any heartbeat thread is started, so no thread is forked with it
+    pool = Pool(processes=params['num_analyzers'], initializer=init_pool_worker, initargs=(params,))
+    try:
+        worker_counts = work_queue_jobs(stages, max_jobs, max_attempts, pool)
+    finally:
+        pool.close() # tells the process nothing more will be added.
+        pool.join() # blocks script until everything has been processed and workers exit
+
+    return worker_counts
+
+# the job loop of work_queue
+def work_queue_jobs(stages, max_jobs, max_attempts, pool):
+    worker_counts = {'done': 0, 'retried': 0, 'failed': 0, 'abandoned': 0}
+
+    while max_jobs is None or sum(worker_counts.values()) < max_jobs:
+        reap_queue_leases()
+        job, lease_path = lease_queue_job(stages)
+
+        if job is None:
+            # wait for other workers, whose jobs may still come back to pending
+            if not os.listdir(get_queue_path('leased')):
+                break
+            time.sleep(get_queue_option('poll_seconds'))
+            continue
+
+        job_label = '%s FOV %d, channels %s' % (job['stage'], job['fov'],
+                                               ', '.join([str(peak) for peak in job['peaks']]))
+        information('Running %s.' % job_label)
+
+        stop_event = threading.Event()
+        lease_lost = threading.Event()
+        heartbeat = threading.Thread(target=renew_queue_lease,
+                                     args=(lease_path, stop_event, lease_lost))
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        start_time = time.time()
+        try:
+            # the next job may be run by a worker on another machine, so files are closed after
+            with h5_session():
+                run_queue_job(job, pool)
+            state = 'done'
+        except Exception:
+            job['attempts'] += 1
+            job['errors'].append(traceback.format_exc())
+            warning('Job %s failed.' % job_label)
+            warning(job['errors'][-1])
+            state = 'failed' if job['attempts'] >= max_attempts else 'pending'
+        finally:
+            stop_event.set()
+            heartbeat.join()
+
+        # another worker may be running the job again, leave it to that worker
+        if lease_lost.is_set():
+            warning('Abandoned %s, its lease was lost while it ran.' % job_label)
+            worker_counts['abandoned'] += 1
+            continue
+
+        job['worker'] = get_queue_worker_id()
+        job['seconds'] = time.time() - start_time
+        if not move_queue_job(lease_path, job, state):
+            warning('Lease of %s was given up before it finished.' % job_label)
+            worker_counts['abandoned'] += 1
+            continue
+        worker_counts['retried' if state == 'pending' else state] += 1
+
+    return worker_counts
+
+# count the jobs in each state
+def get_queue_status():
+    '''Returns {stage : {state : number of jobs}}.'''
+
+    queue_status = {}
+    for state in queue_states:
+        if not os.path.exists(get_queue_path(state)):
+            continue
+        for job_name in os.listdir(get_queue_path(state)):
+            stage = job_name.split('_xy')[0]
+            queue_status.setdefault(stage, dict([(s, 0) for s in queue_states]))
+            queue_status[stage][state] += 1
+
+    return queue_status
+
+# put failed jobs back in pending
+def retry_queue_jobs(stages=None):
+    make_queue_dirs()
+    retried = 0
+    for job_name in os.listdir(get_queue_path('failed')):
+        if stages and job_name.split('_xy')[0] not in stages:
+            continue
+        with open(get_queue_path('failed', job_name), 'r') as job_file:
+            job = json.load(job_file)
+        job['attempts'] = 0
+        if move_queue_job(get_queue_path('failed', job_name), job, 'pending'):
+            retried += 1
+    return retried
+
+### stages the queue can run. Each takes the fov_id, a list of peak ids and the pool
+# of the worker.
+# average the empties of an FOV
+def queue_empties(fov_id, peak_ids, pool):
+    specs = load_specs()
+    if not average_empties_stack(fov_id, specs, color=params['phase_plane'], align=True, pool=pool):
+        raise ValueError('FOV %d has no empty channels.' % fov_id)
+
+# phase subtraction of channels
+def queue_subtract(fov_id, peak_ids, pool):
+    job_specs = {fov_id: dict([(peak_id, 1) for peak_id in peak_ids])}
+    subtract_fov_stack(fov_id, job_specs, color=params['phase_plane'], method='phase', pool=pool)
+
+# Otsu segmentation of channels
+def queue_segment(fov_id, peak_ids, pool):
+    for peak_id in peak_ids:
+        segment_chnl_stack(fov_id, peak_id)
+
+# standard lineages of channels
+def queue_lineage(fov_id, peak_ids, pool):
+    for peak_id in peak_ids:
+        save_queue_cells(fov_id, peak_id, make_lineage_chnl_stack((fov_id, peak_id)))
+
+# subtraction, segmentation and lineages in memory, see process_chnl_stack
+def queue_process(fov_id, peak_ids, pool):
+    for peak_id in peak_ids:
+        save_queue_cells(fov_id, peak_id, process_chnl_stack(fov_id, peak_id)['cells'])
+
+# stage name : (function, whether jobs must cover a whole FOV)
+queue_stages = {'empties': (queue_empties, True),
+                'subtract': (queue_subtract, False),
+                'segment': (queue_segment, False),
+                'lineage': (queue_lineage, False),
+                'process': (queue_process, False)}
+
+# save the cells of one channel, to be put together by collect_queue_cells
+def save_queue_cells(fov_id, peak_id, Cells):
+    cells_path = os.path.join(params['cell_dir'], 'channels')
+    if not os.path.exists(cells_path):
+        try:
+            os.makedirs(cells_path)
+        except OSError:
+            pass # made by another worker in the meantime
+    cell_filename = os.path.join(cells_path, 'xy%03d_p%04d_cells.pkl' % (fov_id, peak_id))
+    with open(cell_filename + '.tmp', 'wb') as cell_file:
+        pickle.dump(Cells, cell_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(cell_filename + '.tmp', cell_filename)
+
+# put the cells of all channels together
+def collect_queue_cells():
+    '''Returns one dictionary of the cells saved by the lineage and process stages.'''
+
+    Cells = {}
+    cells_path = os.path.join(params['cell_dir'], 'channels')
+    for cell_filename in sorted(os.listdir(cells_path)):
+        if not cell_filename.endswith('_cells.pkl'):
+            continue
+        with open(os.path.join(cells_path, cell_filename), 'rb') as cell_file:
+            Cells.update(pickle.load(cell_file))
+
+    return Cells
+
 ### Cell class and related functions
 
 # this is the object that holds all information for a detection
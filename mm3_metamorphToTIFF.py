@@ -11,6 +11,7 @@ from skimage import io
 from skimage.external import tifffile as tiff
 import argparse
 import inspect
+from multiprocessing import Pool
 
 # user modules
 # realpath() will make your script run, even if you symlink it
@@ -42,15 +43,53 @@ def warning(*objs):
 def information(*objs):
     print(time.strftime("%H:%M:%S", time.localtime()), *objs, file=sys.stdout)
 
+# combine the per channel TIFFs of one stage position and frame
+def convert_image(file_name_list, new_name, y_crop, x_crop, tif_compress):
+    '''Stacks the channel images in file_name_list, crops them, and saves the stack
+    to new_name. Run by the conversion pool, one image per task.
+
+    tif_compress is between 0 and 9, 0 is no compression, 9 is most compression.
+    '''
+
+    imgs = []
+    for imgname in file_name_list:
+        with tiff.TiffFile(imgname) as tif:
+            imgs.append(tif.asarray())
+
+    img_data = np.stack(imgs, axis=0) # combine channels into a stacked tiff
+
+    # crop image. Use the whole image where there are Nones
+    y_lo = y_crop[0] if y_crop[0] else 0
+    y_hi = y_crop[1] if y_crop[1] else img_data.shape[1]
+    x_lo = x_crop[0] if x_crop[0] else 0
+    x_hi = x_crop[1] if x_crop[1] else img_data.shape[2]
+
+    img_data = img_data[:, y_lo:y_hi, x_lo:x_hi]
+
+    # save out image
+    information("Saving {}.".format(new_name))
+    tiff.imsave(new_name, img_data, compress=tif_compress, photometric='minisblack')
+
+    return new_name
+
+# check if an output is newer than all of its inputs
+def is_up_to_date(new_name, file_name_list):
+    if not os.path.exists(new_name):
+        return False
+    output_mtime = os.path.getmtime(new_name)
+    return all(os.path.getmtime(imgname) < output_mtime for imgname in file_name_list)
+
 # runs if script is run from terminal
 if __name__ == '__main__':
     '''Edit TIFFs from Jeremy's format to the one expected by mm3.'''
 
     # set switches and parameters
-    parser = argparse.ArgumentParser(prog='python mm3_Compile.py',
-                                     description='Identifies and slices out channels into individual TIFF stacks through time.')
+    parser = argparse.ArgumentParser(prog='python mm3_metamorphToTIFF.py',
+                                     description='Combines Metamorph channel images into multipage TIFFs for mm3.')
     parser.add_argument('-f', '--paramfile',  type=str,
                         required=True, help='Yaml file containing parameters.')
+    parser.add_argument('-j', '--nproc',  type=int,
+                        required=False, help='Number of processors to use.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -62,6 +101,11 @@ if __name__ == '__main__':
         param_file_path = 'yaml_templates/params_SJ110_100X.yaml'
     p = mm3.init_mm3_helpers(param_file_path) # initialized the helper library
 
+    # number of threads for multiprocessing
+    if namespace.nproc:
+        p['num_analyzers'] = namespace.nproc
+    mm3.information('Using {} threads for multiprocessing.'.format(p['num_analyzers']))
+
     # define variables here
     source_dir = p['experiment_directory']
     dest_dir = os.path.join(source_dir,'TIFF')
@@ -75,11 +119,26 @@ if __name__ == '__main__':
     time_between_frames = p['metamorphToTIFF']['seconds_between_frames']
     strain_name = p['metamorphToTIFF']['strain_name']
 
+    # number between 0 and 9, 0 is no compression, 9 is most compression.
+    tif_compress = p['metamorphToTIFF'].get('tiff_compress', 0)
+
+    # group the files of each channel by stage position and frame
     file_name_dict = {}
     for i in file_name_filters:
-        file_name_dict[i] = glob.glob(os.path.join(source_dir, '*{}*.TIF'.format(i)))
-        #file_name_dict[i] = [file_path.split('/')[-1] for file_path in file_name_dict[i]]
-        file_name_dict[i].sort()
+        file_name_dict[i] = {}
+        for file_path in glob.glob(os.path.join(source_dir, '*{}*.TIF'.format(i))):
+            mat = pat.match(file_path.replace(' ','_'))
+            if mat is None:
+                continue
+            stagePosition, frame = mat.group(1,2)
+            file_name_dict[i][(int(stagePosition), int(frame))] = file_path
+
+    # only images which have a file for every channel can be combined
+    image_keys = set(file_name_dict[file_name_filters[0]].keys())
+    for i in file_name_filters[1:]:
+        image_keys &= set(file_name_dict[i].keys())
+    image_keys = sorted(image_keys)
+    information('Found {} images with all {} channels.'.format(len(image_keys), len(file_name_filters)))
 
     # cropping
     t_crop = p['metamorphToTIFF']['t_crop']
@@ -93,45 +152,46 @@ if __name__ == '__main__':
         if x_crop[i] == "None":
             x_crop[i] = None
 
-    new_name_list = []
-
-    for i in range(len(file_name_dict[file_name_filters[0]])):
-
-        file_name_list = [file_name_dict[file_name_filter][i] for file_name_filter in file_name_filters]
-        #pprint(file_name_list) # uncomment for debugging
-        init_file_name = file_name_list[0]
-
-        nameStr = init_file_name.replace(' ','_')
-        #print(nameStr) # uncomment for debugging
-        mat = pat.match(nameStr)
-        stagePosition,frame = mat.group(1,2)
-        stagePosition = int(stagePosition)
-        frame = int(frame)
-
+    # find what needs converting
+    conversions = []
+    skipped = 0
+    for stagePosition, frame in image_keys:
         # skip if we aren't using this time point
         if (t_crop[0] and frame < t_crop[0]) or (t_crop[1] and frame > t_crop[1]):
             continue
 
+        file_name_list = [file_name_dict[file_name_filter][(stagePosition, frame)]
+                          for file_name_filter in file_name_filters]
         new_name = os.path.join(dest_dir, '{}_t{:0=4}xy{:0=2}.tif'.format(file_prefix,
                                                                           frame,
                                                                           stagePosition))
 
-        imgs = []
-        for imgname in file_name_list:
-            with tiff.TiffFile(imgname) as tif:
-                imgs.append(tif.asarray())
-
-        img_data = np.stack(imgs, axis=0) # combine channels into a stacked tiff
-
-        # crop image. Set defaults incase there are Nones
-        if not y_crop[0]: y_crop[0] = 0
-        if not y_crop[1]: y_crop[1] = img_data.shape[1]
-        if not x_crop[0]: x_crop[0] = 0
-        if not x_crop[1]: x_crop[1] = img_data.shape[2]
-
-        img_data = img_data[:, y_crop[0]:y_crop[1], x_crop[0]:x_crop[1]]
+        # outputs newer than their inputs are already done
+        if is_up_to_date(new_name, file_name_list):
+            skipped += 1
+            continue
 
-        # save out image
-        information("Saving {}.".format(new_name))
-        # print(os.path.join(dest_dir,new_name))
-        io.imsave(os.path.join(dest_dir, new_name), img_data)
+        conversions.append((file_name_list, new_name))
+
+    information('Converting {} images, {} are up to date.'.format(len(conversions), skipped))
+
+    # convert in parallel
+    start_time = time.time()
+    pool = Pool(p['num_analyzers'])
+    results = [pool.apply_async(convert_image, args=(file_name_list, new_name, y_crop, x_crop, tif_compress))
+               for file_name_list, new_name in conversions]
+    pool.close() # tells the process nothing more will be added.
+    pool.join() # blocks script until everything has been processed and workers exit
+
+    converted = 0
+    for (file_name_list, new_name), result in zip(conversions, results):
+        try:
+            result.get()
+            converted += 1
+        except Exception as e:
+            mm3.warning('Failed to convert {}.'.format(new_name))
+            mm3.warning(e)
+
+    elapsed = time.time() - start_time
+    information('Converted {} images in {:.1f} s ({:.1f} files/s).'.format(converted, elapsed,
+                                                                        converted / max(elapsed, 1e-9)))